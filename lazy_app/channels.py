@@ -0,0 +1,172 @@
+import asyncio
+from collections import deque
+from protocol import ProtocolError
+
+# Logical channels multiplexed over one websocket, for peers that speak
+# protocol.CHANNELS. Lower channel numbers are always sent first. Channel 0
+# is plain, unframed text, exactly what older peers speak, so a connection
+# without channels is just a connection that only uses channel 0. Other
+# channels carry a short header and are split into fragments, so a large
+# message on one channel never holds up a small one on a higher priority:
+#   "#<channel>\n<data>"    the last (or only) fragment of a message
+#   "#<channel>+\n<data>"   more fragments of this message follow
+#   "#<channel>=<size>"     the receiver consumed <size> characters, the sender may send that much more
+CONTROL, INPUT, BULK = 0, 1, 2
+KNOWN = {CONTROL, INPUT, BULK}  # Every channel gets a queue, so others are refused
+WINDOW = 256 * 1024  # Characters in flight per channel before the receiver has to acknowledge them
+FRAGMENT = 16 * 1024
+
+# Commands that are latency sensitive and small, everything else defaults to CONTROL
+INPUT_COMMANDS = {"mouse_move", "key_press", "left_click", "right_click", "f1", "alt_tab", "screen_ack"}
+
+
+def command_channel(command: str) -> int:
+    return INPUT if command in INPUT_COMMANDS else CONTROL
+
+
+def frame(channel: int, data: str, more=False) -> str:
+    if channel == CONTROL:
+        return data
+    return f"#{channel}{'+' if more else ''}\n{data}"
+
+
+def grant(channel: int, size: int) -> str:
+    return f"#{channel}={size}"
+
+
+class Demux:
+
+    # Reassembles fragments and reports what was consumed, so the receiving
+    # side can hand the sender more credit
+    def __init__(self, on_consumed=None, window=WINDOW):
+        self.on_consumed = on_consumed
+        self.window = window
+        self.buffers: dict[int, list[str]] = {}
+        self.consumed: dict[int, int] = {}
+
+    def feed(self, message) -> tuple[int, str] | None:
+        # Returns (channel, message) once a message is complete
+        if not isinstance(message, str) or not message.startswith("#"):
+            return CONTROL, message
+
+        header, _, data = message.partition("\n")
+        grants = "=" in header
+        try:
+            if grants:
+                channel, size = (int(part) for part in header[1:].split("=", 1))
+            else:
+                more = header.endswith("+")
+                channel = int(header[1:].rstrip("+"))
+        except ValueError:
+            channel = None
+        if channel not in KNOWN:
+            raise ProtocolError(f"Malformed channel header {header[:32]!r}")
+        if grants:
+            self.granted(channel, size)
+            return None
+
+        self.acknowledge(channel, len(data))
+        if more:
+            self.buffers.setdefault(channel, []).append(data)
+            return None
+
+        parts = self.buffers.pop(channel, None)
+        if parts:
+            parts.append(data)
+            data = "".join(parts)
+        return channel, data
+
+    def granted(self, channel: int, size: int):
+        pass  # Only a sending side keeps credit
+
+    def acknowledge(self, channel: int, size: int):
+        consumed = self.consumed.get(channel, 0) + size
+        if consumed >= self.window // 4 and self.on_consumed:
+            self.on_consumed(channel, consumed)
+            consumed = 0
+        self.consumed[channel] = consumed
+
+
+class Channels(Demux):
+
+    # Both directions of one connection: a queue per channel drained by a
+    # single writer task in priority order, fragment by fragment, within the
+    # credit the other side granted. Queue entries are [key, message, offset].
+    def __init__(self, send, enabled=False, window=WINDOW, fragment=FRAGMENT):
+        super().__init__(self.queue_grant, window)
+        self.send = send
+        self.enabled = enabled
+        self.fragment = fragment
+        self.queues: dict[int, deque[list]] = {CONTROL: deque()}
+        self.credit: dict[int, int] = {}
+        self.grants: dict[int, int] = {}
+        self.ready = asyncio.Event()
+        self.writer = None
+
+    def start(self) -> "Channels":
+        self.writer = asyncio.create_task(self.run())
+        return self
+
+    def queue(self, channel: int) -> deque:
+        if not self.enabled:
+            channel = CONTROL
+        queue = self.queues.get(channel)
+        if queue is None:
+            queue = self.queues[channel] = deque()
+            self.queues = dict(sorted(self.queues.items()))
+        return queue
+
+    def put_nowait(self, message: str, channel=CONTROL, key=None):
+        self.queue(channel).append([key, message, 0])
+        self.ready.set()
+
+    def queue_grant(self, channel: int, size: int):
+        self.grants[channel] = self.grants.get(channel, 0) + size
+        self.ready.set()
+
+    def granted(self, channel: int, size: int):
+        self.credit[channel] = self.credit.get(channel, self.window) + size
+        self.ready.set()
+
+    def next_channel(self) -> int | None:
+        for channel, queue in self.queues.items():
+            if queue and (channel == CONTROL or self.credit.get(channel, self.window) > 0):
+                return channel
+        return None
+
+    async def run(self):
+        while True:
+            if self.grants:
+                grants, self.grants = self.grants, {}
+                for channel, size in grants.items():
+                    await self.send(grant(channel, size))
+                continue
+
+            channel = self.next_channel()
+            if channel is None:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+
+            queue = self.queues[channel]
+            entry = queue[0]
+            message, offset = entry[1], entry[2]
+            if channel == CONTROL:
+                queue.popleft()
+                await self.send(message)
+                self.sent(message)
+                continue
+
+            size = min(self.fragment, self.credit.get(channel, self.window), len(message) - offset)
+            more = offset + size < len(message)
+            if more:
+                entry[2] = offset + size
+            else:
+                queue.popleft()
+            self.credit[channel] = self.credit.get(channel, self.window) - size
+            await self.send(frame(channel, message[offset:offset + size], more))
+            if not more:
+                self.sent(message)
+
+    def sent(self, message: str):
+        pass
@@ -0,0 +1,141 @@
+import os
+import json
+import atexit
+import logging
+from queue import SimpleQueue
+from time import monotonic
+from logging.handlers import QueueHandler, QueueListener
+
+# Loggers only put records on a queue, a background thread formats them and
+# writes the console. Settings come from the environment, so levels can be
+# changed per module without editing code:
+#   LAZY_LOG_LEVEL   default level, then per logger overrides: "INFO,Outbox=DEBUG,Heartbeat=WARNING"
+#   LAZY_LOG_FORMAT  "text" (default) or "json", one object per line
+#   LAZY_LOG_RATE    records per second one call site may log before the rest are dropped, 0 for no limit
+#
+# Fields passed as extra={...} are kept on the record and written as
+# key=value pairs after the message, or as keys of the JSON object.
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_RATE = 20
+
+# Attributes every LogRecord has, anything else on a record is a field
+STANDARD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "taskName"}
+
+
+def fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in STANDARD}
+
+
+class KeyValueFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        pairs = " ".join(f"{key}={value}" for key, value in fields(record).items())
+        return f"{line} {pairs}" if pairs else line
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            **fields(record),
+        }, default=str)
+
+
+class RateLimit(logging.Filter):
+
+    # A token bucket per call site: a loop that logs on every message gets
+    # rate records per second, the next one through tells how many were
+    # dropped. Errors are never dropped.
+    def __init__(self, rate: float, burst: float = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst or rate
+        self.buckets: dict[tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not self.rate or record.levelno >= logging.ERROR:
+            return True
+
+        now = monotonic()
+        key = (record.pathname, record.lineno)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0]  # tokens, last refill, suppressed
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+
+        bucket[0] -= 1
+        if bucket[2]:
+            record.suppressed = bucket[2]
+            bucket[2] = 0
+        return True
+
+
+def parse_levels(spec: str) -> tuple[str, dict[str, str]]:
+    default, overrides = DEFAULT_LEVEL, {}
+    for part in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, level = part.rpartition("=")
+        if name:
+            overrides[name] = level.upper()
+        else:
+            default = level.upper()
+    return default, overrides
+
+
+class RecordHandler(QueueHandler):
+
+    # The stock prepare() formats the message and traceback on the caller's
+    # thread so the record can be pickled. The queue stays in this process,
+    # so the record goes as it is and the listener's handlers format it.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+QUEUE = SimpleQueue()
+HANDLER = RecordHandler(QUEUE)
+LIMIT = RateLimit(DEFAULT_RATE)
+HANDLER.addFilter(LIMIT)
+CONSOLE = logging.StreamHandler()
+LISTENER = QueueListener(QUEUE, CONSOLE)
+LEVELS = {"default": DEFAULT_LEVEL, "overrides": {}}
+
+
+def configure(levels: str = None, format: str = None, rate: float = None):
+    # Arguments left out fall back to the environment, then to the defaults
+    default, overrides = parse_levels(levels or os.environ.get("LAZY_LOG_LEVEL", ""))
+    LEVELS.update(default=default, overrides=overrides)
+    for name, logger in list(logging.root.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and HANDLER in logger.handlers:
+            logger.setLevel(overrides.get(name, default))
+    for name, level in overrides.items():
+        logging.getLogger(name).setLevel(level)
+
+    format = format or os.environ.get("LAZY_LOG_FORMAT", "text")
+    CONSOLE.setFormatter(JsonFormatter() if format == "json" else KeyValueFormatter())
+    LIMIT.rate = LIMIT.burst = float(rate if rate is not None else os.environ.get("LAZY_LOG_RATE", DEFAULT_RATE))
+
+
+def get_logger(name: str) -> logging.Logger:
+    logger = logging.getLogger(name)
+    if HANDLER not in logger.handlers:
+        logger.setLevel(LEVELS["overrides"].get(name, LEVELS["default"]))
+        logger.propagate = False
+        logger.addHandler(HANDLER)
+    return logger
+
+
+configure()
+LISTENER.start()
+atexit.register(LISTENER.stop)  # Writes out what is still queued
@@ -11,10 +11,15 @@ Config.set(
     ],
 )
 
-import json
 import asyncio
 import threading
-from printmoji import print
+from collections import deque
+from itertools import count
+from time import monotonic
+import protocol
+import channels
+from protocol import ProtocolError
+from lazy_logging import get_logger
 from lazy_socket.server import LazyServer
 
 from kivy.app import App
@@ -27,23 +32,70 @@ from ui_device_list import DeviceList
 from ui_properties import DeviceProperties, SiteProperties
 from ui_trackpad import TrackpadScreen
 
+logger = get_logger("LazyApp")
+
 
 class Manager:
 
+    # Seconds the manager waits for an agent's reply before answering "timeout"
+    DEADLINES = {"start_egmc": 30, "stop_egmc": 30, "clear_ram": 30, "start_automakro": 20, "stop_automakro": 20}
+    DEADLINE = 10
+    MAX_PENDING = 500
+    # Sent without a cid so the manager can merge bursts of them
+    STREAMED = {"mouse_move", "screen_ack"}
+
     def __init__(self, app: "MainApp"):
         self.client = None
         self.app = app
+        self.protocol = 0
+        self.cids = count(1)
+        # cid -> (target, command, time sent) for commands still waiting for a reply
+        self.pending: dict[str, tuple[str, str, float]] = {}
+        self.demux = channels.Demux(self.grant)
+
+    def connected(self, client, theirs):
+        self.client = client
+        self.protocol = protocol.negotiate(theirs)
+        self.demux = channels.Demux(self.grant)
 
-    def send(self, message):
+    def send(self, message, channel=channels.CONTROL):
         if self.client:
-            print(f"🟧Sending: {message}")
+            logger.debug("Sending %s", message)
+            if self.protocol >= protocol.CHANNELS:
+                message = channels.frame(channel, message)
             self.app.server.send(message, client=self.client)
         else:
-            print("No client connected to send message")
+            logger.warning("No client connected to send message")
+
+    def grant(self, channel, size):
+        self.app.server.send(channels.grant(channel, size), client=self.client)
+
+    def send_command(self, target, command, **fields):
+        channel = channels.command_channel(command)
+        if self.protocol >= protocol.CORRELATED and command not in self.STREAMED:
+            cid = str(next(self.cids))
+            if len(self.pending) >= self.MAX_PENDING:
+                self.pending.pop(next(iter(self.pending)))
+            self.pending[cid] = (target, command, monotonic())
+            deadline = self.DEADLINES.get(command, self.DEADLINE)
+            self.send(protocol.route(target, protocol.encode("app", command, **fields), cid=cid, ttl=deadline), channel)
+        elif self.protocol >= protocol.ROUTED:
+            self.send(protocol.route(target, protocol.encode("app", command, **fields)), channel)
+        else:
+            self.send(protocol.encode("app", command, target=target, **fields))
+
+    def complete(self, cid) -> str:
+        # Latency suffix for the status line, empty for uncorrelated replies
+        pending = self.pending.pop(cid, None)
+        if not pending:
+            return ""
+        return f" ({(monotonic() - pending[2]) * 1000:.0f} ms)"
 
 
 class MainApp(App):
 
+    LOG_LINES = 1000  # Lines kept per followed log
+
     BACKGROUND = 0.204, 0.278, 0.341, 1
     POSITIVE = 0.263, 0.667, 0.545, 1
     NEGATIVE = 0.976, 0.255, 0.267, 1
@@ -64,8 +116,9 @@ class MainApp(App):
         self.server.process_message = self.process_message
         self.server_thread.start()
         self._manager = Manager(self)
-
-        Clock.schedule_interval(lambda dt: self.update_devices(), 10)
+        self.device_epoch = None
+        self.device_version = None
+        self.logs: dict[tuple[str, str], deque] = {}
 
     def build_device_list_screen(self):
         self.device_list = DeviceList(name="devices")
@@ -84,7 +137,7 @@ class MainApp(App):
         return self.trackpad
 
     def build(self):
-        print("Building!")
+        logger.debug("Building")
         self.status = Label(text="Lazy App", size_hint_y=None, height=30)
 
         self.screen_manager = ScreenManager()
@@ -101,42 +154,117 @@ class MainApp(App):
         return layout
 
     def update_devices(self):
-        print("🟪Updating device list")
-        message = {"sender": "app", "command": "device_info"}
-        self._manager.send(json.dumps(message))
+        logger.info("Updating device list")
+        self._manager.send(
+            protocol.encode("app", "device_info", since=self.device_version, epoch=self.device_epoch)
+        )
+
+    def subscribe_devices(self):
+        logger.info("Subscribing to device updates")
+        self._manager.send(
+            protocol.encode("app", "subscribe", since=self.device_version, epoch=self.device_epoch)
+        )
+
+    def add_devices(self, data):
+        self.device_epoch = data["epoch"]
+        self.device_version = data["version"]
+        if data.get("unchanged"):
+            return
+
+        for properties in data["result"]:
+            self.device_list.add_or_update_device(properties)
+        logger.info(f"Added/Updated {len(data['result'])} devices")
 
-    def add_device(self, data):
-        self.device_list.add_or_update_device(data["result"])
-        print(f"🟩Added/Updated device {data['result'].get('ip', 'Unknown IP')}")
+    def show_fan_out(self, data):
+        summary = f"{data['action']}: {data['done']}/{data['total']} done, {data['failed']} failed"
+        if data.get("progress") and not data["finished"]:
+            # Updates report "<chunks sent>/<chunks>" per device still transferring
+            sent, chunks = (sum(int(count.split("/")[part]) for count in data["progress"].values()) for part in (0, 1))
+            summary += f", {len(data['progress'])} transferring ({sent * 100 // max(chunks, 1)}%)"
+        if data["finished"]:
+            failures = [f"{ip.split('.')[-1]} {result}" for ip, result in data["results"].items() if not isinstance(result, dict) and result not in ("Success", "Up to date")]
+            summary = "; ".join([summary] + failures)
+        self.status.text = summary
+
+    def show_log(self, agent_ip, data):
+        lines = self.logs.setdefault((agent_ip, data["path"]), deque(maxlen=self.LOG_LINES))
+        lines.extend(data["lines"])
+        if data.get("skipped"):
+            logger.warning(f"EGM {agent_ip} - skipped {data['skipped']} bytes of {data['path']}")
+        if lines:
+            self.status.text = f"{agent_ip} - {lines[-1]}"
 
     async def process_message(self, client, message):
-        data = json.loads(message)
+        try:
+            received = self._manager.demux.feed(message)
+        except ProtocolError as e:
+            logger.warning(f"Ignoring invalid message: {e}")
+            return
+        if not received:
+            return  # A fragment or a credit grant
+        _, message = received
+
+        routed = protocol.split_route(message)
+        if routed:
+            message = routed.payload
+
+        try:
+            data = protocol.decode(message)
+        except ProtocolError as e:
+            logger.warning(f"Ignoring invalid message: {e}")
+            return
+
+        if routed:
+            data["sender_ip"] = routed.sender
+
         sender, command = data["sender"], data["command"]
-        print(f"Received message from {sender}: {command}")
+        logger.debug("Received %s from %s", command, sender)
 
         if sender == "manager":
             if command == "register":
-                self._manager.client = client
-                print("🟨Connected to manager")
+                self._manager.connected(client, data.get("protocol"))
+                self._manager.send(protocol.encode("app", "register", protocol=protocol.PROTOCOL_VERSION))
+                logger.info("Connected to manager")
                 self.status.text = "Connected to manager"
-                self.update_devices()
+                self.subscribe_devices()
                 return
             
-            elif command == "device_info":
-                Clock.schedule_once(lambda dt: self.add_device(data))
+            elif command in ("device_info", "device_update"):
+                Clock.schedule_once(lambda dt: self.add_devices(data))
+                return
+
+            elif command == "fan_out":
+                Clock.schedule_once(lambda dt: self.show_fan_out(data))
+                return
+
+            elif command == "timeout" and routed:
+                target, command, _ = self._manager.pending.pop(routed.cid, (routed.sender, "command", 0))
+                logger.warning(f"EGM {target} - {command}: {data['result']}")
+                self.status.text = f"{target} - {command}: {data['result']}"
                 return
             
             else:
+                if routed:
+                    self._manager.pending.pop(routed.cid, None)
                 self.status.text = f"Manager: {data['result']}"
 
             
+        if sender == "egm" and command == "log_lines":
+            Clock.schedule_once(lambda dt: self.show_log(data["sender_ip"], data))
+            return
+
+        if sender == "egm" and command == "screen_frame":
+            Clock.schedule_once(lambda dt: self.trackpad.show_frame(data))
+            return
+
         if sender == "egm":
             result = data["result"]
             command = data["command"]
             agent_ip = data["sender_ip"]
 
-            print(f"🟨EGM {agent_ip} - {command} result: {result}")
-            self.status.text = f"{agent_ip} - {command}: {result}"
+            latency = self._manager.complete(routed.cid) if routed else ""
+            logger.debug("EGM %s - %s result: %s%s", agent_ip, command, result, latency)
+            self.status.text = f"{agent_ip} - {command}: {result}{latency}"
 
 
 if __name__ == "__main__":
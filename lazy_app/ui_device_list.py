@@ -1,10 +1,13 @@
-import json
 from kivy.app import App
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.screenmanager import Screen
 from kivy.uix.button import Button
-from kivy.properties import StringProperty
+from time import time
+from kivy.properties import BooleanProperty, StringProperty
 from ui_components import BorderedButton
+from lazy_logging import get_logger
+
+logger = get_logger("DeviceList")
 
 
 class Device(BorderedButton):
@@ -15,6 +18,8 @@ class Device(BorderedButton):
     site = StringProperty("?")
     bv_type = StringProperty("?")
     lazy_egm_version = StringProperty("?")
+    stale = BooleanProperty(False)  # Last known state, the manager has not heard from it since restarting
+    health = StringProperty("?")
 
     def __init__(self, app, properties={}, **kwargs):
         super().__init__(**kwargs)
@@ -26,19 +31,31 @@ class Device(BorderedButton):
         self.update_properties(properties)
 
     def update_properties(self, properties):
+        logger.debug("Updating device %s", properties)
         for key, value in properties.items():
-            print(key, "=", value)
             setattr(self, key, value)
 
         if "label" not in properties:
             self.label = f"EGM {self.id}"
+        if "telemetry" in properties:
+            self.health = self.describe(properties["telemetry"])
+
+    @staticmethod
+    def describe(telemetry: dict) -> str:
+        parts = [f"{name} {telemetry[key]}%" for key, name in (("cpu", "CPU"), ("memory", "RAM"), ("disk", "Disk"))
+                 if telemetry.get(key) is not None]
+        if telemetry.get("booted"):
+            hours = int(time() - telemetry["booted"]) // 3600
+            parts.append(f"up {hours // 24}d {hours % 24}h")
+        parts += [f"{name.split('.')[0]} {'on' if running else 'off'}"
+                  for name, running in telemetry.get("processes", {}).items()]
+        return ", ".join(parts)
 
     def send_command(self, command, status_text):
-        print(status_text)
+        logger.info(status_text)
         self.status_label.text = status_text
 
-        message = {"sender": "app", "command": command, "target": self.ip}
-        self.ws.send(json.dumps(message))
+        self.ws.send_command(self.ip, command)
 
     def stop_automakro(self):
         self.send_command("stop_automakro", f"Stopping AutoMakro on {self.id}")
@@ -113,6 +130,9 @@ class DeviceList(Screen):
                     self.app.device_properties.device = d  # Assignment triggers property refresh
                 return
 
+        if "site" not in properties:
+            return  # Partial update for a device we have not seen yet
+
         device = Device(self.app, properties)
         self.all_devices.append(device)
         container = self.ids.container
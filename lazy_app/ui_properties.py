@@ -1,3 +1,4 @@
+import protocol
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.screenmanager import Screen
 from ui_device_list import Device, Site
@@ -36,6 +37,9 @@ class SiteProperties(Screen):
 
     site = ObjectProperty(Site(), rebind=True)
 
+    # Device methods whose agent command has a different name
+    COMMANDS = {"stop_egm_controller": "stop_egmc", "start_egm_controller": "start_egmc"}
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.app = App.get_running_app()
@@ -49,5 +53,6 @@ class SiteProperties(Screen):
                              (self.__class__.__name__, attr))
 
     def run_all(self, command: str):
-        for device in self.site.ids.container.children:
-            getattr(device, command)()
+        command = self.COMMANDS.get(command, command)
+        self.status.text = f"Running {command} on {self.site.name}"
+        self.app._manager.send(protocol.encode("app", "fan_out", action=command, select={"site": self.site.name}))
@@ -1,10 +1,21 @@
-import json
-from kivy.properties import NumericProperty, ObjectProperty
+import zlib
+from base64 import b64decode
+from io import BytesIO
+from kivy.graphics.texture import Texture
+from kivy.properties import ListProperty, NumericProperty, ObjectProperty
 from kivy.uix.widget import Widget
 from kivy.uix.screenmanager import Screen
 from kivy.uix.textinput import TextInput
 from kivy.clock import Clock
 from ui_device_list import Device
+from lazy_logging import get_logger
+
+logger = get_logger("Trackpad")
+
+try:
+    from PIL import Image  # Decodes jpeg tiles, without it the agent sends zlib ones
+except ImportError:
+    Image = None
 
 
 class Trackpad(Widget):
@@ -14,11 +25,41 @@ class Trackpad(Widget):
     # Sensitivity multiplier for mouse movement
     sensitivity = NumericProperty(1.0)
 
+    # The EGM's screen, drawn as large as fits at x, y, width, height of picture
+    screen = ObjectProperty(None, allownone=True)
+    picture = ListProperty([0, 0, 0, 0])
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.active_touches = {}
         self.first_touch_pos = {}
         self.last_touch_pos = {}
+        self.bind(pos=self.fit, size=self.fit, screen=self.fit)
+
+    def fit(self, *args):
+        if not self.screen:
+            return
+        scale = min(self.width / self.screen.width, self.height / self.screen.height)
+        width, height = self.screen.width * scale, self.screen.height * scale
+        self.picture = [self.center_x - width / 2, self.center_y - height / 2, width, height]
+
+    def show_frame(self, data) -> bool:
+        # Draws the tiles of a screen_frame, False if they cannot be drawn
+        size = (data["width"], data["height"])
+        if not self.screen or self.screen.size != size:
+            if not data.get("full"):
+                return False  # Tiles of a size that is gone, the agent sends a whole frame when this is not acked
+            self.screen = Texture.create(size=size, colorfmt="rgb")
+            self.screen.flip_vertical()  # Rows arrive top first
+        for x, y, width, height, encoded in data["tiles"]:
+            tile = b64decode(encoded)
+            if data["codec"] == "jpeg":
+                pixels = Image.open(BytesIO(tile)).convert("RGB").tobytes()
+            else:
+                pixels = zlib.decompress(tile)
+            self.screen.blit_buffer(pixels, pos=(x, y), size=(width, height), colorfmt="rgb", bufferfmt="ubyte")
+        self.canvas.ask_update()
+        return True
 
     def on_touch_down(self, touch):
         if not self.collide_point(*touch.pos):
@@ -78,16 +119,40 @@ class TrackpadScreen(Screen):
 
     device: Device = ObjectProperty(Device(None))
 
+    # The agent streams its screen while this is shown, for SCREEN_LEASE
+    # seconds at a time unless renewed
+    CODECS = ["jpeg", "zlib"] if Image else ["zlib"]
+    SCREEN_LEASE = 60
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.moves = []
+        self.renew_screen = None
         Clock.schedule_interval(self.sum_mouse_moves, 0.1)
+
+    def on_enter(self):
+        self.watch_screen()
+        self.renew_screen = Clock.schedule_interval(self.watch_screen, self.SCREEN_LEASE / 3)
+
+    def on_leave(self):
+        if self.renew_screen:
+            self.renew_screen.cancel()
+        self.send_command("screen_stop", "Stopping the screen stream")
+        self.ids.trackpad.screen = None
+
+    def watch_screen(self, dt=None):
+        self.send_command("screen_stream", "Streaming the screen", max_width=int(self.ids.trackpad.width),
+                          codecs=self.CODECS, lease=self.SCREEN_LEASE)
+
+    def show_frame(self, data):
+        if data.get("sender_ip") != self.device.ip:
+            return  # Still on its way when the screen was left
+        if self.ids.trackpad.show_frame(data):
+            self.send_command("screen_ack", f"Showed frame {data['frame']}", frame=data["frame"])
     
     def send_command(self, command, status_text, **kwargs):
-        print(status_text)
-        message = {"sender": "app", "command": command, "target": self.device.ip}
-        message.update(kwargs)
-        self.device.ws.send(json.dumps(message))
+        logger.debug(status_text)
+        self.device.ws.send_command(self.device.ip, command, **kwargs)
 
     def sum_mouse_moves(self, dt):
         if not self.moves:
@@ -122,7 +187,7 @@ class KeyboardInput(TextInput):
     def keyboard_on_key_down(self, window, keycode, text, modifiers):
         key_num, key_name = keycode
         
-        print(f"Key pressed: {key_name}")
+        logger.debug("Key pressed: %s", key_name)
         if key_name == 'backspace':
             self.executor.on_key_press('backspace')
         elif key_name == 'shift':
@@ -0,0 +1,125 @@
+import os
+import asyncio
+import threading
+from collections import deque
+from lazy_logging import get_logger
+
+logger = get_logger("Input")
+
+
+class PyAutoGuiBackend:
+
+    # Injects into the desktop session. pyautogui is imported here so the
+    # agent can start with another backend where there is no desktop.
+    def __init__(self):
+        import pyautogui
+        pyautogui.PAUSE = 0  # The worker paces input itself, no sleeping after every call
+        self.gui = pyautogui
+
+    def move(self, dx, dy, duration):
+        self.gui.moveRel(dx, dy, duration=duration)
+
+    def click(self, button):
+        self.gui.click(button=button)
+
+    def press(self, key):
+        self.gui.press(key)
+
+    def hotkey(self, *keys, interval=0.0):
+        self.gui.hotkey(*keys, interval=interval)
+
+
+class RecordingBackend:
+
+    # Keeps what would have been injected, for tests and headless machines
+    def __init__(self):
+        self.events = []
+
+    def move(self, dx, dy, duration):
+        self.events.append(("move", dx, dy, duration))
+
+    def click(self, button):
+        self.events.append(("click", button))
+
+    def press(self, key):
+        self.events.append(("press", key))
+
+    def hotkey(self, *keys, interval=0.0):
+        self.events.append(("hotkey", *keys))
+
+
+BACKENDS = {"pyautogui": PyAutoGuiBackend, "recording": RecordingBackend}
+
+
+class Event:
+    __slots__ = ("action", "args", "kwargs", "futures", "loop")
+
+    def __init__(self, action: str, args: tuple, kwargs: dict, future: asyncio.Future, loop):
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.loop = loop
+
+
+class InputWorker:
+
+    # One thread injects everything, in the order it was submitted, so the
+    # event loop never waits on input. A move queued right behind another
+    # move is merged into it, anything else is a barrier, so a click always
+    # lands where the moves before it left the pointer. A move glides over
+    # MOVE_DURATION only when nothing is waiting behind it, otherwise it
+    # jumps, so lag stays bounded however fast the trackpad sends.
+    MOVE_DURATION = 0.1
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = BACKENDS[os.environ.get("LAZY_INPUT_BACKEND", "pyautogui")]()
+        self.backend = backend
+        self.queue: deque[Event] = deque()
+        self.ready = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="input", daemon=True)
+        self.thread.start()
+
+    def submit(self, action: str, *args, **kwargs) -> asyncio.Future:
+        # Resolves once the event was injected, or with the backend's error
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.ready:
+            tail = self.queue[-1] if self.queue else None
+            if action == "move" and tail and tail.action == "move":
+                tail.args = (tail.args[0] + args[0], tail.args[1] + args[1])
+                tail.futures.append(future)
+            else:
+                self.queue.append(Event(action, args, kwargs, future, loop))
+                self.ready.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                event = self.queue.popleft()
+                backlog = len(self.queue)
+
+            error = None
+            try:
+                if event.action == "move":
+                    self.backend.move(*event.args, duration=0 if backlog else self.MOVE_DURATION)
+                else:
+                    getattr(self.backend, event.action)(*event.args, **event.kwargs)
+            except Exception as e:
+                logger.warning(f"Could not inject {event.action}: {e}")
+                error = e
+            event.loop.call_soon_threadsafe(self.resolve, event.futures, error)
+
+    @staticmethod
+    def resolve(futures: list[asyncio.Future], error: Exception | None):
+        for future in futures:
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
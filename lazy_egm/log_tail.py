@@ -0,0 +1,154 @@
+import os
+import re
+import asyncio
+from collections import deque
+from pathlib import Path
+from time import monotonic
+from lazy_logging import get_logger
+
+logger = get_logger("LogTail")
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "WARNING": 30, "ERROR": 40, "CRITICAL": 50, "FATAL": 50}
+LEVEL = re.compile(r"\b(DEBUG|INFO|WARN(?:ING)?|ERROR|CRITICAL|FATAL)\b")
+LEVEL_WITHIN = 80  # Characters at the start of a line searched for its level
+
+
+class LogTail:
+
+    # Follows one file for one app. The file is only open while reading, so
+    # the program writing it can still rotate it; another file at the path,
+    # or one shorter than the offset, is read from its start. Lines are
+    # filtered here, by regex and by minimum level, where lines without a
+    # level (traceback lines) take the level of the line before. Matching
+    # lines go out in frames of up to BATCH characters, at most rate per
+    # second. Beyond that reading falls behind, and skips ahead to the end
+    # once it is MAX_LAG behind. Runs until the lease expires, the app
+    # renews it by asking again.
+    POLL = 0.5
+    BATCH = 16 * 1024
+    MAX_READ = 256 * 1024
+    MAX_PENDING = 256 * 1024
+    MAX_LINE = 8 * 1024
+    MAX_LAG = 4 * 1024 * 1024
+    RATE = 16 * 1024
+    MAX_RATE = 256 * 1024
+    LEASE = 300
+    MAX_LEASE = 3600
+
+    def __init__(self, path: str, send, alive):
+        self.path = Path(path)
+        self.send = send  # async (lines, offset, skipped)
+        self.alive = alive
+        self.identity = None
+        self.offset = 0
+        self.partial = b""
+        self.resync = False
+        self.line_level = 0
+        self.pending: deque[str] = deque()
+        self.pending_size = 0
+        self.skipped = 0
+        self.task = None
+
+    def configure(self, pattern: str = None, level: str = None, rate: int = None, lease: float = None):
+        if level and level.upper() not in LEVELS:
+            raise ValueError(f"unknown level {level}")
+        self.pattern = re.compile(pattern) if pattern else None
+        self.level = LEVELS[level.upper()] if level else 0
+        self.rate = max(1, min(rate or self.RATE, self.MAX_RATE))
+        self.expires = monotonic() + max(1, min(lease or self.LEASE, self.MAX_LEASE))
+
+    def start(self, backlog: int = 0):
+        # Blocking. Starts at the end of the file, or backlog lines before it.
+        stat = os.stat(self.path)
+        self.identity = (stat.st_dev, stat.st_ino)
+        self.offset = stat.st_size
+        if backlog > 0:
+            self.offset = self.rewind(stat.st_size, backlog)
+
+    def rewind(self, end: int, lines: int) -> int:
+        start = end
+        with open(self.path, "rb") as file:
+            newlines = 0
+            while start > 0 and newlines <= lines and end - start < self.MAX_LAG:
+                step = min(64 * 1024, start)
+                start -= step
+                file.seek(start)
+                newlines += file.read(step).count(b"\n")
+            file.seek(start)
+            data = file.read(end - start)
+        kept = data.split(b"\n")[-(lines + 1):]  # The last lines and whatever follows the last newline
+        return end - len(b"\n".join(kept))
+
+    async def run(self):
+        # The bucket holds a second's worth of the rate, so no frame ever
+        # carries more than the rate allows; a line that would not fit even
+        # in a full bucket is cut to fit
+        tokens = self.rate
+        last = monotonic()
+        while monotonic() < self.expires and self.alive():
+            if self.pending_size < self.MAX_PENDING:
+                await asyncio.to_thread(self.read)
+
+            now = monotonic()
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            last = now
+            if self.pending and len(self.pending[0]) > self.rate:
+                self.pending_size -= len(self.pending[0]) - self.rate
+                self.pending[0] = self.pending[0][:self.rate]
+            batch, size = [], 0
+            while self.pending and size + len(self.pending[0]) <= min(tokens, self.BATCH):
+                line = self.pending.popleft()
+                batch.append(line)
+                size += len(line)
+            self.pending_size -= size
+            tokens -= size
+
+            if batch or self.skipped:
+                await self.send(batch, self.offset, self.skipped)
+                self.skipped = 0
+            await asyncio.sleep(self.POLL)  # At most a frame per poll, however far behind
+
+    def read(self):
+        # Blocking, for a worker thread
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return  # Rotated away, the new file shows up later
+        identity = (stat.st_dev, stat.st_ino)
+        if identity != self.identity or stat.st_size < self.offset:
+            logger.info(f"{self.path} was rotated or truncated, reading it from the start")
+            self.identity, self.offset, self.partial, self.resync = identity, 0, b"", False
+        if stat.st_size == self.offset:
+            return
+
+        with open(self.path, "rb") as file:
+            if stat.st_size - self.offset > self.MAX_LAG:
+                # Skips to the end, and the rest of the line there if it is unfinished
+                self.skipped += stat.st_size - self.offset
+                file.seek(stat.st_size - 1)
+                self.offset, self.partial, self.resync = stat.st_size, b"", file.read(1) != b"\n"
+            file.seek(self.offset)
+            data = file.read(self.MAX_READ)
+        self.offset += len(data)
+
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        if self.resync and lines:
+            lines.pop(0)  # The rest of a line that was skipped
+            self.resync = False
+        if len(self.partial) > self.MAX_LINE:
+            lines.append(self.partial)
+            self.partial = b""
+        for line in lines:
+            self.filter(line.rstrip(b"\r").decode("utf-8", "replace")[:self.MAX_LINE])
+
+    def filter(self, line: str):
+        match = LEVEL.search(line, 0, LEVEL_WITHIN)
+        if match:
+            self.line_level = LEVELS[match.group(1)]
+        if self.line_level < self.level:
+            return
+        if self.pattern and not self.pattern.search(line):
+            return
+        self.pending.append(line)
+        self.pending_size += len(line)
@@ -1,22 +1,95 @@
-import time
 import socket
 import json
-import subprocess
-import pyautogui
+import asyncio
+import protocol
+import channels
+from protocol import ProtocolError
+from lazy_logging import get_logger
+from input_worker import InputWorker
+from log_tail import LogTail
+from outbox import Outbox
+from process_table import ProcessTable
+from screen_stream import ScreenStream, make_codec, make_source
+from telemetry import Telemetry
+from updater import Updater
 from lazy_socket.server import LazyServer
+from asyncio.subprocess import PIPE
 from pathlib import Path
 from shutil import rmtree
 
 CONFIG_PATH = Path("lazy_egm.cfg")
 VERSION = "1.0.2"
 
+logger = get_logger("LazyEGM")
+
 
 class EGM(LazyServer):
 
+    WATCHED = ("EGMController.exe", "AutoMakro.exe")  # Reported by process_status when no names are asked for
+    READY_AFTER = 5  # Seconds a started process has to show up in the process table
+    READY_POLL = 0.25
+    STOP_TIMEOUT = 10
+    RUN_TIMEOUT = 30
+    BIND_ATTEMPTS = 30  # Seconds an updated agent waits for the one it replaces to free the port
+    RESTART_AFTER = 1  # Seconds to get the reply to update_commit out before closing
+    MAX_TAILS = 8
+    LOG_ROOTS = ("D:/EGMController", "D:/AutoMakro")  # Where tail_log may read, "log_roots" in the config
+    MAX_STREAMS = 2
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.properties = self.load_config()
+        # Settings of the agent itself, the rest of the config describes the machine to the manager
+        telemetry_interval = self.properties.pop("telemetry_interval", 5)
+        storage = self.properties.pop("storage", "E:/")
+        update_key = self.properties.pop("update_key", None)
+        self.log_roots = [Path(root).resolve() for root in self.properties.pop("log_roots", self.LOG_ROOTS)]
         self.properties["lazy_egm_version"] = VERSION
+        self.manager_protocol = 0
+        self.channels: dict[object, Outbox] = {}
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.input = InputWorker()
+        self.processes = ProcessTable()
+        self.telemetry = Telemetry(storage, telemetry_interval)
+        self.tails: dict[tuple, LogTail] = {}
+        self.streams: dict[tuple, ScreenStream] = {}
+        self.updater = Updater(key=update_key)
+
+    async def _start(self):
+        refresher = asyncio.create_task(self.processes.run())
+        reporter = asyncio.create_task(self.report_telemetry())
+        try:
+            for attempt in range(1, self.BIND_ATTEMPTS + 1):
+                try:
+                    await super()._start()
+                    break
+                except OSError as e:
+                    if attempt == self.BIND_ATTEMPTS:
+                        raise
+                    logger.warning(f"Cannot listen on port {self.port} yet: {e}")
+                    await asyncio.sleep(1)
+        finally:
+            refresher.cancel()
+            reporter.cancel()
+
+    async def report_telemetry(self):
+        # Managers that registered get the fields that changed, on the bulk
+        # channel so it never holds up a reply
+        while True:
+            await asyncio.sleep(self.telemetry.interval)
+            self.telemetry.forget(self.clients)
+            if not self.telemetry.sent:
+                continue
+            try:
+                values = await asyncio.to_thread(self.telemetry.sample)
+            except Exception as e:
+                logger.warning(f"Could not sample telemetry: {e}")
+                continue
+            values["processes"] = {name: self.processes.running(name) for name in self.WATCHED}
+            for client in list(self.telemetry.sent):
+                changes = self.telemetry.changes(client, values)
+                if changes:
+                    self.channels_for(client).put(protocol.encode("egm", "telemetry", **changes), channels.BULK)
 
     def load_config(self):
         if CONFIG_PATH.exists():
@@ -27,30 +100,71 @@ class EGM(LazyServer):
             CONFIG_PATH.write_text(json.dumps(content, indent=4))
             return content
 
-    async def send_response(self, client, data, **kwargs):
-        await client.send(
-            json.dumps(dict(sender="egm", command=data["command"], **kwargs))
-        )
+    def channels_for(self, client) -> Outbox:
+        if client not in self.channels:
+            for gone in [other for other in self.channels if other not in self.clients]:
+                self.channels.pop(gone).writer.cancel()
+            self.channels[client] = Outbox(client.send).start()
+        return self.channels[client]
+
+    async def send_response(self, client, data, app_ip=None, **kwargs):
+        if app_ip and data.get("routed"):
+            message = protocol.route(app_ip, protocol.encode("egm", data["command"], **kwargs), cid=data.get("cid"))
+        elif app_ip:
+            message = protocol.encode("egm", data["command"], app_ip=app_ip, **kwargs)
+        else:
+            message = protocol.encode("egm", data["command"], **kwargs)
+        # Replies go back on the channel the request came in on
+        self.channels_for(client).put(message, data.get("channel", channels.CONTROL))
 
     async def process_message(self, client, message):
-        data = json.loads(message)
+        try:
+            received = self.channels_for(client).feed(message)
+        except ProtocolError as e:
+            logger.warning(f"Ignoring invalid message: {e}")
+            return
+        if not received:
+            return  # A fragment or a credit grant
+        channel, message = received
+
+        routed = protocol.split_route(message)
+        if routed:
+            message = routed.payload
+
+        try:
+            data = protocol.decode(message)
+        except ProtocolError as e:
+            logger.warning(f"Ignoring invalid message: {e}")
+            return
+
+        data["channel"] = channel
+        if routed:
+            # Replies to routed requests are routed back the same way, with the request's cid
+            data.update(sender_ip=routed.sender, routed=True, cid=routed.cid)
+
         if data["sender"] == "manager":
             try:
                 await self.run_manager_command(client, data)
             except Exception as e:
-                print(f"Error processing manager command {data['command']}: {e}")
+                logger.error(f"Error processing manager command {data['command']}: {e}")
                 await self.send_response(client, data, result=f"Failure - {e}")
 
         if data["sender"] == "app":
             try:
                 await self.run_app_command(client, data)
             except Exception as e:
-                print(f"Error processing app command {data['command']}: {e}")
-                await self.send_response(client, data, result=f"Failure - {e}")
+                logger.error(f"Error processing app command {data['command']}: {e}")
+                await self.send_response(client, data, result=f"Failure - {e}", app_ip=data.get("sender_ip"))
 
     async def run_manager_command(self, client, data):
         if data["command"] == "register":
-            await self.send_response(client, data, result=self.properties)
+            self.manager_protocol = protocol.negotiate(data.get("protocol"))
+            self.channels_for(client).enabled = self.manager_protocol >= protocol.CHANNELS
+            if self.manager_protocol >= protocol.TELEMETRY:
+                self.telemetry.watch(client)
+            else:
+                self.telemetry.unwatch(client)  # Older managers reject the frames as unknown
+            await self.send_response(client, data, result=self.properties, protocol=protocol.PROTOCOL_VERSION)
 
         if data["command"] == "ping":
             await self.send_response(client, data, result="pong")
@@ -63,62 +177,109 @@ class EGM(LazyServer):
             await self.send_response(client, data, result="Success", app_ip=app_ip)
 
         elif command == "start_explorer":
-            result = "Success" if self._try_start("explorer.exe", poll=False) else "Failure"
+            result = "Success" if await self._try_start("explorer.exe", poll=False) else "Failure"
             await self.send_response(client, data, result=result, app_ip=app_ip)
 
         elif command == "start_task_manager":
-            result = "Success" if self._try_start("taskmgr.exe") else "Failure"
+            result = "Success" if await self._try_start("taskmgr.exe") else "Failure"
             await self.send_response(client, data, result=result, app_ip=app_ip)
 
         elif command == "stop_automakro":
-            result = "Success" if self._try_kill("AutoMakro.exe") else "Failure"
+            result = "Success" if await self._try_kill("AutoMakro.exe") else "Failure"
             await self.send_response(client, data, result=result, app_ip=app_ip)
 
         elif command == "start_automakro":
-            result = "Success" if self._try_start("AutoMakro.exe", cwd="D:/AutoMakro") else "Failure"
+            result = "Success" if await self._try_start("AutoMakro.exe", cwd="D:/AutoMakro") else "Failure"
             await self.send_response(client, data, result=result, app_ip=app_ip)
 
         elif command == "stop_egmc":
-            result = "Success" if self._try_kill("EGMController.exe", force=False) else "Failure"
+            result = "Success" if await self._try_kill("EGMController.exe", force=False) else "Failure"
             await self.send_response(client, data, result=result, app_ip=app_ip)
 
         elif command == "start_egmc":
-            result = "Success" if self._try_start("EGMController.exe", cwd="D:/EGMController") else "Failure"
+            result = "Success" if await self._try_start("EGMController.exe", cwd="D:/EGMController") else "Failure"
             await self.send_response(client, data, result=result, app_ip=app_ip)
 
+        elif command == "process_status":
+            names = data.get("names") or self.WATCHED
+            await self.send_response(client, data, result=self.processes.status(names), app_ip=app_ip)
+
         elif command == "clear_ram":
             try:
-                rmtree("E:/Storage")
+                async with self.lock_for("E:/Storage"):
+                    await asyncio.to_thread(rmtree, "E:/Storage")
                 await self.send_response(client, data, result="Success", app_ip=app_ip)
             except FileNotFoundError:
                 await self.send_response(client, data, result="No files to delete", app_ip=app_ip)
             except Exception as e:
                 await self.send_response(client, data, result=f"Failure - {e}", app_ip=app_ip)
 
+        elif command == "tail_log":
+            tail = await self.tail_log(client, data, app_ip)
+            await self.send_response(client, data, result="Success", offset=tail.offset, app_ip=app_ip)
+
+        elif command == "stop_tail":
+            tail = self.tails.pop((client, app_ip, data["path"]), None)
+            if tail:
+                tail.task.cancel()
+            await self.send_response(client, data, result="Success" if tail else "Not tailing", app_ip=app_ip)
+
+        elif command == "screen_stream":
+            stream = await self.screen_stream(client, data, app_ip)
+            await self.send_response(client, data, result="Success", codec=stream.codec.name, app_ip=app_ip)
+
+        elif command == "screen_ack":
+            stream = self.streams.get((client, app_ip))
+            if stream:
+                stream.ack(data["frame"])
+
+        elif command == "screen_stop":
+            stream = self.streams.pop((client, app_ip), None)
+            if stream:
+                stream.task.cancel()
+            await self.send_response(client, data, result="Success" if stream else "Not streaming", app_ip=app_ip)
+
+        elif command == "update_offer":
+            reply = await self.updater.offer(data["build"], data["size"], data["chunk_size"], data["chunks"],
+                                             data.get("signature"))
+            await self.send_response(client, data, app_ip=app_ip, **reply)
+
+        elif command == "update_chunk":
+            result = await self.updater.receive(data["build"], data["index"], data["data"])
+            await self.send_response(client, data, result=result, app_ip=app_ip)
+
+        elif command == "update_commit":
+            async with self.lock_for("update"):
+                result = await self.updater.install(data["build"])
+            await self.send_response(client, data, result=result, app_ip=app_ip)
+            if result == "Success":
+                self.updater.restart()
+                asyncio.get_running_loop().call_later(self.RESTART_AFTER, self.server.close)
+
         elif command == "f1":
-            pyautogui.press("f1")
+            await self.input.submit("press", "f1")
             await self.send_response(client, data, result="Success", app_ip=app_ip)
 
         elif command == "alt_tab":
-            pyautogui.hotkey("alt", "tab", interval=0.2)
+            await self.input.submit("hotkey", "alt", "tab", interval=0.2)
             await self.send_response(client, data, result="Success", app_ip=app_ip)
 
         elif command == "mouse_move":
             dx = data.get("dx", 0)
             dy = data.get("dy", 0)
-            pyautogui.moveRel(dx, -dy, duration=0.1)
+            await self.input.submit("move", dx, -dy)
             await self.send_response(client, data, result="Success", app_ip=app_ip)
 
         elif command == "left_click":
-            pyautogui.click()
+            await self.input.submit("click", "left")
             await self.send_response(client, data, result="Success", app_ip=app_ip)
 
         elif command == "right_click":
-            pyautogui.click(button="right")
+            await self.input.submit("click", "right")
             await self.send_response(client, data, result="Success", app_ip=app_ip)
 
         elif command == "key_press":
-            pyautogui.press(data["key"])
+            await self.input.submit("press", data["key"])
             await self.send_response(client, data, result="Success", app_ip=app_ip)
 
         elif command == "a":
@@ -136,25 +297,140 @@ class EGM(LazyServer):
         else:
             await self.send_response(client, data, result="Unknown command", app_ip=app_ip)
 
-    def _try_kill(self, process_name, force=True):
-        command = f"taskkill {'/F' if force else ''} /IM {process_name}"
-        print(command)
-        result = subprocess.run(command, capture_output=True, shell=True)
-        return result.returncode == 0 or result.returncode == 128
-
-    def _try_start(self, process_path, cwd=None, poll=True):
-        print(process_path)
-        result = subprocess.Popen(process_path, cwd=cwd, shell=True)
-        if not poll:
-            return True
-        time.sleep(2)
-        return result.poll() is None
-
-    def _try_run(self, command, rc=0):
-        print(command)
-        result = subprocess.run(command, capture_output=True, shell=True)
-        print(result.returncode)
-        return result.returncode == rc
+    async def tail_log(self, client, data, app_ip) -> LogTail:
+        # One tail per app and file, asking again changes its filters and renews its lease
+        key = (client, app_ip, data["path"])
+        tail = self.tails.get(key)
+        if not tail:
+            if len(self.tails) >= self.MAX_TAILS:
+                raise RuntimeError(f"already following {len(self.tails)} logs")
+            frame = {"command": "log_lines", "routed": data.get("routed"), "channel": channels.BULK}
+
+            async def send(lines, offset, skipped):
+                await self.send_response(client, frame, path=data["path"], lines=lines, offset=offset,
+                                         skipped=skipped, app_ip=app_ip)
+
+            tail = LogTail(self.log_path(data["path"]), send, lambda: client in self.clients)
+        tail.configure(data.get("pattern"), data.get("level"), data.get("rate"), data.get("lease"))
+        if key not in self.tails:
+            await asyncio.to_thread(tail.start, data.get("backlog") or 0)
+            self.tails[key] = tail
+            tail.task = asyncio.create_task(self.follow(key, tail))
+        return tail
+
+    def log_path(self, path: str) -> Path:
+        # Links are followed first, so none leads out of the roots. The
+        # agent's own config holds its update key and is never readable.
+        resolved = Path(path).resolve()
+        if resolved == CONFIG_PATH.resolve() or not any(resolved.is_relative_to(root) for root in self.log_roots):
+            raise PermissionError(f"{path} cannot be followed, logs are read from {', '.join(map(str, self.log_roots))}")
+        return resolved
+
+    async def follow(self, key, tail: LogTail):
+        try:
+            await tail.run()
+        except Exception as e:
+            logger.warning(f"Stopped following {tail.path}: {e}")
+        finally:
+            if self.tails.get(key) is tail:
+                del self.tails[key]
+
+    async def screen_stream(self, client, data, app_ip) -> ScreenStream:
+        # One stream per app, asking again renews its lease
+        key = (client, app_ip)
+        stream = self.streams.get(key)
+        if not stream:
+            if len(self.streams) >= self.MAX_STREAMS:
+                raise RuntimeError(f"already streaming to {len(self.streams)} apps")
+            frame = {"command": "screen_frame", "routed": data.get("routed"), "channel": channels.BULK}
+
+            async def send(**fields):
+                await self.send_response(client, frame, app_ip=app_ip, **fields)
+
+            source = make_source()
+            codec = make_codec(data.get("codecs") or ["zlib"])
+            stream = ScreenStream(source, codec, send, lambda: client in self.clients)
+        stream.configure(data.get("max_width"), data.get("lease"))
+        if key not in self.streams:
+            self.streams[key] = stream
+            stream.task = asyncio.create_task(self.stream_screen(key, stream))
+        return stream
+
+    async def stream_screen(self, key, stream: ScreenStream):
+        try:
+            await stream.run()
+        except Exception as e:
+            logger.warning(f"Stopped streaming the screen: {e}")
+        finally:
+            if self.streams.get(key) is stream:
+                del self.streams[key]
+
+    def lock_for(self, name) -> asyncio.Lock:
+        # Commands run concurrently, but the ones touching the same process or
+        # files take its lock first thing, before anything they await. Locks
+        # are fair, so a stop and a start sent back to back run in that order.
+        return self.locks.setdefault(name.lower(), asyncio.Lock())
+
+    async def _try_kill(self, process_name, force=True):
+        async with self.lock_for(process_name):
+            await self.processes.refresh()
+            if not self.processes.running(process_name):
+                logger.info(f"{process_name} is not running")
+                return True
+
+            if force:
+                await asyncio.to_thread(self.processes.kill, process_name)
+            else:
+                await self._run(f"taskkill /IM {process_name}")  # Asks its windows to close
+            if await self.processes.wait_gone(process_name, self.STOP_TIMEOUT):
+                return True
+            logger.warning(f"{process_name} is still running after {self.STOP_TIMEOUT}s")
+            return False
+
+    async def _try_start(self, process_path, cwd=None, poll=True):
+        name = Path(process_path).name
+        async with self.lock_for(name):
+            if poll:
+                await self.processes.refresh()
+                if self.processes.running(name):
+                    logger.info(f"{name} is already running")
+                    return True
+
+            logger.info(f"Starting {process_path}")
+            process = await asyncio.create_subprocess_shell(process_path, cwd=cwd)
+            if not poll:
+                return True
+            return await self.wait_started(name, process)
+
+    async def wait_started(self, name, process) -> bool:
+        # Started once it shows up in the process table, unless the shell
+        # starting it fails first
+        deadline = asyncio.get_running_loop().time() + self.READY_AFTER
+        while asyncio.get_running_loop().time() < deadline:
+            if process.returncode:
+                logger.warning(f"Starting {name} failed with {process.returncode}")
+                return False
+            await self.processes.refresh()
+            if self.processes.running(name):
+                return True
+            await asyncio.sleep(self.READY_POLL)
+        logger.warning(f"{name} did not show up within {self.READY_AFTER}s")
+        return False
+
+    async def _try_run(self, command, rc=0):
+        return await self._run(command) == rc
+
+    async def _run(self, command) -> int | None:
+        process = await asyncio.create_subprocess_shell(command, stdout=PIPE, stderr=PIPE)
+        try:
+            await asyncio.wait_for(process.communicate(), self.RUN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"{command} did not finish in {self.RUN_TIMEOUT}s, killing it")
+            process.kill()
+            await process.wait()
+            return None
+        logger.info(f"{command} returned {process.returncode}")
+        return process.returncode
 
     def get_ip(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -0,0 +1,46 @@
+import protocol
+from channels import Channels, CONTROL, BULK
+from lazy_logging import get_logger
+
+logger = get_logger("Outbox")
+
+
+def merge_telemetry(older: dict, newer: dict) -> dict:
+    return {**older, **newer}  # Both are deltas, the newer value of a field wins
+
+
+# Unrouted bulk frames that are merged into an unsent one of the same command
+MERGERS = {"telemetry": merge_telemetry}
+
+
+class Outbox(Channels):
+
+    # What the agent sends one manager. Each channel queues at most LIMIT
+    # messages, BULK_LIMIT on the bulk channel, which is what piles up
+    # behind a slow link. Telemetry deltas are merged into the one still
+    # waiting; past the limit the oldest other message that has not started
+    # going out is dropped. A dropped screen frame is never acked, so the stream
+    # sends the next one whole.
+    LIMIT = 256
+    BULK_LIMIT = 32
+
+    def put(self, message: str, channel=CONTROL):
+        queue = self.queue(channel)
+        key = None
+        if channel == BULK and message.startswith("{"):
+            key = protocol.peek_command(message)
+            if key in MERGERS:
+                for entry in queue:
+                    if entry[0] == key and entry[2] == 0:
+                        entry[1] = protocol.dumps(MERGERS[key](protocol.loads(entry[1]), protocol.loads(message)))
+                        return
+
+        limit = self.BULK_LIMIT if self.enabled and channel == BULK else self.LIMIT
+        if len(queue) >= limit:
+            # Never a telemetry delta, the manager would miss what it changed
+            unsent = next((index for index, entry in enumerate(queue) if entry[2] == 0 and entry[0] not in MERGERS), None)
+            if unsent is not None:
+                dropped = queue[unsent][1]
+                del queue[unsent]
+                logger.warning(f"Queue {channel} full, dropped {protocol.peek_command(dropped)}")
+        self.put_nowait(message, channel, key)
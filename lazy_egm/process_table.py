@@ -0,0 +1,90 @@
+import asyncio
+import psutil
+from time import monotonic
+from lazy_logging import get_logger
+
+logger = get_logger("Processes")
+
+
+class ProcessTable:
+
+    # Running processes by name, so questions about them never spawn a
+    # shell. A refresh lists the PIDs and only reads the name of the ones
+    # that are new, on a worker thread; the result replaces the tables in
+    # one assignment, so readers on the event loop never see half of it.
+    REFRESH = 2.0
+
+    def __init__(self):
+        self.names: dict[int, str] = {}
+        self.pids: dict[str, tuple[int, ...]] = {}
+        self.refreshed = 0.0
+        self.lock = asyncio.Lock()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning(f"Could not refresh the process table: {e}")
+            await asyncio.sleep(self.REFRESH)
+
+    async def refresh(self):
+        async with self.lock:  # One scan at a time, a caller that waited gets the fresh result
+            self.names, self.pids = await asyncio.to_thread(self.scan)
+            self.refreshed = monotonic()
+
+    def scan(self) -> tuple[dict, dict]:
+        current = psutil.pids()
+        names = {}
+        for pid in current:
+            name = self.names.get(pid)
+            if name is None:
+                try:
+                    name = psutil.Process(pid).name().lower()
+                except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                    continue
+            names[pid] = name
+
+        pids = {}
+        for pid, name in names.items():
+            pids.setdefault(name, []).append(pid)
+        return names, {name: tuple(found) for name, found in pids.items()}
+
+    def find(self, name: str) -> tuple[int, ...]:
+        return self.pids.get(name.lower(), ())
+
+    def running(self, name: str) -> bool:
+        return name.lower() in self.pids
+
+    def status(self, names) -> dict:
+        age = round(monotonic() - self.refreshed, 1)
+        return {name: {"running": self.running(name), "pids": list(self.find(name)), "age": age} for name in names}
+
+    def processes(self, name: str) -> list[psutil.Process]:
+        # The cached PIDs that still belong to name, a PID may have been
+        # reused since the last refresh. Blocking, for worker threads.
+        found = []
+        for pid in self.find(name):
+            try:
+                process = psutil.Process(pid)
+                if process.name().lower() == name.lower():
+                    found.append(process)
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                pass
+        return found
+
+    def kill(self, name: str):
+        for process in self.processes(name):
+            try:
+                process.kill()
+            except psutil.NoSuchProcess:
+                pass
+
+    def wait(self, name: str, timeout: float) -> bool:
+        _, alive = psutil.wait_procs(self.processes(name), timeout)
+        return not alive
+
+    async def wait_gone(self, name: str, timeout: float) -> bool:
+        gone = await asyncio.to_thread(self.wait, name, timeout)
+        await self.refresh()
+        return gone and not self.running(name)
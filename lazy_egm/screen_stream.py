@@ -0,0 +1,260 @@
+import os
+import zlib
+import asyncio
+from base64 import b64encode
+from io import BytesIO
+from time import monotonic
+from lazy_logging import get_logger
+
+logger = get_logger("Screen")
+
+
+class PyAutoGuiSource:
+
+    # The desktop the agent runs in, pyautogui is imported here like in
+    # input_worker so the agent starts where there is no desktop
+    def __init__(self):
+        import pyautogui
+        self.gui = pyautogui
+
+    def grab(self) -> tuple[int, int, bytes]:
+        image = self.gui.screenshot().convert("RGB")
+        return image.width, image.height, image.tobytes()
+
+
+class SyntheticSource:
+
+    # A still background with a square moving across it, for tests and
+    # machines without a desktop
+    SQUARE = 40
+
+    def __init__(self, width=640, height=360):
+        self.width = width
+        self.height = height
+        self.background = bytes((x * 255 // width) for _ in range(height) for x in range(width) for _ in range(3))
+        self.grabs = 0
+
+    def grab(self) -> tuple[int, int, bytes]:
+        frame = bytearray(self.background)
+        left = (self.grabs * 8) % (self.width - self.SQUARE)
+        top = (self.grabs * 4) % (self.height - self.SQUARE)
+        for y in range(top, top + self.SQUARE):
+            start = (y * self.width + left) * 3
+            frame[start:start + self.SQUARE * 3] = b"\xff" * (self.SQUARE * 3)
+        self.grabs += 1
+        return self.width, self.height, bytes(frame)
+
+
+SOURCES = {"pyautogui": PyAutoGuiSource, "synthetic": SyntheticSource}
+
+
+def make_source():
+    return SOURCES[os.environ.get("LAZY_SCREEN_SOURCE", "pyautogui")]()
+
+
+class ZlibCodec:
+
+    # Lossless at full quality, below that the low bits of every channel are
+    # dropped first, which compresses a lot better
+    name = "zlib"
+
+    def __init__(self):
+        self.tables = {}
+
+    def encode(self, pixels: bytes, width: int, height: int, quality: int) -> bytes:
+        drop = 0 if quality >= 90 else 1 if quality >= 70 else 2 if quality >= 50 else 3 if quality >= 30 else 4
+        if drop:
+            table = self.tables.get(drop)
+            if table is None:
+                table = self.tables[drop] = bytes(value >> drop << drop for value in range(256))
+            pixels = pixels.translate(table)
+        return zlib.compress(pixels, 1)
+
+
+class JpegCodec:
+
+    name = "jpeg"
+
+    def __init__(self):
+        from PIL import Image  # Installed with pyautogui, which needs it for screenshots
+        self.image = Image
+
+    def encode(self, pixels: bytes, width: int, height: int, quality: int) -> bytes:
+        buffer = BytesIO()
+        self.image.frombytes("RGB", (width, height), pixels).save(buffer, "JPEG", quality=quality)
+        return buffer.getvalue()
+
+
+CODECS = {"jpeg": JpegCodec, "zlib": ZlibCodec}
+
+
+def make_codec(accepted: list[str]):
+    # The first codec the app accepts that works here
+    for name in accepted:
+        try:
+            return CODECS[name]()
+        except (KeyError, ImportError):
+            continue
+    raise ValueError(f"none of the codecs {', '.join(accepted)} is available")
+
+
+def downscale(pixels: bytes, width: int, height: int, factor: int) -> tuple[int, int, bytes]:
+    # Keeps every factor-th pixel of every factor-th row
+    if factor == 1:
+        return width, height, pixels
+    stride = width * 3
+    scaled_width = (width + factor - 1) // factor
+    scaled_height = (height + factor - 1) // factor
+    row = scaled_width * 3
+    scaled = bytearray(row * scaled_height)
+    for y in range(scaled_height):
+        line = pixels[y * factor * stride:(y * factor + 1) * stride]
+        for channel in range(3):
+            scaled[y * row + channel:(y + 1) * row:3] = line[channel::3 * factor]
+    return scaled_width, scaled_height, bytes(scaled)
+
+
+def changed_tiles(previous: bytes | None, pixels: bytes, width: int, height: int, size: int) -> list[tuple]:
+    # (x, y, width, height) of the tiles that differ. Whole bands of rows are
+    # compared first, a still screen costs a few comparisons.
+    stride = width * 3
+    if previous is None or len(previous) != len(pixels):
+        return [(x, y, min(size, width - x), min(size, height - y))
+                for y in range(0, height, size) for x in range(0, width, size)]
+
+    tiles = []
+    for top in range(0, height, size):
+        bottom = min(top + size, height)
+        if previous[top * stride:bottom * stride] == pixels[top * stride:bottom * stride]:
+            continue
+        columns = set()
+        for y in range(top, bottom):
+            start = y * stride
+            if previous[start:start + stride] == pixels[start:start + stride]:
+                continue
+            for left in range(0, width, size):
+                if left not in columns:
+                    a, b = start + left * 3, start + min(left + size, width) * 3
+                    if previous[a:b] != pixels[a:b]:
+                        columns.add(left)
+        tiles += [(left, top, min(size, width - left), bottom - top) for left in sorted(columns)]
+    return tiles
+
+
+def cut(pixels: bytes, width: int, x: int, y: int, w: int, h: int) -> bytes:
+    return b"".join(pixels[((row * width) + x) * 3:((row * width) + x + w) * 3] for row in range(y, y + h))
+
+
+class ScreenStream:
+
+    # Streams the screen to one app as tiles that changed since the previous
+    # frame, downscaled to the width the app shows it at. At most
+    # MAX_UNACKED frames are on their way; each ack measures how long a frame
+    # took to show up. Frames slower than TARGET_LATENCY cut the frame rate
+    # and quality, faster ones raise them again, and the frame rate never
+    # exceeds what the measured throughput carries. A frame that is not
+    # acked within ACK_TIMEOUT may be lost, the next one is sent whole.
+    TILE = 64
+    MIN_FPS = 1
+    MAX_FPS = 15
+    MIN_QUALITY = 20
+    MAX_QUALITY = 90
+    TARGET_LATENCY = 0.2
+    MAX_UNACKED = 2
+    ACK_TIMEOUT = 2
+    LEASE = 60
+    MAX_LEASE = 600
+
+    def __init__(self, source, codec, send, alive):
+        self.source = source
+        self.codec = codec
+        self.send = send  # async (**frame)
+        self.alive = alive
+        self.frame = 0
+        self.previous = None
+        self.max_width = None
+        self.full = True
+        self.fps = 5.0
+        self.quality = 70
+        self.unacked: dict[int, tuple[float, int]] = {}  # frame -> (sent, characters)
+        self.acked = asyncio.Event()
+        self.throughput = None  # Characters per second, averaged over acks
+        self.frame_size = None
+        self.task = None
+
+    def configure(self, max_width: int = None, lease: float = None):
+        if max_width != self.max_width:
+            self.full = True  # The app redraws from scratch at another size
+        self.max_width = max_width
+        self.expires = monotonic() + max(1, min(lease or self.LEASE, self.MAX_LEASE))
+
+    async def run(self):
+        while monotonic() < self.expires and self.alive():
+            started = monotonic()
+            for frame, (sent, _) in list(self.unacked.items()):
+                if started - sent > self.ACK_TIMEOUT:
+                    logger.debug("Frame %s was not acked, sending the next one whole", frame)
+                    del self.unacked[frame]
+                    self.slow_down()
+                    self.full = True
+            if len(self.unacked) >= self.MAX_UNACKED:
+                self.acked.clear()
+                try:
+                    await asyncio.wait_for(self.acked.wait(), self.ACK_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            frame = await asyncio.to_thread(self.capture)
+            if frame:
+                size = sum(len(tile[4]) for tile in frame["tiles"])
+                self.unacked[frame["frame"]] = (monotonic(), size)
+                self.frame_size = size if self.frame_size is None else 0.8 * self.frame_size + 0.2 * size
+                await self.send(**frame)
+
+            interval = 1 / self.fps
+            if self.throughput and self.frame_size:
+                interval = max(interval, self.frame_size / self.throughput)
+            await asyncio.sleep(max(0.0, interval - (monotonic() - started)))
+
+    def capture(self) -> dict | None:
+        # Blocking, for a worker thread
+        width, height, pixels = self.source.grab()
+        factor = -(-width // self.max_width) if self.max_width else 1
+        width, height, pixels = downscale(pixels, width, height, max(1, factor))
+        full, self.full = self.full, False
+        tiles = changed_tiles(None if full else self.previous, pixels, width, height, self.TILE)
+        self.previous = pixels
+        if not tiles:
+            return None
+
+        self.frame += 1
+        encoded = [
+            [x, y, w, h, b64encode(self.codec.encode(cut(pixels, width, x, y, w, h), w, h, self.quality)).decode()]
+            for x, y, w, h in tiles
+        ]
+        return {"frame": self.frame, "width": width, "height": height, "codec": self.codec.name,
+                "tiles": encoded, "full": full}
+
+    def ack(self, frame: int):
+        # Frames arrive in order, an ack covers the ones before it too
+        sent = self.unacked.pop(frame, None)
+        for earlier in [earlier for earlier in self.unacked if earlier < frame]:
+            del self.unacked[earlier]
+        self.acked.set()
+        if not sent:
+            return
+
+        latency = max(monotonic() - sent[0], 0.001)
+        rate = sent[1] / latency
+        self.throughput = rate if self.throughput is None else 0.8 * self.throughput + 0.2 * rate
+        if latency > self.TARGET_LATENCY:
+            self.slow_down()
+        else:
+            self.fps = min(self.MAX_FPS, self.fps + 0.5)
+            if latency < self.TARGET_LATENCY / 2:
+                self.quality = min(self.MAX_QUALITY, self.quality + 5)
+
+    def slow_down(self):
+        self.fps = max(self.MIN_FPS, self.fps * 0.7)
+        self.quality = max(self.MIN_QUALITY, self.quality - 10)
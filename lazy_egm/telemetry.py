@@ -0,0 +1,62 @@
+import psutil
+from time import time, monotonic
+from lazy_logging import get_logger
+
+logger = get_logger("Telemetry")
+
+
+class Telemetry:
+
+    # Samples the machine's health every interval. What each manager was
+    # last sent is kept, and a sample only goes out as the fields that
+    # moved past their threshold since, so an idle machine sends next to
+    # nothing. Uptime grows by itself, it is compared as the boot time it
+    # implies. Fields without a threshold are sent whenever they change.
+    THRESHOLDS = {"cpu": 10, "memory": 2, "disk": 1, "uptime": 60}
+
+    def __init__(self, storage: str, interval: float = 5):
+        self.storage = storage
+        self.interval = interval
+        self.sent: dict[object, dict] = {}
+        psutil.cpu_percent()  # The first reading only starts the measurement
+
+    def watch(self, client):
+        # A manager that (re)registers gets every field in the next frame
+        self.sent[client] = {}
+
+    def unwatch(self, client):
+        self.sent.pop(client, None)
+
+    def forget(self, clients):
+        for client in [client for client in self.sent if client not in clients]:
+            del self.sent[client]
+
+    def sample(self) -> dict:
+        # Blocking, for a worker thread. CPU is the average since the previous sample.
+        values = {
+            "cpu": round(psutil.cpu_percent()),
+            "memory": round(psutil.virtual_memory().percent),
+            "uptime": round(time() - psutil.boot_time()),
+        }
+        try:
+            values["disk"] = round(psutil.disk_usage(self.storage).percent)
+        except OSError as e:
+            logger.debug("No disk usage for %s: %s", self.storage, e)
+            values["disk"] = None
+        return values
+
+    def changes(self, client, values: dict) -> dict:
+        sent = self.sent.setdefault(client, {})
+        changed = {}
+        for field, value in values.items():
+            compared = value - monotonic() if field == "uptime" else value
+            if field not in sent or self.moved(field, sent[field], compared):
+                sent[field] = compared
+                changed[field] = value
+        return changed
+
+    def moved(self, field: str, last, value) -> bool:
+        threshold = self.THRESHOLDS.get(field)
+        if threshold is None or last is None or value is None:
+            return value != last
+        return abs(value - last) >= threshold
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The agent's modules import each other by name, as when it runs from its directory
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+from input_worker import InputWorker, RecordingBackend
+
+
+class GatedBackend(RecordingBackend):
+
+    # Holds the first injection until released, so what is submitted
+    # meanwhile queues up behind it
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def press(self, key):
+        self.started.set()
+        self.release.wait(5)
+        super().press(key)
+
+    def click(self, button):
+        if button == "broken":
+            raise RuntimeError("no such button")
+        super().click(button)
+
+
+async def queue_behind_press(worker: InputWorker, backend: GatedBackend, *events) -> list:
+    futures = [worker.submit("press", "f1")]
+    await asyncio.to_thread(backend.started.wait, 5)
+    futures += [worker.submit(action, *args) for action, *args in events]
+    backend.release.set()
+    return await asyncio.wait_for(asyncio.gather(*futures, return_exceptions=True), 5)
+
+
+def test_moves_queued_together_are_merged():
+    backend = GatedBackend()
+    worker = InputWorker(backend)
+    results = asyncio.run(queue_behind_press(worker, backend, ("move", 1, 2), ("move", 3, 4), ("move", -1, 0)))
+
+    assert results == [None] * 4
+    assert backend.events == [("press", "f1"), ("move", 3, 6, InputWorker.MOVE_DURATION)]
+
+
+def test_other_events_are_barriers():
+    backend = GatedBackend()
+    worker = InputWorker(backend)
+    asyncio.run(queue_behind_press(worker, backend, ("move", 1, 1), ("move", 1, 1), ("click", "left"), ("move", 5, 5)))
+
+    # The click lands where the first two moves left the pointer; a move with
+    # something queued behind it jumps instead of gliding
+    assert backend.events == [("press", "f1"), ("move", 2, 2, 0), ("click", "left"),
+                              ("move", 5, 5, InputWorker.MOVE_DURATION)]
+
+
+def test_backend_errors_reach_the_submitter():
+    backend = GatedBackend()
+    worker = InputWorker(backend)
+    results = asyncio.run(queue_behind_press(worker, backend, ("click", "broken"), ("click", "left")))
+
+    assert isinstance(results[1], RuntimeError)
+    assert results[2] is None
+    assert backend.events[-1] == ("click", "left")
@@ -0,0 +1,78 @@
+import zlib
+import pytest
+from base64 import b64decode
+from screen_stream import ScreenStream, SyntheticSource, ZlibCodec, changed_tiles, downscale
+
+
+class StillSource(SyntheticSource):
+
+    # The square never moves
+    def grab(self):
+        self.grabs = 0
+        return super().grab()
+
+
+def stream(source, max_width=None) -> ScreenStream:
+    screen = ScreenStream(source, ZlibCodec(), None, lambda: True)
+    screen.configure(max_width)
+    screen.quality = ScreenStream.MAX_QUALITY  # Lossless with zlib
+    return screen
+
+
+def draw(canvas: bytearray, frame: dict):
+    width = frame["width"]
+    for x, y, w, h, encoded in frame["tiles"]:
+        pixels = zlib.decompress(b64decode(encoded))
+        for row in range(h):
+            start = ((y + row) * width + x) * 3
+            canvas[start:start + w * 3] = pixels[row * w * 3:(row + 1) * w * 3]
+
+
+@pytest.mark.parametrize("max_width", [None, 320, 213])
+def test_tiles_rebuild_every_frame(max_width):
+    screen = stream(SyntheticSource(), max_width)
+    canvas = None
+    for _ in range(40):
+        frame = screen.capture()
+        if canvas is None:
+            assert frame["full"]
+            canvas = bytearray(frame["width"] * frame["height"] * 3)
+        else:
+            assert not frame["full"]
+        draw(canvas, frame)
+        assert bytes(canvas) == screen.previous
+    assert frame["width"] <= (max_width or 640)
+
+
+def test_only_changed_tiles_are_sent():
+    screen = stream(SyntheticSource())
+    assert len(screen.capture()["tiles"]) == 10 * 6  # 640x360 in 64px tiles
+
+    # A 40px square moving by (8, 4) touches at most four tiles
+    assert 1 <= len(screen.capture()["tiles"]) <= 4
+
+
+def test_still_screen_sends_nothing():
+    screen = stream(StillSource())
+    assert screen.capture()["full"]
+    assert screen.capture() is None
+
+
+def test_new_width_starts_with_a_whole_frame():
+    screen = stream(SyntheticSource(), 640)
+    screen.capture()
+    screen.configure(320)
+    frame = screen.capture()
+    assert frame["full"] and frame["width"] == 320 and len(frame["tiles"]) == 5 * 3
+
+
+def test_downscale_keeps_every_nth_pixel():
+    pixels = bytes(value % 256 for value in range(5 * 3 * 3))  # 5x3
+    assert downscale(pixels, 5, 3, 2) == (3, 2, pixels[0:3] + pixels[6:9] + pixels[12:15] + pixels[30:33] + pixels[36:39] + pixels[42:45])
+
+
+def test_changed_tiles_clips_at_the_edges():
+    before = bytes(70 * 70 * 3)
+    after = bytearray(before)
+    after[-3:] = b"\xff\xff\xff"
+    assert changed_tiles(before, bytes(after), 70, 70, 64) == [(64, 64, 6, 6)]
@@ -0,0 +1,98 @@
+import random
+import asyncio
+import hashlib
+import pytest
+from base64 import b64encode
+from updater import Updater, signature
+
+KEY = "fleet key"
+CHUNK_SIZE = 1024
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class Build:
+
+    # A dummy payload split the way the manager splits builds
+    def __init__(self, data: bytes):
+        self.data = data
+        self.parts = [data[index:index + CHUNK_SIZE] for index in range(0, len(data), CHUNK_SIZE)]
+        self.sha256 = sha256(data)
+        self.manifest = {"build": self.sha256, "size": len(data), "chunk_size": CHUNK_SIZE,
+                         "chunks": [sha256(part) for part in self.parts]}
+
+    def offer(self, updater: Updater, key=KEY) -> dict:
+        return asyncio.run(updater.offer(**self.manifest, signed=signature(key, self.sha256, len(self.data))))
+
+    def send(self, updater: Updater, index: int) -> str:
+        return asyncio.run(updater.receive(self.sha256, index, b64encode(self.parts[index]).decode()))
+
+
+@pytest.fixture
+def target(tmp_path):
+    target = tmp_path / "LazyEGM.exe"
+    target.write_bytes(b"installed build")
+    return target
+
+
+def test_interrupted_update_resumes_and_installs(target):
+    build = Build(random.Random(1).randbytes(5000))
+
+    assert build.offer(Updater(target, KEY)) == {"result": "Ready", "have": []}
+    updater = Updater(target, KEY)
+    build.offer(updater)
+    assert [build.send(updater, index) for index in (0, 2)] == ["Success", "Success"]
+
+    # A restarted agent finds the chunks that made it
+    updater = Updater(target, KEY)
+    assert build.offer(updater) == {"result": "Ready", "have": [0, 2]}
+    assert asyncio.run(updater.install(build.sha256)) == f"Failure - {len(build.parts) - 2} chunks missing"
+    for index in range(len(build.parts)):
+        if index not in (0, 2):
+            build.send(updater, index)
+
+    assert asyncio.run(updater.install(build.sha256)) == "Success"
+    assert target.read_bytes() == build.data
+    assert target.with_name("LazyEGM.old.exe").read_bytes() == b"installed build"
+    assert build.offer(updater) == {"result": "Current"}
+
+
+def test_chunks_not_matching_their_hash_are_rejected(target):
+    build = Build(b"x" * 3000)
+    updater = Updater(target, KEY)
+    build.offer(updater)
+
+    with pytest.raises(ValueError, match="chunk hash mismatch"):
+        asyncio.run(updater.receive(build.sha256, 1, b64encode(b"y" * CHUNK_SIZE).decode()))
+    assert build.offer(updater)["have"] == []
+
+
+def test_builds_not_matching_their_hash_are_not_installed(target):
+    build = Build(b"a" * 1000 + b"b" * 1000)
+    updater = Updater(target, KEY)
+    forged = {**build.manifest, "build": sha256(b"something else")}
+    asyncio.run(updater.offer(**forged, signed=signature(KEY, forged["build"], forged["size"])))
+    for index in range(len(build.parts)):
+        asyncio.run(updater.receive(forged["build"], index, b64encode(build.parts[index]).decode()))
+
+    with pytest.raises(ValueError, match="build hash mismatch"):
+        asyncio.run(updater.install(forged["build"]))
+    assert target.read_bytes() == b"installed build"
+
+
+@pytest.mark.parametrize("key, manifest, result", [
+    (None, {}, "Failure - updates are not enabled on this agent"),
+    (KEY, {"signed": "0" * 64}, "Failure - the build is not signed by the manager"),
+    (KEY, {"chunks": ["../../LazyEGM.old.exe"]}, "Failure - malformed build or chunk name"),
+    (KEY, {"size": 5000}, "Failure - 2 chunks do not make 5000 bytes in chunks of 1024"),
+])
+def test_bad_offers_are_refused(target, key, manifest, result):
+    build = Build(b"z" * 2000)
+    offer = {**build.manifest, "signed": signature(KEY, build.sha256, 2000), **manifest}
+    if "size" in manifest:
+        offer["signed"] = signature(KEY, build.sha256, manifest["size"])
+
+    assert asyncio.run(Updater(target, key).offer(**offer)) == {"result": result}
+    assert asyncio.run(Updater(target, key).receive(build.sha256, 0, "")) == "Failure - build was not offered"
@@ -0,0 +1,159 @@
+import os
+import re
+import sys
+import asyncio
+import hmac
+import hashlib
+import subprocess
+from base64 import b64decode
+from pathlib import Path
+from lazy_logging import get_logger
+
+logger = get_logger("Updater")
+
+DIGEST = re.compile(r"[0-9a-f]{64}")  # Builds and chunks are named by their sha256, and stored under that name
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def signature(key: str, build: str, size: int) -> str:
+    # What the manager signs an offer with, see fleet_update.signature
+    return hmac.new(key.encode(), f"{build}:{size}".encode(), hashlib.sha256).hexdigest()
+
+
+def install_target() -> Path:
+    # The running exe when frozen. From source there is nothing to replace,
+    # LAZY_UPDATE_TARGET names a file to install to instead, e.g. for tests.
+    if getattr(sys, "frozen", False):
+        return Path(sys.executable)
+    return Path(os.environ.get("LAZY_UPDATE_TARGET", "LazyEGM.exe")).resolve()
+
+
+class Updater:
+
+    # Builds arrive as chunks named by their sha256 and are kept in a chunk
+    # store next to the exe. An offer is answered with the chunks already
+    # there, so an update cut off by a disconnect, or one that shares
+    # chunks with the installed build, only sends what is missing. Install
+    # checks the whole build against its hash before swapping it in; the
+    # previous exe stays next to it as .old for a manual rollback. Only
+    # offers signed with the key shared with the manager are taken, so only
+    # a build the manager vouches for is ever installed. Without a key
+    # updates are off.
+    def __init__(self, target: Path = None, key: str = None):
+        self.target = target or install_target()
+        self.key = key
+        self.store = self.target.parent / "updates" / "chunks"
+        self.offers: dict[str, dict] = {}
+        self.installed: str | None = None
+
+    async def offer(self, build: str, size: int, chunk_size: int, chunks: list[str], signed: str = None) -> dict:
+        if not self.key:
+            return {"result": "Failure - updates are not enabled on this agent"}
+        if not signed or not hmac.compare_digest(signed, signature(self.key, build, size)):
+            return {"result": "Failure - the build is not signed by the manager"}
+        problem = self.check(build, size, chunk_size, chunks)
+        if problem:
+            return {"result": f"Failure - {problem}"}
+        if build == await self.current():
+            return {"result": "Current"}
+        self.offers[build] = {"size": size, "chunk_size": chunk_size, "chunks": chunks}
+        have = await asyncio.to_thread(self.stored, chunks)
+        logger.info(f"Offered build {build[:12]}, {len(have)} of {len(chunks)} chunks already here")
+        return {"result": "Ready", "have": have}
+
+    @staticmethod
+    def check(build: str, size: int, chunk_size: int, chunks: list[str]) -> str | None:
+        # What is wrong with a manifest, chunk names end up in paths
+        if not all(isinstance(name, str) and DIGEST.fullmatch(name) for name in (build, *chunks)):
+            return "malformed build or chunk name"
+        if size < 0 or chunk_size <= 0 or len(chunks) != (size + chunk_size - 1) // chunk_size:
+            return f"{len(chunks)} chunks do not make {size} bytes in chunks of {chunk_size}"
+        return None
+
+    async def current(self) -> str | None:
+        if self.installed is None and self.target.exists():
+            self.installed = await asyncio.to_thread(lambda: sha256(self.target.read_bytes()))
+        return self.installed
+
+    def stored(self, chunks: list[str]) -> list[int]:
+        return [index for index, chunk in enumerate(chunks) if (self.store / chunk).exists()]
+
+    async def receive(self, build: str, index: int, data: str) -> str:
+        offer = self.offers.get(build)
+        if not offer:
+            return "Failure - build was not offered"
+        if not 0 <= index < len(offer["chunks"]):
+            return f"Failure - no chunk {index}"
+        await asyncio.to_thread(self.write_chunk, offer["chunks"][index], b64decode(data))
+        return "Success"
+
+    def write_chunk(self, chunk: str, data: bytes):
+        if sha256(data) != chunk:
+            raise ValueError("chunk hash mismatch")
+        self.store.mkdir(parents=True, exist_ok=True)
+        partial = self.store / f"{chunk}.part"
+        partial.write_bytes(data)
+        os.replace(partial, self.store / chunk)
+
+    async def install(self, build: str) -> str:
+        offer = self.offers.get(build)
+        if not offer:
+            return "Failure - build was not offered"
+        missing = len(offer["chunks"]) - len(await asyncio.to_thread(self.stored, offer["chunks"]))
+        if missing:
+            return f"Failure - {missing} chunks missing"
+        await asyncio.to_thread(self.swap, build, offer)
+        self.installed = build
+        self.offers.clear()
+        return "Success"
+
+    def swap(self, build: str, offer: dict):
+        new = self.target.with_name(f"{self.target.stem}.new{self.target.suffix}")
+        old = self.target.with_name(f"{self.target.stem}.old{self.target.suffix}")
+        digest = hashlib.sha256()
+        with open(new, "wb") as file:
+            for chunk in offer["chunks"]:
+                data = (self.store / chunk).read_bytes()
+                digest.update(data)
+                file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        if digest.hexdigest() != build or new.stat().st_size != offer["size"]:
+            new.unlink()
+            raise ValueError("build hash mismatch")
+
+        # A running exe cannot be overwritten on Windows, but it can be renamed
+        if self.target.exists():
+            os.replace(self.target, old)
+        try:
+            os.replace(new, self.target)
+        except OSError:
+            os.replace(old, self.target)
+            raise
+        logger.info(f"Installed build {build[:12]} to {self.target}")
+
+        # Keep only this build's chunks, the next update is likely to share some
+        keep = set(offer["chunks"])
+        for path in self.store.iterdir():
+            if path.name not in keep:
+                path.unlink(missing_ok=True)
+
+    def restart(self):
+        # Starts the installed build right away, it waits for this process to
+        # let go of the port
+        if getattr(sys, "frozen", False):
+            command = [str(self.target), *sys.argv[1:]]
+        else:
+            command = [sys.executable, *sys.argv]
+        # A onefile exe started from another one would otherwise reuse the
+        # parent's extracted modules, which go away when the parent exits
+        env = {**os.environ, "PYINSTALLER_RESET_ENVIRONMENT": "1"}
+        if os.name == "nt":
+            flags = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+            subprocess.Popen(command, env=env, creationflags=flags, close_fds=True)
+        else:
+            subprocess.Popen(command, env=env, start_new_session=True, close_fds=True)
+        logger.info(f"Restarting as {' '.join(command)}")
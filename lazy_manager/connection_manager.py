@@ -1,48 +1,163 @@
 import asyncio
+import random
+import ipaddress
+import metrics
+import protocol
 import websockets
+from channels import CONTROL
+from enum import Enum
+from time import monotonic
 from lazy_logging import get_logger
-from zeroconf import ServiceListener, ServiceBrowser, Zeroconf
+from outbox import Outbox, Overflow
+from protocol import ProtocolError
+from zeroconf import IPVersion, ServiceStateChange
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
+
+
+# Accepts single IPs, CIDR blocks ("10.0.0.0/24") and ranges ("10.0.0.2-10.0.0.27")
+def parse_ips(specs, exclude=()) -> list[str]:
+    excluded = set(exclude)
+    ips = {}
+    for spec in specs:
+        spec = spec.strip()
+        if "/" in spec:
+            addresses = ipaddress.ip_network(spec, strict=False).hosts()
+        elif "-" in spec:
+            first, last = (int(ipaddress.ip_address(part.strip())) for part in spec.split("-", 1))
+            addresses = (ipaddress.ip_address(i) for i in range(first, last + 1))
+        else:
+            addresses = [ipaddress.ip_address(spec)]
 
+        for address in addresses:
+            ip = str(address)
+            if ip not in excluded:
+                ips[ip] = None
+    return list(ips)
 
-class AppListener(ServiceListener):
-    def __init__(self):
-        self.ips = []
-        self.logger = get_logger("AppListener")
 
-    def on_service_found(self, ip):
-        pass
+class Backoff:
+
+    def __init__(self, base=0.5, cap=60.0, factor=2.0):
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempts = 0
+
+    def next(self) -> float:
+        delay = min(self.cap, self.base * self.factor ** self.attempts)
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.attempts = 0
+
+
+AGENTS_CONNECTED = metrics.Gauge("lazy_agents_connected", "Agents with an open connection")
+APPS_CONNECTED = metrics.Gauge("lazy_apps_connected", "Apps with an open connection")
 
-    def add_service(self, zeroconf, type, name):
-        self.logger.info(f"Service added: {name}")
-        info = zeroconf.get_service_info(type, name)
-        if info:
-            ip = ".".join(map(str, info.addresses[0]))
-            self.logger.info(f"Discovered service: {name} at {ip}")
-            if ip not in self.ips:
-                self.ips.append(ip)
-                self.on_service_found(ip)
-            else:
-                self.logger.debug(f"Service {name} at {ip} already known")
 
-    def remove_service(self, zc, type_, name):
-        self.logger.info(f"Service removed: {name}")
+class AgentState(Enum):
+    IDLE = "idle"
+    CONNECTING = "connecting"
+    OPEN = "open"
+    BACKOFF = "backoff"
 
-    def update_service(self, zc, type_, name):
-        self.logger.debug(f"Service updated: {name}")
-        self.add_service(zc, type_, name)
+
+class AppListener:
+
+    # Browses for apps on the event loop. Resolved addresses are cached for
+    # CACHE_TTL so repeated announcements do not query the network again,
+    # but an Updated event may carry a new address and always resolves
+    # afresh. A service may announce several addresses; it is connected on
+    # the first one and only moved when that address goes away.
+    CACHE_TTL = 30
+    RESOLVE_TIMEOUT = 3
+
+    def __init__(self, zeroconf: AsyncZeroconf, events: asyncio.Queue):
+        self.zeroconf = zeroconf
+        self.events = events
+        self.services: dict[str, str] = {}
+        self.cache: dict[str, tuple[float, list[str]]] = {}
+        self.resolving: dict[str, asyncio.Task] = {}
+        self.outdated: set[str] = set()  # Updated while being resolved
+        self.logger = get_logger("AppListener")
+
+    def on_change(self, zeroconf, service_type: str, name: str, state_change: ServiceStateChange):
+        if state_change is ServiceStateChange.Removed:
+            self.logger.info(f"Service removed: {name}")
+            task = self.resolving.pop(name, None)
+            if task:
+                task.cancel()
+            self.outdated.discard(name)
+            self.cache.pop(name, None)
+            ip = self.services.pop(name, None)
+            if ip:
+                self.events.put_nowait(("remove", ip))
+            return
+
+        self.logger.debug(f"Service {state_change.name.lower()}: {name}")
+        if state_change is ServiceStateChange.Updated:
+            self.cache.pop(name, None)
+            if name in self.resolving:
+                self.outdated.add(name)
+        if name not in self.resolving:
+            self.resolving[name] = asyncio.create_task(self.resolve(service_type, name))
+
+    async def resolve(self, service_type: str, name: str):
+        try:
+            addresses = await self.addresses(service_type, name)
+        except Exception as e:
+            self.logger.warning(f"Could not resolve {name}: {e}")
+            return
+        finally:
+            self.resolving.pop(name, None)
+            if name in self.outdated:
+                self.outdated.discard(name)
+                self.cache.pop(name, None)  # What this resolve cached may predate the update
+                self.resolving[name] = asyncio.create_task(self.resolve(service_type, name))
+
+        current = self.services.get(name)
+        if not addresses or current in addresses:
+            return
+
+        ip = addresses[0]
+        self.logger.info(f"Discovered service: {name} at {ip}" + (f" (also {', '.join(addresses[1:])})" if len(addresses) > 1 else ""))
+        if current:
+            self.events.put_nowait(("remove", current))
+        self.services[name] = ip
+        self.events.put_nowait(("add", ip))
+
+    async def addresses(self, service_type: str, name: str) -> list[str]:
+        cached = self.cache.get(name)
+        if cached and cached[0] > monotonic():
+            return cached[1]
+
+        info = AsyncServiceInfo(service_type, name)
+        if not await info.async_request(self.zeroconf.zeroconf, self.RESOLVE_TIMEOUT * 1000):
+            return []
+        addresses = info.parsed_addresses(IPVersion.V4Only)  # App URLs are built as ws://<ip>:<port>
+        self.cache[name] = (monotonic() + self.CACHE_TTL, addresses)
+        return addresses
 
 
 class Agent:
 
-    def __init__(self, ip: str, connection: websockets.ServerConnection):
+    def __init__(self, ip: str, connection: websockets.ServerConnection, limit=256, overflow=Overflow.COALESCE):
         self.ip = ip
         self.connection = connection
+        self.outbox = Outbox(connection, "agent", limit, overflow)
         self.id = int(ip.split(".")[-1])
+        self.protocol = 0
+
+    async def send(self, message: str, channel=CONTROL):
+        await self.outbox.put(message, channel)
 
-    async def send(self, message: str):
-        await self.connection.send(message)
+    async def ping(self) -> float:
+        pong = await self.connection.ping()
+        return await pong
 
     async def close(self):
+        self.outbox.close()
         await self.connection.close()
 
     def __str__(self):
@@ -51,34 +166,137 @@ class Agent:
 
 class App:
 
-    def __init__(self, ip: str, connection: websockets.ServerConnection):
+    def __init__(self, ip: str, connection: websockets.ServerConnection, limit=256, overflow=Overflow.COALESCE):
         self.ip = ip
         self.connection = connection
+        self.outbox = Outbox(connection, "app", limit, overflow)
         self.octet = int(ip.split(".")[-1])
+        self.protocol = 0
 
-    async def send(self, message: str):
-        await self.connection.send(message)
+    async def send(self, message: str, channel=CONTROL):
+        await self.outbox.put(message, channel)
+
+    async def close(self):
+        self.outbox.close()
+        await self.connection.close()
 
     def __str__(self):
         return f"App({self.ip})"
 
 
-class ConnectionManager:
+class Peer:
+
+    # Link to another manager shard. Each side dials the other and only sends
+    # on its own outgoing connection, so one Peer is used for both directions.
+    # A stalled shard must not hold up whoever sends to it, so when its queue
+    # is full the oldest message is dropped. Routed commands then time out like
+    # any lost reply; a dropped device update makes the link stale, and once
+    # the queue has drained resync(since) sends what changed after the last
+    # update that went out.
+    SYNC = ("device_info", "device_update")
+
+    def __init__(self, shard: str, url: str):
+        self.shard = shard
+        self.url = url
+        self.connection = None
+        self.outbox = None
+        self.protocol = protocol.PROTOCOL_VERSION  # Shards are deployed together
+        self.resync = None  # (since) -> device_info message, set by the manager
+        self.synced = None  # Version of the last device update sent
+        self.stale = False
+
+    def attach(self, connection: websockets.ClientConnection):
+        self.connection = connection
+        self.synced, self.stale = None, False
+        # Links stay on one channel: each direction has its own socket, with no way back for credit.
+        self.outbox = Outbox(connection, "peer", limit=1024, overflow=Overflow.COALESCE,
+                             on_drop=self.dropped, on_sent=self.delivered)
+
+    def dropped(self, message: str):
+        if not message.startswith("@") and protocol.peek_command(message) in self.SYNC:
+            self.stale = True
+
+    def delivered(self, message: str):
+        if not self.stale:
+            if not message.startswith("@") and protocol.peek_command(message) in self.SYNC:
+                self.synced = protocol.loads(message)["version"]
+        elif self.resync and len(self.outbox) < self.outbox.limit // 2:
+            self.stale = False
+            self.outbox.put_nowait(self.resync(self.synced))
+
+    def detach(self):
+        if self.outbox is not None:
+            self.outbox.close()
+        self.connection = self.outbox = None
+
+    async def send(self, message: str, channel=CONTROL):
+        if self.outbox is None:
+            raise websockets.ConnectionClosed(None, None)
+        await self.outbox.put(message, channel)
+
+    async def close(self):
+        if self.connection:
+            await self.connection.close()
+        self.detach()
 
+    def __str__(self):
+        return f"Peer({self.shard})"
 
-    def __init__(self, agent_port=8765, app_port=8766, agent_ips=None):
+
+class ConnectionManager:
+
+    # A connection has to stay up this long before a drop reconnects without backing off
+    STABLE_AFTER = 10
+
+    def __init__(
+        self,
+        agent_port=8765,
+        app_port=8766,
+        agent_ips=None,
+        exclude_ips=(),
+        app_ips=None,
+        max_connects=64,
+        connect_timeout=3,
+        metrics_port=None,
+        metrics_host="127.0.0.1",
+        shard=None,
+        peer_port=None,
+        peers=None,
+        outbox_size=256,
+        agent_overflow=Overflow.COALESCE,
+        app_overflow=Overflow.COALESCE,
+    ):
         self.agent_port = agent_port
         self.app_port = app_port
-        self.agent_ips = agent_ips if agent_ips else []
+        self.agent_ips = parse_ips(agent_ips, exclude=exclude_ips) if agent_ips else []
+        self.max_connects = max_connects
+        self.connect_timeout = connect_timeout
         self.agents: dict[str, Agent] = {}
+        self.agent_states: dict[str, AgentState] = {ip: AgentState.IDLE for ip in self.agent_ips}
+        self.agent_tasks: dict[str, asyncio.Task] = {}
+        self.app_ips = parse_ips(app_ips) if app_ips else []
         self.apps: dict[str, App] = {}
+        self.app_tasks: dict[str, asyncio.Task] = {}
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.shard = shard
+        self.peer_port = peer_port
+        self.peers: dict[str, Peer] = {name: Peer(name, url) for name, url in (peers or {}).items()}
+        self.outbox_size = outbox_size
+        self.agent_overflow = Overflow(agent_overflow)
+        self.app_overflow = Overflow(app_overflow)
         self.logger = get_logger("ConnectionManager")
-        self.setup_listener()
+
+        AGENTS_CONNECTED.collect = lambda: sum(state == AgentState.OPEN for state in self.agent_states.values())
+        APPS_CONNECTED.collect = lambda: sum(
+            app.connection.state == websockets.protocol.State.OPEN for app in self.apps.values()
+        )
 
     def setup_listener(self):
-        zeroconf = Zeroconf()
-        self.listener = AppListener()
-        ServiceBrowser(zeroconf, "_lazy._tcp.local.", self.listener)
+        self.app_events = asyncio.Queue()
+        self.zeroconf = AsyncZeroconf()
+        self.listener = AppListener(self.zeroconf, self.app_events)
+        self.browser = AsyncServiceBrowser(self.zeroconf.zeroconf, "_lazy._tcp.local.", handlers=[self.listener.on_change])
 
     def start(self):
         self.loop = asyncio.new_event_loop()
@@ -90,62 +308,177 @@ class ConnectionManager:
             self.try_connect_agents(),
             self.try_connect_apps(),
         ]
+        if self.metrics_port:
+            tasks.append(metrics.serve(self.metrics_host, self.metrics_port))
+        if self.peer_port:
+            tasks.append(self.serve_peers())
+        tasks += [self.supervise_peer(peer) for peer in self.peers.values()]
         await asyncio.gather(*tasks)
 
+    async def serve_peers(self):
+        async with websockets.serve(self.accept_peer, "0.0.0.0", self.peer_port):
+            self.logger.info(f"Shard {self.shard} accepting peers on port {self.peer_port}")
+            await asyncio.Future()
+
+    async def accept_peer(self, connection: websockets.ServerConnection):
+        try:
+            hello = protocol.decode(await connection.recv())
+        except (ProtocolError, websockets.ConnectionClosed) as e:
+            self.logger.warning(f"Rejected peer: {e}")
+            return
+
+        peer = self.peers.get(hello.get("shard"))
+        if hello["command"] != "hello" or not peer:
+            self.logger.warning(f"Rejected unknown peer {hello.get('shard')}")
+            await connection.close()
+            return
+
+        self.logger.info(f"{peer} connected")
+        try:
+            async for message in connection:
+                try:
+                    await self.handle_peer_message(message, peer)
+                except Exception as e:
+                    self.logger.error(f"Error handling message from {peer}: {e}")
+        except websockets.ConnectionClosed:
+            pass
+        self.logger.warning(f"{peer} disconnected")
+        await self.on_peer_disconnect(peer)
+
+    async def supervise_peer(self, peer: Peer):
+        backoff = Backoff(cap=10)
+        while True:
+            try:
+                peer.attach(await websockets.connect(peer.url, open_timeout=self.connect_timeout))
+                await peer.send(protocol.encode("manager", "hello", shard=self.shard))
+                await self.on_peer_connect(peer)
+                backoff.reset()
+                await peer.connection.wait_closed()
+                self.logger.warning(f"Lost link to {peer}")
+            except Exception as e:
+                self.logger.debug(f"Failed to connect to {peer} at {peer.url}: {e}")
+            peer.detach()
+            await asyncio.sleep(backoff.next())
+
     async def try_connect_apps(self):
+        self.setup_listener()
+        for ip in self.app_ips:
+            self.app_events.put_nowait(("add", ip))  # Known apps, on top of the ones zeroconf finds
         while True:
-            for ip in self.listener.ips:
-                if ip in self.apps and self.apps[ip].connection.state == websockets.protocol.State.OPEN:
-                    continue  # Already connected
+            event, ip = await self.app_events.get()
+            if event == "add" and ip not in self.app_tasks:
                 self.logger.info(f"Discovered app: {ip}")
-                await self._connect_to_app(ip)
-
-            for app in self.apps.values():
-                if app.connection.state > websockets.protocol.State.OPEN:
-                    self.logger.info(f"Reconnecting to app {app.ip}")
-                    async def reconnect():
-                        try:
-                            ws = await websockets.connect(f"ws://{app.ip}:{self.app_port}")
-                            await self.on_app_connect(app)
-                            app.connection = ws
-                        except Exception as e:
-                            pass
-                    asyncio.create_task(reconnect())
-            await asyncio.sleep(2)
-
-    async def _connect_to_app(self, ip: str):
+                self.app_tasks[ip] = asyncio.create_task(self.supervise_app(ip))
+            elif event == "remove":
+                await self.remove_app(ip)
+
+    async def supervise_app(self, ip: str):
+        backoff = Backoff()
+        while True:
+            app = await self._connect_to_app(ip)
+
+            if app:
+                connected_at = monotonic()
+                await self.process_app_messages(app)
+                self.drop_app(app)
+                await self.on_app_disconnect(app)
+                if monotonic() - connected_at >= self.STABLE_AFTER:
+                    backoff.reset()
+                    continue
+
+            delay = backoff.next()
+            self.logger.info(f"Reconnecting to app {ip} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _connect_to_app(self, ip: str) -> App | None:
+        metrics.CONNECT_ATTEMPTS.labels("app").inc()
         try:
-            ws = await websockets.connect(f"ws://{ip}:{self.app_port}")
-            self.apps[ip] = App(ip, ws)
-            await self.on_app_connect(self.apps[ip])
-            self.loop.create_task(self.process_app_messages(self.apps[ip]))
+            ws = await websockets.connect(f"ws://{ip}:{self.app_port}", open_timeout=self.connect_timeout)
         except Exception as e:
+            metrics.CONNECT_FAILURES.labels("app").inc()
             self.logger.warning(f"Failed to connect to app at {ip}: {e}")
+            return None
+
+        app = App(ip, ws, self.outbox_size, self.app_overflow)
+        self.apps[ip] = app
+        try:
+            await self.on_app_connect(app)
+        except websockets.ConnectionClosed:
+            self.drop_app(app)
+            return None
+        return app
+
+    def drop_app(self, app: App):
+        # Forwarding looks apps up here, a closed one must not be found
+        app.outbox.close()
+        if self.apps.get(app.ip) is app:
+            del self.apps[app.ip]
+
+    async def remove_app(self, ip: str):
+        task = self.app_tasks.pop(ip, None)
+        if task:
+            task.cancel()
+        app = self.apps.pop(ip, None)
+        if app:
+            self.logger.info(f"{app} went away")
+            await app.close()
+            await self.on_app_disconnect(app)
 
     async def try_connect_agents(self):
+        self.connect_slots = asyncio.Semaphore(self.max_connects)
+        for ip in self.agent_ips:
+            self.agent_tasks[ip] = asyncio.create_task(self.supervise_agent(ip))
+        self.logger.info(f"Supervising {len(self.agent_tasks)} agents")
+        await asyncio.gather(*self.agent_tasks.values())
+
+    async def supervise_agent(self, ip: str):
+        backoff = Backoff()
         while True:
-            for ip in self.agent_ips:
-                agent = self.agents.get(ip)
-                if agent and agent.connection.state == websockets.protocol.State.OPEN:
-                    continue  # Already connected
-                asyncio.create_task(self._connect_to_agent(ip))
-            await asyncio.sleep(5)
-
-    async def _connect_to_agent(self, ip: str):
+            self.agent_states[ip] = AgentState.CONNECTING
+            agent = await self._connect_to_agent(ip)
+
+            if agent:
+                self.agent_states[ip] = AgentState.OPEN
+                connected_at = monotonic()
+                await self.process_agent_messages(agent)
+                self.drop_agent(agent)
+                await self.on_agent_disconnect(agent)
+                if monotonic() - connected_at >= self.STABLE_AFTER:
+                    backoff.reset()
+                    continue  # Dropped after a healthy session, retry right away
+
+            self.agent_states[ip] = AgentState.BACKOFF
+            await asyncio.sleep(backoff.next())
+
+    async def _connect_to_agent(self, ip: str) -> Agent | None:
+        async with self.connect_slots:
+            metrics.CONNECT_ATTEMPTS.labels("agent").inc()
+            try:
+                ws = await websockets.connect(f"ws://{ip}:{self.agent_port}", open_timeout=self.connect_timeout)
+            except Exception as e:
+                metrics.CONNECT_FAILURES.labels("agent").inc()
+                self.logger.debug(f"Failed to connect to agent at {ip}: {e}")
+                return None
+
+        agent = Agent(ip, ws, self.outbox_size, self.agent_overflow)
+        self.agents[ip] = agent
         try:
-            ws = await websockets.connect(f"ws://{ip}:{self.agent_port}")
-            self.agents[ip] = Agent(ip, ws)
-            await self.on_agent_connect(self.agents[ip])
-            self.loop.create_task(self.process_agent_messages(self.agents[ip]))
-        except Exception as e:
-            pass
-            # self.logger.warning(f"Failed to connect to agent at {ip}: {e}")
+            await self.on_agent_connect(agent)
+        except websockets.ConnectionClosed:
+            self.drop_agent(agent)
+            return None
+        return agent
+
+    def drop_agent(self, agent: Agent):
+        agent.outbox.close()
+        if self.agents.get(agent.ip) is agent:
+            del self.agents[agent.ip]
 
     async def ping(self):
         for agent, ws in self.agents.items():
             try:
                 await ws.ping()
-                self.logger.info(f"Pinged {agent}")
+                self.logger.debug(f"Pinged {agent}")
             except Exception as e:
                 self.logger.warning(f"Failed to ping {agent}: {e}")
 
@@ -153,21 +486,35 @@ class ConnectionManager:
         if ip in self.agents:
             ws = self.agents[ip]
             await ws.send(message)
-            self.logger.info(f"Sent to {ip}: {message}")
+            self.logger.debug("Sent message", extra={"ip": ip, "size": len(message)})
         else:
             self.logger.info(f"No connection to {ip}")
 
     async def process_agent_messages(self, agent: Agent):
         try:
             async for message in agent.connection:
-                await self.handle_agent_message(message, agent)
+                metrics.AGENT_IN.inc()
+                metrics.AGENT_BYTES_IN.inc(len(message))
+                try:
+                    received = agent.outbox.feed(message)
+                    if received:
+                        await self.handle_agent_message(received[1], agent, received[0])
+                except Exception as e:
+                    self.logger.error(f"Error handling message from {agent}: {e}")
         except websockets.ConnectionClosed:
-            self.logger.info("Connection closed")
+            self.logger.info(f"{agent} connection closed")
 
     async def process_app_messages(self, app: App):
         try:
             async for message in app.connection:
-                await self.handle_app_message(message, app)
+                metrics.APP_IN.inc()
+                metrics.APP_BYTES_IN.inc(len(message))
+                try:
+                    received = app.outbox.feed(message)
+                    if received:
+                        await self.handle_app_message(received[1], app, received[0])
+                except Exception as e:
+                    self.logger.error(f"Error handling message from {app}: {e}")
         except websockets.ConnectionClosed:
             self.logger.warning(f"{app} connection closed")
 
@@ -176,14 +523,29 @@ class ConnectionManager:
             await ws.close()
             self.logger.info(f"Closed connection to {agent}")
 
-    async def handle_agent_message(self, message: str, agent: Agent):
+    async def handle_agent_message(self, message: str, agent: Agent, channel=CONTROL):
         pass
 
-    async def handle_app_message(self, message: str, app: App):
+    async def handle_app_message(self, message: str, app: App, channel=CONTROL):
         pass
 
     async def on_agent_connect(self, agent: Agent):
         pass
 
+    async def on_agent_disconnect(self, agent: Agent):
+        pass
+
     async def on_app_connect(self, app: App):
         pass
+
+    async def handle_peer_message(self, message: str, peer: Peer):
+        pass
+
+    async def on_peer_connect(self, peer: Peer):
+        pass
+
+    async def on_peer_disconnect(self, peer: Peer):
+        pass
+
+    async def on_app_disconnect(self, app: App):
+        pass
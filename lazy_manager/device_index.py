@@ -0,0 +1,117 @@
+import ipaddress
+from bisect import bisect_right, insort
+from itertools import islice
+from egm import EGM
+
+# Fields a query can filter on, each kept in a {value: {ip, ...}} index
+INDEXED = ("site", "type", "bv_type", "status", "lazy_egm_version", "shard")
+
+
+def ip_key(ip: str) -> int:
+    try:
+        return int(ipaddress.ip_address(ip))
+    except ValueError:
+        return 0
+
+
+class DeviceIndex(dict):
+
+    # The devices by IP, plus a secondary index per INDEXED field. Lookups by
+    # IP stay plain dict reads. Fields change in place on the records, so
+    # whoever changes one calls reindex(), DeviceManager.touch() does for
+    # every visible change.
+    def __init__(self):
+        super().__init__()
+        self.indexes: dict[str, dict[object, set[str]]] = {field: {} for field in INDEXED}
+        self.indexed: dict[str, tuple] = {}  # The values each device is filed under
+        # Every device in IP order, pages are read off it
+        self.keys: dict[str, tuple[int, str]] = {}
+        self.order: list[tuple[int, str]] = []
+
+    def __setitem__(self, ip: str, egm: EGM):
+        if ip not in self.keys:
+            self.keys[ip] = (ip_key(ip), ip)
+            insort(self.order, self.keys[ip])
+        super().__setitem__(ip, egm)
+        self.reindex(egm)
+
+    def __delitem__(self, ip: str):
+        super().__delitem__(ip)
+        self.forget(ip)
+
+    def pop(self, ip: str, *default):
+        if ip in self:
+            self.forget(ip)
+        return super().pop(ip, *default)
+
+    def forget(self, ip: str):
+        self.unfile(ip)
+        key = self.keys.pop(ip)
+        del self.order[bisect_right(self.order, key) - 1]
+
+    def reindex(self, egm: EGM):
+        values = tuple(getattr(egm, field) for field in INDEXED)
+        previous = self.indexed.get(egm.ip)
+        if values == previous:
+            return
+        for field, old, new in zip(INDEXED, previous or (None,) * len(INDEXED), values):
+            if previous and old != new:
+                self.discard(field, old, egm.ip)
+            if not previous or old != new:
+                self.indexes[field].setdefault(new, set()).add(egm.ip)
+        self.indexed[egm.ip] = values
+
+    def unfile(self, ip: str):
+        for field, value in zip(INDEXED, self.indexed.pop(ip, ())):
+            self.discard(field, value, ip)
+
+    def discard(self, field: str, value, ip: str):
+        ips = self.indexes[field].get(value)
+        if ips:
+            ips.discard(ip)
+            if not ips:
+                del self.indexes[field][value]
+
+    def matching(self, where: dict) -> set[str] | None:
+        # IPs matching every field, a value may also be a list of accepted
+        # values. None means no filter at all. Raises KeyError for a field
+        # that is not indexed.
+        groups = []
+        for field, wanted in where.items():
+            index = self.indexes[field]
+            if isinstance(wanted, list):
+                groups.append(set().union(*(index.get(value, ()) for value in wanted)))
+            else:
+                groups.append(index.get(wanted, set()))
+        if not groups:
+            return None
+
+        groups.sort(key=len)
+        return groups[0].intersection(*groups[1:])
+
+    def select(self, where: dict) -> list[EGM]:
+        ips = self.matching(where)
+        return list(self.values()) if ips is None else [self[ip] for ip in ips]
+
+    def query(self, where: dict, limit: int, after: str = None) -> tuple[list[EGM], int, str | None]:
+        # One page of matches in IP order, the total number of matches and the
+        # cursor for the next page, if there is one
+        ips = self.matching(where)
+        total = len(self) if ips is None else len(ips)
+        cursor = (ip_key(after), after) if after is not None else None
+
+        if ips is None or limit * len(self) < 4 * total * total:
+            # Plenty of matches, walking the IP order finds a page soonest
+            page = []
+            for key in islice(self.order, bisect_right(self.order, cursor) if cursor else 0, None):
+                if ips is None or key[1] in ips:
+                    page.append(key[1])
+                    if len(page) > limit:
+                        break
+        else:
+            # Few matches scattered over the fleet, sorting them is cheaper
+            keys = self.keys
+            page = sorted((ip for ip in ips if not cursor or keys[ip] > cursor), key=keys.__getitem__)[:limit + 1]
+
+        following = page[limit - 1] if len(page) > limit else None
+        return [self[ip] for ip in page[:limit]], total, following
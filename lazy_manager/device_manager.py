@@ -1,74 +1,237 @@
 import asyncio
-import json
-import logging
+import metrics
+import protocol
 from time import time
-from egm import EGM
-from websockets import ClientConnection, ConnectionClosed
-from connection_manager import Agent
+from uuid import uuid4
+from egm import EGM, RemoteEGM, FIELDS, TELEMETRY
+from device_index import DeviceIndex, INDEXED
+from heartbeat import Heartbeat
+from registry import Registry
+from websockets import ConnectionClosed
+from connection_manager import Agent, App, Peer
+from lazy_logging import get_logger
 
-logger = logging.getLogger("DeviceManager")
-logger.setLevel(logging.DEBUG)
-logger.propagate = False
+logger = get_logger("DeviceManager")
 
-if not logger.hasHandlers():
-    handler = logging.StreamHandler()
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+
+HEARTBEAT_RTT = metrics.Gauge("lazy_heartbeat_rtt_seconds", "Last websocket ping round trip per device", ("ip",))
 
 
 class DeviceManager:
-    def __init__(self):
-        self.devices = {}
-        self.ping_loop = None
+
+    # Devices restored from the registry that have not re-registered by then are marked Offline
+    RECONCILE_AFTER = 60
+    PAGE = 100
+    MAX_PAGE = 1000
+
+    def __init__(self, shard: str = None, registry: str = None):
+        self.shard = shard
+        self.devices = DeviceIndex()
+        self.heartbeat = Heartbeat(self.devices, self.set_status)
+        HEARTBEAT_RTT.collect = lambda: {(ip,): egm.rtt for ip, egm in self.devices.items() if egm.rtt is not None}
+        # Bumped on every visible change; the epoch tells clients when versions restarted
+        self.version = 0
+        self.epoch = uuid4().hex[:8]
+        self.subscribers: dict[App, dict] = {}
+        self.pending: dict[str, dict] = {}
+        self.changed = asyncio.Event()
+        self.publisher = None
+        self.registry = Registry(registry) if registry else None
+        if self.registry:
+            self.restore(self.registry.load())
+
+    def restore(self, records: list[dict]):
+        for record in records:
+            egm = EGM(None, **record)
+            egm.status = record.get("status", "Offline")
+            egm.last_seen = record.get("last_seen", 0)
+            egm.version = record.get("version", 0)
+            egm.stale = True
+            self.devices[egm.ip] = egm
+        self.version = max((egm.version for egm in self.devices.values()), default=0)
+
+    async def run(self):
+        tasks = [self.reconcile()]
+        if self.registry:
+            tasks.append(self.registry.run())
+        await asyncio.gather(*tasks)
+
+    async def reconcile(self):
+        await asyncio.sleep(self.RECONCILE_AFTER)
+        missing = [egm for egm in self.devices.values() if egm.stale]
+        if missing:
+            logger.info(f"{len(missing)} stored devices did not come back, marking them Offline")
+        for egm in missing:
+            egm.stale = False
+            egm.status = "Offline"
+            self.touch(egm, status="Offline", stale=False)
+
+    def touch(self, egm: EGM, **changes):
+        self.devices.reindex(egm)
+        self.version += 1
+        egm.version = self.version
+        if self.registry and not isinstance(egm, RemoteEGM):
+            self.registry.save(egm)
+
+        if self.subscribers:
+            # A device that registered is sent whole, otherwise only the fields that changed
+            update = self.pending.setdefault(egm.ip, {"ip": egm.ip})
+            update.update(changes or egm.serialize())
+            self.changed.set()
+
+    def set_status(self, egm: EGM, status: str):
+        if egm.status != status:
+            egm.status = status
+            self.touch(egm, status=status)
+
+    def subscribe(self, app: App, match: dict = None):
+        logger.info(f"{app} subscribed to device updates {match or ''}")
+        self.subscribers[app] = match or {}
+        if not self.publisher:
+            self.publisher = asyncio.create_task(self.publish_changes())
+
+    def unsubscribe(self, app: App):
+        self.subscribers.pop(app, None)
+
+    @staticmethod
+    def matches(egm: EGM, match: dict) -> bool:
+        return all(getattr(egm, key, None) == value for key, value in match.items())
+
+    async def publish_changes(self):
+        while True:
+            await self.changed.wait()
+            await asyncio.sleep(0.05)  # Let a burst of changes collapse into one frame
+            self.changed.clear()
+            pending, self.pending = self.pending, {}
+
+            for app, match in list(self.subscribers.items()):
+                updates = [
+                    update for ip, update in pending.items()
+                    if ip in self.devices and self.matches(self.devices[ip], match)
+                ]
+                if not updates:
+                    continue
+
+                message = protocol.encode(
+                    "manager", "device_update", epoch=self.epoch, version=self.version, result=updates
+                )
+                try:
+                    await app.send(message)
+                except ConnectionClosed:
+                    self.unsubscribe(app)
+
+    def select(self, selector: dict) -> list[EGM]:
+        if selector.get("ips"):
+            devices = [self.devices[ip] for ip in selector["ips"] if ip in self.devices]
+        else:
+            match = {key: selector[key] for key in ("site", "type", "bv_type") if selector.get(key)}
+            if not match and not selector.get("all"):
+                return []
+            devices = self.devices.select(match)
+        return [egm for egm in devices if egm.agent]  # Stored devices without an agent cannot run anything
+
+    def snapshot(self, since: int = None, epoch: str = None, match: dict = None) -> dict:
+        if epoch != self.epoch:
+            since = None
+
+        if since is not None and since >= self.version:
+            return {"epoch": self.epoch, "version": self.version, "unchanged": True, "result": []}
+
+        devices = self.devices.select(match) if match else self.devices.values()
+        if since is not None:
+            devices = [egm for egm in devices if egm.version > since]
+
+        return {
+            "epoch": self.epoch,
+            "version": self.version,
+            "full": since is None,
+            "result": [egm.serialize() for egm in devices],
+        }
+
+    def query(self, where: dict = None, limit: int = None, after: str = None) -> dict:
+        where = where or {}
+        for field, value in where.items():
+            if field not in INDEXED:
+                raise ValueError(f"Cannot filter on '{field}', only on {', '.join(INDEXED)}")
+            if not all(isinstance(item, (str, int, bool)) for item in (value if isinstance(value, list) else [value])):
+                raise ValueError(f"Filter '{field}' takes a value or a list of values")
+
+        limit = max(1, min(limit or self.PAGE, self.MAX_PAGE))
+        devices, total, following = self.devices.query(where, limit, after)
+        return {
+            "epoch": self.epoch,
+            "version": self.version,
+            "total": total,
+            "next": following,
+            "result": [egm.serialize() for egm in devices],
+        }
 
     async def register(self, agent: Agent, data):
         logger.info(f"Registering device {agent.id}")
 
         properties = data["result"]
 
-        if agent.ip in self.devices:
-            await self.devices[agent.ip].agent.close()
+        previous = self.devices.get(agent.ip)
+        if previous and previous.agent and not isinstance(previous, RemoteEGM) and previous.agent is not agent:
+            await previous.agent.close()
 
         egm = EGM(agent=agent, **properties)
+        egm.shard = self.shard
+        egm.status = "Online"
+        egm.last_seen = time()
         self.devices[agent.ip] = egm
-
-        if not self.ping_loop:
-            self.ping_loop = asyncio.create_task(self.ping_devices())
+        self.touch(egm)
+        self.heartbeat.add(egm)
+
+    def disconnected(self, agent: Agent):
+        egm = self.devices.get(agent.ip)
+        if egm and egm.agent is agent:
+            self.set_status(egm, "Offline")
+
+    def merge_remote(self, peer: Peer, records: list[dict], full=False):
+        seen = set()
+        for record in records:
+            ip = record["ip"]
+            seen.add(ip)
+            egm = self.devices.get(ip)
+
+            if egm and not isinstance(egm, RemoteEGM):
+                continue  # A local registration always wins
+
+            if egm and egm.shard == peer.shard:
+                changes = {key: value for key, value in record.items() if key in FIELDS and getattr(egm, key) != value}
+                if changes:
+                    for key, value in changes.items():
+                        setattr(egm, key, value)
+                    self.touch(egm, **changes)
+            elif "site" in record:  # Partial updates for devices we never saw are useless
+                egm = RemoteEGM(peer, {**record, "shard": peer.shard})
+                self.devices[ip] = egm
+                self.touch(egm)
+
+        if full:
+            for egm in self.remote_devices(peer):
+                if egm.ip not in seen:
+                    self.set_status(egm, "Offline")
+
+    def remote_devices(self, peer: Peer) -> list[RemoteEGM]:
+        return [egm for egm in self.devices.select({"shard": peer.shard}) if isinstance(egm, RemoteEGM)]
+
+    def peer_lost(self, peer: Peer):
+        for egm in self.remote_devices(peer):
+            self.set_status(egm, "Offline")
 
     async def handle(self, agent: Agent, data: dict):
         if data["command"] == "register":
             await self.register(agent, data)
 
         if data["command"] == "ping":
-            self.devices[agent.ip].status = "Online"
+            self.set_status(self.devices[agent.ip], "Online")
             self.devices[agent.ip].last_seen = time()
 
-    async def ping_devices(self):
-        while True:
-            device_ips = list(self.devices.keys())
-
-            for ip in device_ips:
-                device = self.devices[ip]
-
-                if time() - device.last_seen < 10:
-                    continue  # Recently seen, skip ping
-
-                try:
-                    message = {
-                        "sender": "manager",
-                        "command": "ping",
-                    }
-                    await device.agent.send(json.dumps(message))
-                    device.last_seen = time()
-                    device.status = "Online"
-                except ConnectionClosed:
-                    logger.warning(f"{device.ip} Ping failed: Connection closed.")
-                    device.status = "Offline"
-                    await device.agent.close()
-                except Exception as e:
-                    device.status = "Offline"
-                    logger.error(f"{device.ip} Ping failed: Error : {e}")
-
-                await asyncio.sleep(1)
-            await asyncio.sleep(1)
+        if data["command"] == "telemetry":
+            egm = self.devices.get(agent.ip)
+            if egm and egm.agent is agent:
+                egm.last_seen = time()
+                values = {field: data[field] for field in TELEMETRY if field in data}
+                self.touch(egm, telemetry=egm.update_telemetry(values))
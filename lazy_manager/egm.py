@@ -1,21 +1,42 @@
 import json
 import asyncio
+from time import time
 from asyncio.subprocess import PIPE
 from connection_manager import Agent
 
 
+# Fields shared with apps and peer managers
+FIELDS = ("id", "site", "type", "bv_type", "status", "lazy_egm_version", "shard", "stale", "telemetry")
+# Fields of an agent's telemetry frames
+TELEMETRY = ("cpu", "memory", "disk", "uptime", "processes")
+
+
 class EGM:
+    __slots__ = (
+        "agent", "ip", "id", "shard", "site", "bv_type", "type", "lazy_egm_version", "stale",
+        "last_seen", "status", "version", "rtt", "missed", "answered", "telemetry",
+    )
 
-    def __init__(self, agent: Agent, **properties):
+    def __init__(self, agent: Agent, ip: str = None, id: int = None, **properties):
         self.agent = agent
-        self.ip = agent.ip
-        self.id = agent.id
+        self.ip = ip or agent.ip
+        self.id = agent.id if id is None else id
+        self.shard = properties.get("shard")
         self.site = properties.get("site")
         self.bv_type = properties.get("bv_type")
         self.type = properties.get("type")
         self.lazy_egm_version = properties.get("lazy_egm_version", "unknown")
+        # Restored from the registry and not confirmed by its agent yet
+        self.stale = properties.get("stale", False)
         self.last_seen = 0
         self.status = "Offline"
+        self.version = 0
+        self.rtt = None
+        self.missed = 0
+        self.answered = 0
+        # Latest health figures from the agent: cpu, memory and disk in percent,
+        # booted (manager clock) and processes, {name: running}
+        self.telemetry = {}
 
     async def is_reachable(self):
         command = f"ping -n 1 {self.ip}"
@@ -29,17 +50,46 @@ class EGM:
         
         self.status = "Online"
         return True
+
+    def update_telemetry(self, values: dict) -> dict:
+        # Agents count uptime on their own clock, turning it into a boot time
+        # on ours keeps it right without the agent sending it again
+        if "uptime" in values:
+            values["booted"] = round(time() - values.pop("uptime"))
+        self.telemetry = {**self.telemetry, **values}
+        return self.telemetry
     
     def serialize(self):
-        return {
+        record = {
             "ip": self.ip,
             "id": self.id,
             "site": self.site,
             "type": self.type,
             "bv_type": self.bv_type,
             "status": self.status,
-            "lazy_egm_version": self.lazy_egm_version
+            "lazy_egm_version": self.lazy_egm_version,
+            "stale": self.stale,
         }
+        if self.shard:
+            record["shard"] = self.shard
+        if self.telemetry:
+            record["telemetry"] = self.telemetry
+        return record
+
+    def __str__(self):
+        return f"EGM {self.id}"
+
+
+class RemoteEGM(EGM):
+
+    # A device owned by another manager shard. Its "agent" is the peer link to
+    # that shard, so commands for it are routed there like any other device.
+    __slots__ = ()
+
+    def __init__(self, peer, record: dict):
+        super().__init__(peer, **record)
+        self.status = record.get("status", "Offline")
+        self.telemetry = record.get("telemetry", {})
 
     def __str__(self):
-        return f"EGM {self.id}"
\ No newline at end of file
+        return f"EGM {self.id} ({self.shard})"
\ No newline at end of file
@@ -0,0 +1,107 @@
+import asyncio
+import protocol
+from uuid import uuid4
+from lazy_logging import get_logger
+from egm import EGM
+from inflight import InFlight
+
+logger = get_logger("FanOut")
+
+
+class FanOut:
+
+    # Replies are routed back to a pseudo app address, "fanout:<job>", so the
+    # regular forwarding path (local agents, legacy agents and other shards)
+    # delivers them to this job's in-flight requests instead of to a tablet.
+    # Job ids are random, replies from shards running jobs of their own must
+    # not match ours.
+    PREFIX = "fanout:"
+    TIMEOUT = 30
+    PROGRESS_INTERVAL = 0.5
+
+    def __init__(self, app, action: str, devices: list[EGM], args: dict = None, cap=16):
+        self.job = uuid4().hex
+        self.address = f"{self.PREFIX}{self.job}"
+        self.app = app
+        self.action = action
+        self.devices = devices
+        self.args = args or {}
+        self.payload = protocol.encode("app", action, **self.args)
+        self.cap = cap
+        self.results: dict[str, object] = {}
+        self.fresh: dict[str, object] = {}
+        self.changed = asyncio.Event()
+
+    async def run(self, forward, inflight: InFlight):
+        logger.info(f"Job {self.job}: {self.action} on {len(self.devices)} devices for {self.app}")
+        slots = asyncio.Semaphore(self.cap)
+        progress = asyncio.create_task(self.report_progress())
+        try:
+            await asyncio.gather(*(self.dispatch(device, forward, inflight, slots) for device in self.devices))
+        finally:
+            progress.cancel()
+        await self.report(finished=True)
+
+    async def dispatch(self, device: EGM, forward, inflight: InFlight, slots: asyncio.Semaphore):
+        async with slots:
+            try:
+                result = await self.apply(device, forward, inflight)
+            except asyncio.TimeoutError:
+                result = "Timeout"
+            except Exception as e:
+                result = f"Failure - {e}"
+
+        self.results[device.ip] = result
+        self.fresh[device.ip] = result
+        self.changed.set()
+
+    async def apply(self, device: EGM, forward, inflight: InFlight):
+        # What the job does to one device, returns its result
+        reply = await self.request(device, self.payload, self.job, forward, inflight, self.TIMEOUT)
+        return reply.get("result")
+
+    async def request(self, device: EGM, payload: str, cid: str, forward, inflight: InFlight, timeout: float,
+                      channel=None) -> dict:
+        request = inflight.add(device.ip, self.address, cid, protocol.peek_command(payload), timeout, future=True)
+        if not request:
+            raise RuntimeError("too many commands in flight")
+        try:
+            await forward(device, payload, self.address, cid, channel)
+            reply = await request.future
+        finally:
+            inflight.discard(request)
+        return protocol.decode(reply) if isinstance(reply, str) else reply
+
+    @staticmethod
+    def failed(result) -> bool:
+        # Queries like process_status answer with a record, commands with "Success"
+        return not isinstance(result, dict) and result != "Success"
+
+    async def report_progress(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            await self.report(finished=False)
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+
+    async def report(self, finished: bool, **extra):
+        # Progress frames carry only results that arrived since the last frame,
+        # the final frame carries all of them
+        results = self.results if finished else self.fresh
+        self.fresh = {}
+        message = protocol.encode(
+            "manager",
+            "fan_out",
+            job=self.job,
+            action=self.action,
+            total=len(self.devices),
+            done=len(self.results),
+            failed=sum(self.failed(result) for result in self.results.values()),
+            finished=finished,
+            results=results,
+            **extra,
+        )
+        try:
+            await self.app.send(message)
+        except Exception as e:
+            logger.warning(f"Job {self.job}: could not report to {self.app}: {e}")
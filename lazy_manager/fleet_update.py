@@ -0,0 +1,150 @@
+import hmac
+import asyncio
+import hashlib
+import protocol
+from base64 import b64encode
+from pathlib import Path
+from channels import BULK
+from egm import EGM
+from fan_out import FanOut
+from inflight import InFlight
+from lazy_logging import get_logger
+
+logger = get_logger("FleetUpdate")
+
+CHUNK_SIZE = 256 * 1024
+
+
+def signature(key: str, build: str, size: int) -> str:
+    # Agents only take offers signed with the key they share with the manager
+    return hmac.new(key.encode(), f"{build}:{size}".encode(), hashlib.sha256).hexdigest()
+
+
+class Build:
+    __slots__ = ("data", "sha256", "chunks", "chunk_size")
+
+    # An agent build split into chunks, everything named by its sha256
+    def __init__(self, data: bytes, chunk_size=CHUNK_SIZE):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.chunks = [hashlib.sha256(self.chunk(index)).hexdigest()
+                       for index in range((len(data) + chunk_size - 1) // chunk_size)]
+
+    @classmethod
+    def read(cls, path: str) -> "Build":
+        return cls(Path(path).read_bytes())
+
+    def chunk(self, index: int) -> bytes:
+        return self.data[index * self.chunk_size:(index + 1) * self.chunk_size]
+
+    def manifest(self) -> dict:
+        return {"build": self.sha256, "size": len(self.data), "chunk_size": self.chunk_size, "chunks": self.chunks}
+
+
+class UpdateFailed(Exception):
+
+    # The agent's reason, dispatch puts "Failure - " back in front
+    def __init__(self, result, what: str = None):
+        reason = str(result).removeprefix("Failure - ")
+        super().__init__(f"{what}: {reason}" if what else reason)
+
+
+class FleetUpdate(FanOut):
+
+    # Pushes one build to many agents at once, cap of them at a time. Each
+    # agent is offered the manifest and answers with the chunks it already
+    # has, only the rest is sent, WINDOW chunks in flight per agent on the
+    # bulk channel. An agent that drops out mid-transfer is offered the
+    # build again once it is back, which resumes where it stopped. Progress
+    # frames are fan_out frames with a "progress" field, "<chunks>/<total>"
+    # per device still transferring.
+    PREFIX = "update:"
+    WINDOW = 4
+    CHUNK_TIMEOUT = 30
+    INSTALL_TIMEOUT = 120
+    ATTEMPTS = 3
+    RETRY_AFTER = 10
+
+    def __init__(self, app, build: Build, devices: list[EGM], lookup, key: str, cap=8):
+        super().__init__(app, "update", devices, cap=cap)
+        self.build = build
+        self.signature = signature(key, build.sha256, len(build.data))
+        self.lookup = lookup  # ip -> the current EGM record, an agent that reconnects gets a new one
+        self.requests = 0
+        self.progress: dict[str, str] = {}
+
+    async def run(self, forward, inflight: InFlight):
+        logger.info(f"Job {self.job}: build {self.build.sha256[:12]}, {len(self.build.chunks)} chunks")
+        await super().run(forward, inflight)
+
+    async def apply(self, device: EGM, forward, inflight: InFlight):
+        try:
+            for attempt in range(1, self.ATTEMPTS + 1):
+                try:
+                    return await self.push(device, forward, inflight)
+                except UpdateFailed:
+                    raise
+                except Exception as e:
+                    if attempt == self.ATTEMPTS:
+                        raise
+                    logger.info(f"Job {self.job}: update of {device.ip} interrupted ({e or type(e).__name__}), resuming")
+                await asyncio.sleep(self.RETRY_AFTER)
+                device = self.lookup(device.ip) or device
+        finally:
+            self.progress.pop(device.ip, None)
+
+    async def push(self, device: EGM, forward, inflight: InFlight) -> str:
+        build = self.build
+        reply = await self.call(device, "update_offer", forward, inflight, self.TIMEOUT, **build.manifest(),
+                                signature=self.signature)
+        if reply.get("result") == "Current":
+            return "Up to date"
+        if reply.get("result") != "Ready":
+            raise UpdateFailed(reply.get("result"))
+
+        have = set(reply.get("have") or ())
+        missing = iter([index for index in range(len(build.chunks)) if index not in have])
+        sent = [len(have)]
+        self.show(device, sent[0])
+        senders = [asyncio.create_task(self.send_chunks(device, missing, sent, forward, inflight))
+                   for _ in range(self.WINDOW)]
+        try:
+            await asyncio.gather(*senders)
+        finally:
+            for sender in senders:
+                sender.cancel()
+
+        reply = await self.call(device, "update_commit", forward, inflight, self.INSTALL_TIMEOUT, build=build.sha256)
+        if reply.get("result") != "Success":
+            raise UpdateFailed(reply.get("result"))
+        return "Success"
+
+    async def send_chunks(self, device: EGM, missing, sent: list[int], forward, inflight: InFlight):
+        # Senders share the iterator, so each chunk goes out once
+        for index in missing:
+            data = b64encode(self.build.chunk(index)).decode()
+            reply = await self.call(device, "update_chunk", forward, inflight, self.CHUNK_TIMEOUT, BULK,
+                                    build=self.build.sha256, index=index, data=data)
+            if reply.get("result") != "Success":
+                raise UpdateFailed(reply.get("result"), f"chunk {index}")
+            sent[0] += 1
+            self.show(device, sent[0])
+
+    async def call(self, device: EGM, command: str, forward, inflight: InFlight, timeout: float, channel=None,
+                   **fields) -> dict:
+        self.requests += 1
+        cid = f"{self.job}.{self.requests}"
+        return await self.request(device, protocol.encode("app", command, **fields), cid, forward, inflight,
+                                  timeout, channel)
+
+    def show(self, device: EGM, sent: int):
+        self.progress[device.ip] = f"{sent}/{len(self.build.chunks)}"
+        self.changed.set()
+
+    @staticmethod
+    def failed(result) -> bool:
+        return result not in ("Success", "Up to date")
+
+    async def report(self, finished: bool, **extra):
+        await super().report(finished, progress=dict(self.progress), **extra)
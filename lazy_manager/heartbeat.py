@@ -0,0 +1,89 @@
+import asyncio
+import random
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic, time
+from websockets import ConnectionClosed
+from lazy_logging import get_logger
+from egm import EGM
+
+
+class Heartbeat:
+
+    # A device goes Offline after OFFLINE_AFTER missed beats in a row and only
+    # comes back Online after ONLINE_AFTER answered beats in a row, so a single
+    # slow pong does not flap the status. Worst case detection time is
+    # INTERVAL * OFFLINE_AFTER + TIMEOUT, however many devices there are.
+    INTERVAL = 5
+    TIMEOUT = 3
+    OFFLINE_AFTER = 3
+    ONLINE_AFTER = 2
+
+    def __init__(self, devices: dict[str, EGM], set_status):
+        self.devices = devices
+        self.set_status = set_status
+        self.queue = []
+        self.sequence = count()
+        self.wakeup = asyncio.Event()
+        self.logger = get_logger("Heartbeat")
+        self.task = None
+        self.beats: set[asyncio.Task] = set()  # The loop only keeps weak references to tasks
+
+    def add(self, egm: EGM):
+        egm.missed = 0
+        egm.answered = 0
+        # Spread first beats over one interval so a mass reconnect does not ping in lockstep
+        self.schedule(egm, random.uniform(0, self.INTERVAL))
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    def schedule(self, egm: EGM, delay: float):
+        heappush(self.queue, (monotonic() + delay, next(self.sequence), egm))
+        if self.queue[0][2] is egm:
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            now = monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _, _, egm = heappop(self.queue)
+                if self.devices.get(egm.ip) is egm:  # Skip devices that re-registered since
+                    beat = asyncio.create_task(self.beat(egm))
+                    self.beats.add(beat)
+                    beat.add_done_callback(self.beats.discard)
+
+            self.wakeup.clear()
+            timeout = self.queue[0][0] - now if self.queue else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def beat(self, egm: EGM):
+        try:
+            rtt = await asyncio.wait_for(egm.agent.ping(), self.TIMEOUT)
+        except ConnectionClosed:
+            self.logger.warning(f"{egm.ip} Ping failed: Connection closed.")
+            self.set_status(egm, "Offline")
+            return  # The connection supervisor re-registers it once it is back
+        except Exception as e:
+            self.missed(egm, e)
+        else:
+            self.answered(egm, rtt)
+
+        self.schedule(egm, self.INTERVAL)
+
+    def answered(self, egm: EGM, rtt: float):
+        egm.rtt = rtt
+        egm.last_seen = time()
+        egm.missed = 0
+        egm.answered += 1
+        if egm.status != "Online" and egm.answered >= self.ONLINE_AFTER:
+            self.set_status(egm, "Online")
+
+    def missed(self, egm: EGM, error: Exception):
+        egm.answered = 0
+        egm.missed += 1
+        self.logger.debug(f"{egm.ip} missed heartbeat {egm.missed}: {str(error) or 'timeout'}")
+        if egm.missed >= self.OFFLINE_AFTER:
+            self.set_status(egm, "Offline")
@@ -0,0 +1,107 @@
+import math
+import asyncio
+import metrics
+from heapq import heappush, heappop
+from itertools import count
+from time import monotonic
+from lazy_logging import get_logger
+
+logger = get_logger("InFlight")
+
+COMMAND_SECONDS = metrics.Histogram("lazy_command_seconds", "Time from forwarding a command to its reply", ("command",))
+TIMEOUTS = metrics.Counter("lazy_command_timeouts_total", "Commands that got no reply before their deadline", ("command",))
+IN_FLIGHT = metrics.Gauge("lazy_commands_in_flight", "Commands waiting for a reply")
+MAX_COMMANDS = 64  # Command labels come from apps, keep their number bounded
+
+
+def command_label(command: str) -> str:
+    if (command,) in COMMAND_SECONDS.children or len(COMMAND_SECONDS.children) < MAX_COMMANDS:
+        return command
+    return "other"
+
+
+class Request:
+    __slots__ = ("key", "device_ip", "reply_to", "cid", "command", "sent", "deadline", "future")
+
+    def __init__(self, device_ip: str, reply_to: str, cid: str | None, command: str, ttl: float, future=None):
+        self.key = (device_ip, reply_to, cid)
+        self.device_ip = device_ip
+        self.reply_to = reply_to
+        self.cid = cid
+        self.command = command_label(command)
+        self.sent = monotonic()
+        self.deadline = self.sent + ttl
+        self.future = future
+
+
+class InFlight:
+
+    # Commands forwarded to agents, keyed by (device, reply address, cid) so
+    # several requests to one device can be pipelined. Every entry either gets
+    # its reply or is expired at its deadline, so lost replies cannot pile up.
+    DEFAULT_TTL = 10
+    MAX_TTL = 300
+    LIMIT = 10000
+
+    def __init__(self, on_timeout):
+        self.on_timeout = on_timeout
+        self.requests: dict[tuple, Request] = {}
+        self.deadlines = []
+        self.sequence = count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.notices: set[asyncio.Task] = set()  # on_timeout calls still running
+        IN_FLIGHT.collect = lambda: len(self.requests)
+
+    def add(self, device_ip: str, reply_to: str, cid: str | None, command="-", ttl=None, future=False) -> Request | None:
+        if len(self.requests) >= self.LIMIT:
+            logger.warning(f"Too many commands in flight, not tracking {command} for {device_ip}")
+            return None
+
+        # split_route rejects bad deadlines already, a NaN here would stop expire() for good
+        ttl = min(ttl, self.MAX_TTL) if ttl and 0 < ttl < math.inf else self.DEFAULT_TTL
+        request = Request(device_ip, reply_to, cid, command, ttl,
+                          asyncio.get_running_loop().create_future() if future else None)
+        self.requests[request.key] = request
+        heappush(self.deadlines, (request.deadline, next(self.sequence), request))
+        if self.deadlines[0][2] is request:
+            self.wakeup.set()
+        if not self.task:
+            self.task = asyncio.create_task(self.expire())
+        return request
+
+    def resolve(self, device_ip: str, reply_to: str, cid: str | None, reply=None) -> Request | None:
+        request = self.requests.pop((device_ip, reply_to, cid), None)
+        if request:
+            COMMAND_SECONDS.labels(request.command).observe(monotonic() - request.sent)
+            if request.future and not request.future.done():
+                request.future.set_result(reply)
+        return request
+
+    def discard(self, request: Request):
+        if self.requests.get(request.key) is request:
+            del self.requests[request.key]
+
+    async def expire(self):
+        while True:
+            now = monotonic()
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, _, request = heappop(self.deadlines)
+                if self.requests.get(request.key) is not request:
+                    continue  # Answered already
+                del self.requests[request.key]
+                TIMEOUTS.labels(request.command).inc()
+                if request.future:
+                    if not request.future.done():
+                        request.future.set_exception(asyncio.TimeoutError())
+                else:
+                    notice = asyncio.create_task(self.on_timeout(request))
+                    self.notices.add(notice)
+                    notice.add_done_callback(self.notices.discard)
+
+            self.wakeup.clear()
+            timeout = self.deadlines[0][0] - now if self.deadlines else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,384 @@
+import asyncio
+import argparse
+import ipaddress
+import multiprocessing
+import os
+import random
+import sys
+import urllib.request
+import websockets
+import protocol
+from itertools import count
+from pathlib import Path
+from time import monotonic
+from channels import Channels, command_channel
+from lazy_logging import get_logger
+from main import AGENT_PORT, APP_PORT
+
+logger = get_logger("LoadGen")
+
+# Starts a fleet of fake agents and simulated apps on loopback addresses, runs
+# a real manager against them and reports what it sustained. Every 127.0.0.0/8
+# address is loopback on Linux and Windows, so each fake device gets its own IP
+# on the manager's fixed ports. On macOS add the aliases first, e.g.
+# "sudo ifconfig lo0 alias 127.1.0.2 up".
+#
+#   python loadgen.py --agents 2000 --apps 4 --rate 500 --duration 30
+#
+# The fake agents run in --workers processes of their own, so the generator
+# is not the bottleneck. Its own CPU is reported next to the manager's; when
+# it is near 100% per worker, add workers before trusting the numbers.
+
+
+def addresses(first: str, number: int) -> list[str]:
+    start = ipaddress.ip_address(first)
+    return [str(start + i) for i in range(number)]
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def raise_file_limit():
+    # Every device is a socket on both ends, the manager inherits the limit
+    try:
+        import resource
+    except ImportError:
+        return  # Windows has no per-process descriptor limit to raise
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+class FakeAgent:
+
+    # Speaks enough of the lazy_egm protocol for the manager: register, ping
+    # and a "Success" reply to any app command after delay +- jitter seconds
+    def __init__(self, ip: str, delay: float, jitter: float):
+        self.ip = ip
+        self.delay = delay
+        self.jitter = jitter
+        self.properties = {
+            "site": random.choice(("lab", "warehouse")),
+            "bv_type": random.choice(("JcmUba", "MeiCashflow")),
+            "type": random.choice(("vertical", "1600")),
+            "lazy_egm_version": "loadgen",
+        }
+
+    async def serve(self):
+        return await websockets.serve(self.handle, self.ip, AGENT_PORT, compression=None)
+
+    async def handle(self, connection):
+        channels = Channels(connection.send).start()
+        try:
+            async for message in connection:
+                received = channels.feed(message)
+                if received:
+                    self.reply(channels, *received)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            channels.writer.cancel()
+
+    def reply(self, channels: Channels, channel: int, message: str):
+        routed = protocol.split_route(message)
+        if routed:
+            reply = protocol.route(routed.sender, protocol.encode("egm", protocol.peek_command(routed.payload),
+                                                                  result="Success"), cid=routed.cid)
+            if self.delay or self.jitter:
+                wait = max(0.0, self.delay + random.uniform(-self.jitter, self.jitter))
+                asyncio.get_running_loop().call_later(wait, channels.put_nowait, reply, channel)
+            else:
+                channels.put_nowait(reply, channel)
+            return
+
+        data = protocol.decode(message)
+        if data["command"] == "register":
+            channels.enabled = protocol.negotiate(data.get("protocol")) >= protocol.CHANNELS
+            channels.put_nowait(protocol.encode("egm", "register", result=self.properties,
+                                                protocol=protocol.PROTOCOL_VERSION))
+        elif data["command"] == "ping":
+            channels.put_nowait(protocol.encode("egm", "ping", result="pong"))
+
+
+def serve_agents(ips: list[str], delay: float, jitter: float):
+    # Entry point of a worker process
+    async def serve():
+        servers = [await FakeAgent(ip, delay, jitter).serve() for ip in ips]
+        try:
+            await asyncio.Future()
+        finally:
+            for server in servers:
+                server.close()
+
+    raise_file_limit()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+class Stats:
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.failures = 0
+        self.latencies: list[float] = []
+
+    def reset(self):
+        self.__init__()
+
+
+class SimulatedApp:
+
+    # Accepts the manager like lazy_app does and sends routed commands with a
+    # cid to random devices at a fixed rate, whether or not replies keep up,
+    # so a saturated manager shows up as growing latency and timeouts
+    def __init__(self, ip: str, targets: list[str], commands: list[str], rate: float, ttl: float, stats: Stats):
+        self.ip = ip
+        self.targets = targets
+        self.commands = commands
+        self.rate = rate
+        self.ttl = ttl
+        self.stats = stats
+        self.pending: dict[str, float] = {}
+        self.cids = count()
+        self.channels: Channels | None = None
+        self.connected = asyncio.Event()
+
+    async def serve(self):
+        return await websockets.serve(self.handle, self.ip, APP_PORT, compression=None)
+
+    async def handle(self, connection):
+        channels = Channels(connection.send).start()
+        try:
+            async for message in connection:
+                received = channels.feed(message)
+                if received:
+                    self.receive(channels, received[1])
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            channels.writer.cancel()
+            if self.channels is channels:
+                self.channels = None
+                self.connected.clear()
+
+    def receive(self, channels: Channels, message: str):
+        routed = protocol.split_route(message)
+        if not routed:
+            data = protocol.decode(message)
+            if data["command"] == "register":
+                channels.enabled = protocol.negotiate(data.get("protocol")) >= protocol.CHANNELS
+                channels.put_nowait(protocol.encode("app", "register", protocol=protocol.PROTOCOL_VERSION))
+                self.channels = channels
+                self.connected.set()
+            return
+
+        sent = self.pending.pop(routed.cid, None)
+        if sent is None:
+            return  # Sent before the last reset
+        command = protocol.peek_command(routed.payload)
+        if command == "timeout":
+            self.stats.timeouts += 1
+        elif '"result":"Success"' not in routed.payload:
+            self.stats.failures += 1
+        else:
+            self.stats.received += 1
+            self.stats.latencies.append(monotonic() - sent)
+
+    async def drive(self):
+        start, sent = monotonic(), 0
+        while True:
+            await self.connected.wait()
+            due = int((monotonic() - start) * self.rate) - sent
+            for _ in range(due):
+                command = random.choice(self.commands)
+                cid = str(next(self.cids))
+                self.pending[cid] = monotonic()
+                payload = protocol.encode("app", command)
+                self.channels.put_nowait(protocol.route(random.choice(self.targets), payload, cid=cid, ttl=self.ttl),
+                                         command_channel(command))
+            sent += due
+            self.stats.sent += due
+            await asyncio.sleep(0.005)
+
+
+class ProcessProbe:
+
+    # CPU and memory of a set of processes, when psutil is available
+    def __init__(self, *pids: int):
+        try:
+            import psutil
+        except ImportError:
+            logger.warning("psutil is not installed, CPU and memory will not be reported")
+            self.processes = []
+            return
+        self.processes = [psutil.Process(pid) for pid in pids]
+        for process in self.processes:
+            process.cpu_percent()
+
+    def sample(self) -> tuple[float, float] | None:
+        if not self.processes:
+            return None
+        return (sum(process.cpu_percent() for process in self.processes),
+                sum(process.memory_info().rss for process in self.processes) / 2**20)
+
+
+def scrape(port: int) -> dict[str, float]:
+    samples = {}
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2) as response:
+            for line in response.read().decode().splitlines():
+                if line and not line.startswith("#"):
+                    name, _, value = line.rpartition(" ")
+                    samples[name] = float(value)
+    except OSError as e:
+        logger.debug(f"Could not scrape the manager: {e}")
+    return samples
+
+
+def forward_mean(samples: dict[str, float], path: str) -> float:
+    total = samples.get(f'lazy_forward_seconds_count{{path="{path}"}}', 0)
+    return samples.get(f'lazy_forward_seconds_sum{{path="{path}"}}', 0) / total if total else 0.0
+
+
+async def wait_for_agents(number: int, port: int, timeout: float, manager) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = monotonic() + timeout
+    while monotonic() < deadline and manager.returncode is None:
+        connected = int((await loop.run_in_executor(None, scrape, port)).get("lazy_agents_connected", 0))
+        if connected == number:
+            return True
+        logger.info(f"{connected}/{number} agents connected")
+        await asyncio.sleep(1)
+    return False
+
+
+async def run(args):
+    raise_file_limit()
+    agent_ips = addresses(args.agent_base, args.agents)
+    app_ips = addresses(args.app_base, args.apps)
+    stats = Stats()
+
+    workers = [
+        multiprocessing.Process(target=serve_agents, args=(agent_ips[i::args.workers], args.delay, args.jitter), daemon=True)
+        for i in range(min(args.workers, len(agent_ips)))
+    ]
+    for worker in workers:
+        worker.start()
+    apps = [SimulatedApp(ip, agent_ips, args.commands, args.rate / args.apps, args.ttl, stats) for ip in app_ips]
+    servers = [await app.serve() for app in apps]
+    logger.info(f"Serving {len(agent_ips)} fake agents from {agent_ips[0]} in {len(workers)} workers"
+                f" and {len(apps)} apps from {app_ips[0]}")
+
+    command = [sys.executable, str(Path(__file__).with_name("main.py")),
+               "--agents", f"{agent_ips[0]}-{agent_ips[-1]}", "--apps", *app_ips,
+               "--registry", "", "--metrics-port", str(args.metrics_port), *args.manager_args]
+    manager = await asyncio.create_subprocess_exec(*command, stderr=asyncio.subprocess.DEVNULL if args.quiet else None)
+    probe = ProcessProbe(manager.pid)
+    own = ProcessProbe(os.getpid(), *(worker.pid for worker in workers))
+    drivers = []
+
+    try:
+        if not await wait_for_agents(len(agent_ips), args.metrics_port, args.connect_timeout, manager):
+            logger.warning("Not every agent registered in time, measuring the ones that did")
+        for app in apps:
+            await asyncio.wait_for(app.connected.wait(), args.connect_timeout)
+        drivers = [asyncio.create_task(app.drive()) for app in apps]
+
+        await asyncio.sleep(args.warmup)
+        stats.reset()
+        for app in apps:
+            app.pending.clear()
+        before, started = scrape(args.metrics_port), monotonic()
+        resources, generator = [], []
+        own.sample()
+
+        print(f"{'second':>6}{'sent/s':>10}{'replies/s':>11}{'p50 ms':>9}{'p99 ms':>9}{'timeouts':>10}{'cpu %':>8}{'rss MB':>9}"
+              f"{'gen cpu %':>11}")
+        last_sent = last_received = last_latencies = 0
+        for second in range(1, args.duration + 1):
+            await asyncio.sleep(1)
+            window = sorted(stats.latencies[last_latencies:])
+            sample = probe.sample()
+            if sample:
+                resources.append(sample)
+            cpu, rss = sample or (float("nan"), float("nan"))
+            own_sample = own.sample()
+            if own_sample:
+                generator.append(own_sample[0])
+            print(f"{second:>6}{stats.sent - last_sent:>10}{stats.received - last_received:>11}"
+                  f"{percentile(window, 0.5) * 1e3:>9.2f}{percentile(window, 0.99) * 1e3:>9.2f}"
+                  f"{stats.timeouts:>10}{cpu:>8.1f}{rss:>9.1f}{own_sample[0] if own_sample else float('nan'):>11.1f}")
+            last_sent, last_received, last_latencies = stats.sent, stats.received, len(stats.latencies)
+
+        elapsed = monotonic() - started
+        after = scrape(args.metrics_port)
+        report(args, stats, elapsed, resources, generator, before, after)
+    finally:
+        for task in drivers:
+            task.cancel()
+        if manager.returncode is None:
+            manager.terminate()
+            await manager.wait()
+        for server in servers:
+            server.close()
+        for worker in workers:
+            worker.terminate()
+
+
+def report(args, stats: Stats, elapsed: float, resources: list, generator: list, before: dict, after: dict):
+    ordered = sorted(stats.latencies)
+    lost = stats.sent - stats.received - stats.timeouts - stats.failures
+    print()
+    print(f"{args.agents} agents, {args.apps} apps, {args.rate:g} commands/s offered for {elapsed:.1f}s")
+    print(f"  throughput   {stats.received / elapsed:10.1f} replies/s")
+    print(f"  sent         {stats.sent:10}   timeouts {stats.timeouts}   failures {stats.failures}   unanswered {lost}")
+    print("  latency ms  " + "".join(
+        f"  {name} {percentile(ordered, fraction) * 1e3:.2f}"
+        for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p99.9", 0.999), ("max", 1.0))
+    ))
+    if resources:
+        cpu = [sample[0] for sample in resources]
+        rss = [sample[1] for sample in resources]
+        print(f"  cpu %        {sum(cpu) / len(cpu):10.1f} mean   {max(cpu):.1f} max")
+        print(f"  rss MB       {rss[-1]:10.1f} last   {max(rss):.1f} max")
+    if generator:
+        print(f"  generator %  {sum(generator) / len(generator):10.1f} mean cpu over {args.workers + 1} processes")
+    if after:
+        for label, peer, direction in (("agent in", "agent", "in"), ("app in", "app", "in")):
+            key = f'lazy_messages_total{{peer="{peer}",direction="{direction}"}}'
+            print(f"  {label:<12} {(after.get(key, 0) - before.get(key, 0)) / elapsed:10.1f} messages/s (manager)")
+        for path in ("app_to_agent", "agent_to_app"):
+            print(f"  {path:<12} {forward_mean(after, path) * 1e6:10.1f} us mean forward time (manager)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load a lazy manager with a simulated fleet")
+    parser.add_argument("--agents", type=int, default=500, help="Fake agents to start")
+    parser.add_argument("--workers", type=int, default=max(1, min(8, (os.cpu_count() or 2) - 2)),
+                        help="Processes the fake agents are spread over")
+    parser.add_argument("--apps", type=int, default=2, help="Simulated apps driving commands")
+    parser.add_argument("--rate", type=float, default=200, help="Commands per second over all apps")
+    parser.add_argument("--commands", nargs="*", default=["ping"], help="Commands the apps pick from at random")
+    parser.add_argument("--delay", type=float, default=0.0, help="Seconds an agent takes to reply")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +- seconds on top of the delay")
+    parser.add_argument("--ttl", type=float, default=10, help="Deadline the apps give each command")
+    parser.add_argument("--duration", type=int, default=20, help="Seconds to measure")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds of traffic before measuring")
+    parser.add_argument("--connect-timeout", type=float, default=60, help="Seconds to wait for the fleet to connect")
+    parser.add_argument("--agent-base", default="127.1.0.1", help="First agent address")
+    parser.add_argument("--app-base", default="127.2.0.1", help="First app address")
+    parser.add_argument("--metrics-port", type=int, default=9109, help="Metrics port for the manager under test")
+    parser.add_argument("--quiet", action="store_true", help="Hide the manager's log")
+    parser.add_argument("manager_args", nargs=argparse.REMAINDER, help="Extra manager flags after --")
+    args = parser.parse_args()
+    if args.manager_args[:1] == ["--"]:
+        args.manager_args = args.manager_args[1:]
+
+    asyncio.run(run(args))
@@ -1,96 +1,360 @@
-from distutils import command
-import json
-from lazy_logging import get_logger
-from connection_manager import ConnectionManager, App, Agent
+import os
+import asyncio
+import argparse
+import metrics
+import protocol
+from channels import CONTROL, BULK, command_channel
+from protocol import ProtocolError
+from lazy_logging import configure, get_logger
+from connection_manager import ConnectionManager, App, Agent, Peer
 from device_manager import DeviceManager
+from egm import EGM, RemoteEGM
+from fan_out import FanOut
+from fleet_update import Build, FleetUpdate
+from inflight import InFlight, Request
+from outbox import Overflow
+from pathlib import Path
+from websockets import ConnectionClosed
 
 logger = get_logger("LazyManager")
+
+FORWARD_TO_APP = metrics.FORWARD_SECONDS.labels("agent_to_app")
+FORWARD_TO_AGENT = metrics.FORWARD_SECONDS.labels("app_to_agent")
 # def is_network_adapter_active(self, adapter_name):
 #     net_if_stats = psutil.net_if_stats()
 #     if adapter_name in net_if_stats:
 #         return net_if_stats[adapter_name].isup
 #     return False
 
+# Files the manager keeps across restarts
+DATA_DIR = Path(os.environ.get("LAZY_DATA_DIR", Path(__file__).resolve().parent / "data"))
+
 AGENT_PORT = 8765
 APP_PORT = 8767
 
-AGENT_IPS = [f"10.0.0.{i}" for i in range(2, 28)]
-AGENT_IPS.remove("10.0.0.3")  # Exclude POS terminal
+AGENT_IPS = ["10.0.0.2-10.0.0.27"]
+EXCLUDE_IPS = ["10.0.0.3"]  # POS terminal
 
 # AGENT_IPS = ["127.0.0.1"] # For testing purposes
 
 
 class LazyManager(ConnectionManager):
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, agent_port=AGENT_PORT, app_port=APP_PORT, agent_ips=AGENT_IPS, **kwargs)
-        self.device_manager = DeviceManager()
+    def __init__(self, agent_ips=None, registry=None, builds=None, update_key=None, **kwargs):
+        super().__init__(
+            agent_port=AGENT_PORT,
+            app_port=APP_PORT,
+            agent_ips=agent_ips or AGENT_IPS,
+            exclude_ips=EXCLUDE_IPS,
+            **kwargs,
+        )
+        self.device_manager = DeviceManager(shard=self.shard, registry=registry)
+        # Builds are only pushed from here, signed with the key the agents share
+        self.builds = Path(builds or DATA_DIR / "builds").resolve()
+        self.update_key = update_key
+        # Apps on other shards that sent commands to our devices, and the peer they came through
+        self.remote_apps: dict[str, Peer] = {}
+        self.job_tasks: set[asyncio.Task] = set()  # The loop only keeps weak references to tasks
+        self.inflight = InFlight(self.on_timeout)
+        # Agents older than CORRELATED reply without a cid, remember the last one
+        # sent per (device, sender) and put it back on their reply. They may
+        # answer out of order, so app commands to them get no deadline.
+        self.legacy_cids: dict[tuple[str, str], str] = {}
 
-    async def handle_agent_message(self, message: str, agent: Agent):
-        data = json.loads(message)
+    async def loop_forever(self):
+        await asyncio.gather(super().loop_forever(), self.device_manager.run())
 
-        if "app_ip" in data:
-            app_ip = data["app_ip"]
-            app = self.apps.get(app_ip, None)
+    async def handle_agent_message(self, message: str, agent: Agent, channel=CONTROL):
+        routed = protocol.split_route(message)
+        if routed:
+            with FORWARD_TO_APP.time():
+                await self.forward_to_app(routed.target, routed.payload, agent.ip, routed.cid, channel)
+            return
 
-            if app:
-                logger.info(f"Forwarding result from device {agent.ip} to app {app.ip}")
-                data.update(sender_ip=agent.ip)
-                await app.send(json.dumps(data))
-            else:
-                logger.warning(f"App '{app_ip}' not found for forwarding result of device {agent.ip}")
-            
+        try:
+            data = protocol.decode(message)
+        except ProtocolError as e:
+            logger.warning(f"Dropping invalid message from {agent}: {e}")
+            return
+
+        if "app_ip" in data:
+            await self.forward_to_app(data.pop("app_ip"), data, agent.ip)
             return
 
+        if data["command"] == "register":
+            agent.protocol = protocol.negotiate(data.get("protocol"))
+            agent.outbox.enabled = agent.protocol >= protocol.CHANNELS
+
         await self.device_manager.handle(agent, data)
 
-    async def handle_app_message(self, message: str, app: App):
-        data = json.loads(message)
-        
+    async def forward_to_app(self, app_ip: str, payload: str | dict, sender_ip: str, cid: str = None, channel=CONTROL):
+        restored = cid is None and (sender_ip, app_ip) in self.legacy_cids
+        if restored:
+            cid = self.legacy_cids.pop((sender_ip, app_ip))
+        request = self.inflight.resolve(sender_ip, app_ip, cid, payload)
+        if request and request.future:
+            return  # A fan-out job collects its replies itself
+
+        app = self.apps.get(app_ip, None)
+        if not app:
+            peer = self.remote_apps.get(app_ip)
+            if peer:
+                if isinstance(payload, dict):
+                    payload = protocol.dumps(payload)
+                await peer.send(protocol.route(app_ip, payload, sender_ip, cid))
+                return
+            logger.warning(f"App '{app_ip}' not found for forwarding result of device {sender_ip}")
+            return
+
+        if cid is not None and not request and not restored:
+            # The app was already told this one timed out
+            logger.debug("Dropping late reply", extra={"device": sender_ip, "app": app_ip, "cid": cid})
+            return
+
+        logger.debug("Forwarding result", extra={"device": sender_ip, "app": app_ip, "cid": cid})
+        if app.protocol >= protocol.ROUTED:
+            if isinstance(payload, dict):
+                payload = protocol.dumps(payload)
+            await app.send(protocol.route(app_ip, payload, sender_ip, cid), channel)
+            return
+
+        data = payload if isinstance(payload, dict) else protocol.decode(payload)
+        data.update(app_ip=app_ip, sender_ip=sender_ip)
+        await app.send(protocol.dumps(data))
+
+    async def forward_to_agent(self, device: EGM, payload: str | dict, sender_ip: str, cid: str = None, channel=None):
+        if channel is None:
+            channel = command_channel(payload["command"] if isinstance(payload, dict) else protocol.peek_command(payload))
+
+        if device.agent.protocol >= protocol.ROUTED:
+            if isinstance(payload, dict):
+                payload = protocol.dumps(payload)
+            if device.agent.protocol < protocol.CORRELATED:
+                self.stash_cid(device, sender_ip, cid)
+                cid = None
+            await device.agent.send(protocol.route(device.ip, payload, sender_ip, cid), channel)
+            return
+
+        self.stash_cid(device, sender_ip, cid)
+        data = payload if isinstance(payload, dict) else protocol.decode(payload)
+        data.update(sender_ip=sender_ip)
+        await device.agent.send(protocol.dumps(data))
+
+    async def handle_app_message(self, message: str, app: App, channel=CONTROL):
+        routed = protocol.split_route(message)
+        if routed:
+            target, message = routed.target, routed.payload
+            device = self.device_manager.devices.get(target, None)
+            if device and device.agent:
+                if routed.cid is not None and not await self.track(device, app, routed):
+                    return
+                with FORWARD_TO_AGENT.time():
+                    # Apps without channels send everything on CONTROL, sort their input out here
+                    await self.forward_to_agent(device, message, app.ip, routed.cid, channel or None)
+                return
+
+        try:
+            data = protocol.decode(message)
+        except ProtocolError as e:
+            logger.warning(f"Rejecting invalid message from {app}: {e}")
+            await app.send(protocol.encode("manager", "error", result=f"Invalid message - {e}"))
+            return
+
+        if data['command'] == "register":
+            app.protocol = protocol.negotiate(data.get("protocol"))
+            app.outbox.enabled = app.protocol >= protocol.CHANNELS
+            return
+
         if data['command'] == "device_info":
-            logger.info(f"Listing {len(self.device_manager.devices)} devices for app {app.ip}")
-            
-            for egm in self.device_manager.devices.values():
-                message = {
-                    "sender": "manager",
-                    "command": "device_info",
-                    "result": egm.serialize()
-                }
-                await app.send(json.dumps(message))
-            return
-
-        target = data.get("target")
+            snapshot = self.device_manager.snapshot(data.get("since"), data.get("epoch"))
+            logger.info(f"Sending {len(snapshot['result'])} of {len(self.device_manager.devices)} devices to app {app.ip}")
+            await app.send(protocol.encode("manager", "device_info", **snapshot))
+            return
+
+        if data['command'] == "subscribe":
+            match = {key: data[key] for key in ("site", "type") if data.get(key)}
+            self.device_manager.subscribe(app, match)
+            snapshot = self.device_manager.snapshot(data.get("since"), data.get("epoch"), match)
+            await app.send(protocol.encode("manager", "device_info", **snapshot))
+            return
+
+        if data['command'] == "unsubscribe":
+            self.device_manager.unsubscribe(app)
+            return
+
+        if data['command'] == "query":
+            try:
+                page = self.device_manager.query(data.get("where"), data.get("limit"), data.get("after"))
+            except ValueError as e:
+                await app.send(protocol.encode("manager", "error", result=f"Invalid query - {e}"))
+                return
+            await app.send(protocol.encode("manager", "query", **page), BULK)
+            return
+
+        if data['command'] == "fan_out":
+            devices = self.device_manager.select(data["select"])
+            job = FanOut(app, data["action"], devices, data.get("args"))
+            self.start_job(job)
+            return
+
+        if data['command'] == "push_update":
+            path = (self.builds / data["path"]).resolve()
+            if not self.update_key:
+                problem = "updates are not enabled on this manager"
+            elif not path.is_relative_to(self.builds):
+                problem = f"builds are only pushed from {self.builds}"
+            else:
+                problem = None
+            if problem:
+                await app.send(protocol.encode("manager", "error", result=f"Cannot push {data['path']} - {problem}"))
+                return
+            try:
+                build = await asyncio.to_thread(Build.read, path)
+            except OSError as e:
+                await app.send(protocol.encode("manager", "error", result=f"Cannot read build - {e}"))
+                return
+            devices = self.device_manager.select(data["select"])
+            job = FleetUpdate(app, build, devices, self.device_manager.devices.get, self.update_key)
+            self.start_job(job)
+            return
+
+        target = target if routed else data.pop("target", None)
         device = self.device_manager.devices.get(target, None)
-        if not device:
-            logger.warning(f"Device {target} not found for command {data['command']}")
-            message  = dict(
-                sender="manager",
-                result=f"Device {target} not found",
-                **data
-            )
-            await app.send(json.dumps(message))
+        if not device or not device.agent:
+            problem = "not connected" if device else "not found"
+            logger.warning(f"Device {target} {problem} for command {data['command']}")
+            reply = protocol.encode("manager", data["command"], target=target, result=f"Device {target} {problem}")
+            if routed and routed.cid is not None:
+                reply = protocol.route(app.ip, reply, target, routed.cid)
+            await app.send(reply)
+            return
+
+        await self.forward_to_agent(device, data, app.ip)
+
+    def stash_cid(self, device: EGM, sender_ip: str, cid: str | None):
+        if cid is not None:
+            self.legacy_cids[(device.ip, sender_ip)] = cid
+
+    async def track(self, device: EGM, app: App, routed: protocol.Route) -> bool:
+        if device.agent.protocol < protocol.CORRELATED:
+            return True
+
+        if self.inflight.add(device.ip, app.ip, routed.cid, protocol.peek_command(routed.payload), routed.ttl):
+            return True
+
+        reply = protocol.encode("manager", "timeout", result="Too many commands in flight")
+        await app.send(protocol.route(app.ip, reply, device.ip, routed.cid))
+        return False
+
+    async def on_timeout(self, request: Request):
+        logger.warning("No reply in time", extra={"device": request.device_ip, "command": request.command,
+                                                  "app": request.reply_to, "cid": request.cid})
+        app = self.apps.get(request.reply_to)
+        if not app:
+            return
+
+        reply = protocol.encode("manager", "timeout", result="Timeout")
+        try:
+            await app.send(protocol.route(app.ip, reply, request.device_ip, request.cid))
+        except ConnectionClosed:
+            pass
+
+    def start_job(self, job: FanOut):
+        task = asyncio.create_task(job.run(self.forward_to_agent, self.inflight))
+        self.job_tasks.add(task)
+        task.add_done_callback(self.job_tasks.discard)
+
+    async def handle_peer_message(self, message: str, peer: Peer):
+        routed = protocol.split_route(message)
+        if routed:
+            target, sender_ip, payload, cid, _ = routed
+            device = self.device_manager.devices.get(target)
+            if device and not isinstance(device, RemoteEGM):
+                self.remote_apps[sender_ip] = peer
+                if device.agent:
+                    await self.forward_to_agent(device, payload, sender_ip, cid)
+                else:
+                    command = protocol.peek_command(payload)
+                    logger.warning(f"Device {target} not connected for command {command} from {sender_ip}")
+                    reply = protocol.encode("manager", command, target=target, result=f"Device {target} not connected")
+                    await peer.send(protocol.route(sender_ip, reply, target, cid))
+            else:
+                await self.forward_to_app(target, payload, sender_ip, cid)  # A reply for an app or job on this shard
             return
 
-        data.update(sender_ip=app.ip)
-        await device.agent.send(json.dumps(data))
+        data = protocol.decode(message)
+        if data["command"] in ("device_info", "device_update"):
+            self.device_manager.merge_remote(peer, data["result"], full=bool(data.get("full")))
+
+    async def on_peer_connect(self, peer: Peer):
+        logger.info(f"Linked to {peer}")
+        local = {"shard": self.shard}
+        peer.resync = lambda since: protocol.encode(
+            "manager", "device_info", **self.device_manager.snapshot(since, self.device_manager.epoch, local)
+        )
+        self.device_manager.subscribe(peer, local)
+        await peer.send(peer.resync(None))
+
+    async def on_peer_disconnect(self, peer: Peer):
+        self.device_manager.peer_lost(peer)
+        # Apps behind it are learned again from their next command
+        for app_ip in [app_ip for app_ip, via in self.remote_apps.items() if via is peer]:
+            del self.remote_apps[app_ip]
 
     async def on_agent_connect(self, agent: Agent):
         logger.info(f"Agent connected: {agent}")
-        message = {
-            "sender": "manager",
-            "command": "register",
-        }
-        await agent.send(json.dumps(message))
+        await agent.send(protocol.encode("manager", "register", protocol=protocol.PROTOCOL_VERSION))
+
+    async def on_agent_disconnect(self, agent: Agent):
+        self.device_manager.disconnected(agent)
+
+    async def on_app_disconnect(self, app: App):
+        self.device_manager.unsubscribe(app)
 
     async def on_app_connect(self, app: App):
         logger.info(f"App connected: {app}")
-        message = {
-            "sender": "manager",
-            "command": "register",
-        }
-        await app.send(json.dumps(message))
+        await app.send(protocol.encode("manager", "register", protocol=protocol.PROTOCOL_VERSION))
 
 
 if __name__ == "__main__":
-    server = LazyManager()
+    parser = argparse.ArgumentParser(description="Lazy manager")
+    parser.add_argument("--agents", nargs="*", help="Agent IPs, CIDR blocks or ranges (e.g. 10.0.0.0/22)")
+    parser.add_argument("--apps", nargs="*", help="App IPs to connect to without waiting for zeroconf")
+    parser.add_argument("--log-level", help="Log levels, e.g. INFO,Outbox=DEBUG (default from LAZY_LOG_LEVEL)")
+    parser.add_argument("--max-connects", type=int, default=64, help="Concurrent agent connection attempts")
+    parser.add_argument("--metrics-port", type=int, default=9108, help="Port for the /metrics endpoint, 0 to disable")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Interface for the /metrics endpoint, 0.0.0.0 for all")
+    parser.add_argument("--shard", help="Name of this manager when running several shards")
+    parser.add_argument("--peer-port", type=int, default=8770, help="Port other shards connect to")
+    parser.add_argument("--peers", nargs="*", default=[], help="Other shards as name=ws://host:port")
+    parser.add_argument("--registry", help=f"File the device list is kept in across restarts, empty to disable (default devices[-<shard>].db in {DATA_DIR})")
+    parser.add_argument("--builds", help=f"Directory push_update takes agent builds from (default builds in {DATA_DIR}), "
+                                          "signed with the key in LAZY_UPDATE_KEY")
+    parser.add_argument("--outbox-size", type=int, default=256, help="Messages queued per connection before overflow")
+    overflows = [overflow.value for overflow in Overflow]
+    parser.add_argument("--agent-overflow", choices=overflows, default="coalesce", help="What to do when an agent queue is full")
+    parser.add_argument("--app-overflow", choices=overflows, default="coalesce", help="What to do when an app queue is full")
+    args = parser.parse_args()
+    if args.log_level:
+        configure(levels=args.log_level)
+    registry = args.registry
+    if registry is None:
+        registry = str(DATA_DIR / (f"devices-{args.shard}.db" if args.shard else "devices.db"))
+
+    server = LazyManager(
+        agent_ips=args.agents,
+        app_ips=args.apps,
+        registry=registry or None,
+        builds=args.builds,
+        update_key=os.environ.get("LAZY_UPDATE_KEY"),
+        max_connects=args.max_connects,
+        metrics_port=args.metrics_port,
+        metrics_host=args.metrics_host,
+        shard=args.shard,
+        peer_port=args.peer_port if args.shard else None,
+        peers=dict(peer.split("=", 1) for peer in args.peers),
+        outbox_size=args.outbox_size,
+        agent_overflow=args.agent_overflow,
+        app_overflow=args.app_overflow,
+    )
     server.start()
@@ -0,0 +1,214 @@
+import asyncio
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from time import perf_counter
+from lazy_logging import get_logger
+
+logger = get_logger("Metrics")
+
+
+class Metric(ABC):
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    # What is kept per combination of label values
+    @abstractmethod
+    def new_child(self):
+        ...
+
+    def format_labels(self, values, extra=()) -> str:
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        for values, child in self.children.items():
+            yield self.name, self.format_labels(values), child.value
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {value}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def new_child(self):
+        return Value()
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    # A gauge may instead read its values on scrape: collect() returns either
+    # a number or a {label values tuple: number} dict
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self.collect = collect
+
+    def new_child(self):
+        return Value()
+
+    def samples(self):
+        if not self.collect:
+            yield from super().samples()
+            return
+
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name, self.format_labels(label_values), value
+
+
+class Observations:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+
+class Timer:
+    __slots__ = ("observations", "start")
+
+    def __init__(self, observations: Observations):
+        self.observations = observations
+
+    def __enter__(self):
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        self.observations.observe(perf_counter() - self.start)
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labels)
+
+    def new_child(self):
+        return Observations(self.buckets)
+
+    def samples(self):
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+                cumulative += count
+                yield f"{self.name}_bucket", self.format_labels(values, [("le", bound)]), cumulative
+            yield f"{self.name}_sum", self.format_labels(values), child.sum
+            yield f"{self.name}_count", self.format_labels(values), child.count
+
+
+REGISTRY: list[Metric] = []
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+MESSAGES = Counter("lazy_messages_total", "Websocket messages by peer and direction", ("peer", "direction"))
+BYTES = Counter("lazy_bytes_total", "Websocket payload bytes by peer and direction", ("peer", "direction"))
+FORWARD_SECONDS = Histogram("lazy_forward_seconds", "Time to forward a message between app and agent", ("path",))
+CONNECT_ATTEMPTS = Counter("lazy_connect_attempts_total", "Outgoing connection attempts", ("peer",))
+CONNECT_FAILURES = Counter("lazy_connect_failures_total", "Outgoing connection attempts that failed", ("peer",))
+LOOP_LAG = Histogram("lazy_event_loop_lag_seconds", "How late the event loop ran a timer")
+
+AGENT_IN, AGENT_OUT = MESSAGES.labels("agent", "in"), MESSAGES.labels("agent", "out")
+APP_IN, APP_OUT = MESSAGES.labels("app", "in"), MESSAGES.labels("app", "out")
+AGENT_BYTES_IN, AGENT_BYTES_OUT = BYTES.labels("agent", "in"), BYTES.labels("agent", "out")
+APP_BYTES_IN, APP_BYTES_OUT = BYTES.labels("app", "in"), BYTES.labels("app", "out")
+
+
+async def watch_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    lag = LOOP_LAG.labels()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag.observe(max(0.0, loop.time() - start - interval))
+
+
+async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass  # Headers are not needed
+
+        parts = request.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug(f"Metrics request failed: {e}")
+    finally:
+        writer.close()
+
+
+async def start(host="127.0.0.1", port=9108) -> asyncio.Server:
+    server = await asyncio.start_server(handle_request, host, port)
+    port = server.sockets[0].getsockname()[1]  # The one picked for port 0
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+async def serve(host="127.0.0.1", port=9108):
+    server = await start(host, port)
+    async with server:
+        await asyncio.gather(server.serve_forever(), watch_loop_lag())
@@ -0,0 +1,158 @@
+import asyncio
+import weakref
+import metrics
+import protocol
+from channels import Channels, CONTROL
+from enum import Enum
+from websockets import ConnectionClosed
+from lazy_logging import get_logger
+
+logger = get_logger("Outbox")
+
+
+class Overflow(Enum):
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    COALESCE = "coalesce"  # Merge bursts of the same command, then drop oldest
+    BLOCK = "block"  # Make the sender wait for room
+
+
+def merge_mouse_move(older: dict, newer: dict) -> dict:
+    if "dx" in newer or "dy" in newer:
+        newer["dx"] = older.get("dx", 0) + newer.get("dx", 0)
+        newer["dy"] = older.get("dy", 0) + newer.get("dy", 0)
+    return newer  # Replies only need the latest one
+
+
+def merge_device_update(older: dict, newer: dict) -> dict:
+    records = {record["ip"]: record for record in older["result"]}
+    for record in newer["result"]:
+        records[record["ip"]] = {**records.get(record["ip"], {}), **record}
+    newer["result"] = list(records.values())
+    return newer
+
+
+# Commands whose messages can be merged with the one queued right before them
+MERGERS = {"mouse_move": merge_mouse_move, "device_update": merge_device_update}
+
+
+def coalesce_key(message: str) -> tuple | None:
+    # Only messages between the same two ends are merged, merge keeps one route
+    routed = protocol.split_route(message)
+    if routed:
+        if routed.cid is not None:
+            return None  # Someone is waiting for this exact reply
+        message = routed.payload
+    command = protocol.peek_command(message)
+    if command not in MERGERS:
+        return None
+    return (command, routed.target, routed.sender) if routed else (command, None, None)
+
+
+def merge(older: str, newer: str) -> str:
+    routed = protocol.split_route(newer)
+    if routed:
+        old, new = protocol.loads(protocol.split_route(older).payload), protocol.loads(routed.payload)
+    else:
+        old, new = protocol.loads(older), protocol.loads(newer)
+
+    merged = protocol.dumps(MERGERS[new["command"]](old, new))
+    return protocol.route(routed.target, merged, routed.sender) if routed else merged
+
+
+OUTBOXES = weakref.WeakSet()
+
+
+def depths() -> dict:
+    totals = {}
+    for outbox in OUTBOXES:
+        totals[(outbox.kind,)] = totals.get((outbox.kind,), 0) + len(outbox)
+    return totals
+
+
+DEPTH = metrics.Gauge("lazy_outbox_depth", "Messages waiting in outgoing queues", ("peer",), collect=depths)
+DROPPED = metrics.Counter("lazy_outbox_dropped_total", "Outgoing messages dropped because a queue was full", ("peer",))
+COALESCED = metrics.Counter("lazy_outbox_coalesced_total", "Outgoing messages merged into a queued one", ("peer",))
+
+
+class Outbox(Channels):
+
+    # Outgoing messages for one connection. Senders only append here and a
+    # single writer task talks to the socket, so a slow peer fills its own
+    # queues instead of stalling whoever is forwarding to it. Each channel's
+    # queue holds up to limit messages and overflows by the same policy.
+    # on_drop and on_sent are called with each message dropped or written.
+    def __init__(self, connection, kind: str, limit=256, overflow=Overflow.DROP_OLDEST, enabled=False,
+                 on_drop=None, on_sent=None):
+        super().__init__(connection.send, enabled)
+        self.connection = connection
+        self.kind = kind
+        self.limit = limit
+        self.overflow = Overflow(overflow)
+        self.on_drop = on_drop
+        self.on_sent = on_sent
+        self.space = asyncio.Event()
+        self.error: ConnectionClosed | None = None
+        self.sent_messages, self.sent_bytes = metrics.MESSAGES.labels(kind, "out"), metrics.BYTES.labels(kind, "out")
+        self.dropped, self.coalesced = DROPPED.labels(kind), COALESCED.labels(kind)
+        self.start()
+        OUTBOXES.add(self)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def put(self, message: str, channel=CONTROL):
+        if self.error:
+            raise self.error
+
+        queue = self.queue(channel)
+        key = None
+        if self.overflow is Overflow.COALESCE:
+            key = coalesce_key(message)
+            if key and queue and queue[-1][0] == key and queue[-1][2] == 0:
+                queue[-1][1] = merge(queue[-1][1], message)
+                self.coalesced.inc()
+                return
+
+        while len(queue) >= self.limit:
+            if self.overflow is Overflow.BLOCK:
+                self.space.clear()
+                await self.space.wait()
+                if self.error:
+                    raise self.error
+                continue
+            self.dropped.inc()
+            partly_sent = queue[0][2] > 0  # It has to be finished
+            if self.overflow is Overflow.DROP_NEWEST or (partly_sent and len(queue) == 1):
+                if self.on_drop:
+                    self.on_drop(message)
+                return
+            dropped = 1 if partly_sent else 0
+            if self.on_drop:
+                self.on_drop(queue[dropped][1])
+            del queue[dropped]
+
+        self.put_nowait(message, channel, key)
+
+    def sent(self, message: str):
+        self.space.set()
+        self.sent_messages.inc()
+        self.sent_bytes.inc(len(message))
+        if self.on_sent:
+            self.on_sent(message)
+
+    async def run(self):
+        try:
+            await super().run()
+        except ConnectionClosed as e:
+            self.error = e
+        finally:
+            self.error = self.error or ConnectionClosed(None, None)
+            if len(self):
+                logger.debug(f"Discarding {len(self)} unsent {self.kind} messages")
+                for queue in self.queues.values():
+                    queue.clear()
+            self.space.set()
+
+    def close(self):
+        self.writer.cancel()
@@ -0,0 +1,300 @@
+import json
+import math
+from functools import partial
+from typing import NamedTuple
+
+# Bump when the wire format changes. Both ends announce their version in
+# "register" and speak the lower of the two.
+#   1: validated JSON messages
+#   2: routed frames, "@<target> <sender>\n<payload>"
+#   3: routed frames may carry a correlation id and a deadline in seconds,
+#      "@<target> <sender> <cid> <ttl>\n<payload>"
+#   4: logical channels with priorities and flow control, see channels.py
+#   5: agents send "telemetry" frames to the managers they registered with
+PROTOCOL_VERSION = 5
+ROUTED = 2
+CORRELATED = 3
+CHANNELS = 4
+TELEMETRY = 5
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def _load_backends() -> dict:
+    backends = {"json": (partial(json.dumps, separators=(",", ":")), json.loads)}
+
+    try:
+        import orjson
+        backends["orjson"] = (lambda obj: orjson.dumps(obj).decode(), orjson.loads)
+    except ImportError:
+        pass
+
+    try:
+        import msgspec
+        encoder = msgspec.json.Encoder()
+        backends["msgspec"] = (lambda obj: encoder.encode(obj).decode(), msgspec.json.Decoder().decode)
+    except ImportError:
+        pass
+
+    return backends
+
+
+BACKENDS = _load_backends()
+BACKEND = next(name for name in ("msgspec", "orjson", "json") if name in BACKENDS)
+dumps, loads = BACKENDS[BACKEND]
+
+
+class Field:
+    __slots__ = ("types", "required")
+
+    def __init__(self, *types, required=True):
+        self.types = types
+        self.required = required
+
+    def check(self, command: str, name: str, value):
+        if value is None and not self.required:
+            return
+        if self.types and not isinstance(value, self.types):
+            raise ProtocolError(f"{command}: field '{name}' has type {type(value).__name__}")
+
+
+def optional(*types) -> Field:
+    return Field(*types, required=False)
+
+
+Number = (int, float)
+
+# Fields every message from a given sender may carry, on top of its command's own fields
+ENVELOPE = {
+    "manager": {"result": optional()},
+    "app": {"target": optional(str)},
+    "egm": {"result": optional(), "app_ip": optional(str), "sender_ip": optional(str)},
+}
+
+# Each command's message struct, keyed by who sends it. Commands that are not
+# declared are passed through untouched so new agent commands keep working.
+MESSAGES = {
+    "manager": {
+        "register": {"protocol": optional(int)},
+        "ping": {},
+        "device_info": {
+            "epoch": optional(str),
+            "version": optional(int),
+            "full": optional(bool),
+            "unchanged": optional(bool),
+            "result": optional(list),
+        },
+        "device_update": {"epoch": Field(str), "version": Field(int), "result": Field(list)},
+        "hello": {"shard": Field(str)},
+        "timeout": {},
+        "query": {
+            "epoch": Field(str),
+            "version": Field(int),
+            "total": Field(int),
+            "next": optional(str),
+            "result": Field(list),
+        },
+        "fan_out": {
+            "job": Field(str),
+            "action": Field(str),
+            "total": Field(int),
+            "done": Field(int),
+            "failed": Field(int),
+            "finished": Field(bool),
+            "results": Field(dict),
+            "progress": optional(dict),
+        },
+    },
+    "app": {
+        "register": {"protocol": optional(int)},
+        "device_info": {"since": optional(int), "epoch": optional(str)},
+        "subscribe": {"since": optional(int), "epoch": optional(str), "site": optional(str), "type": optional(str)},
+        "unsubscribe": {},
+        "query": {"where": optional(dict), "limit": optional(int), "after": optional(str)},
+        "fan_out": {"action": Field(str), "select": Field(dict), "args": optional(dict)},
+        "mouse_move": {"dx": Field(*Number), "dy": Field(*Number)},
+        "key_press": {"key": Field(str)},
+        "process_status": {"names": optional(list)},
+        "push_update": {"path": Field(str), "select": Field(dict)},
+        "update_offer": {
+            "build": Field(str),
+            "size": Field(int),
+            "chunk_size": Field(int),
+            "chunks": Field(list),
+            "signature": optional(str),
+        },
+        "update_chunk": {"build": Field(str), "index": Field(int), "data": Field(str)},
+        "update_commit": {"build": Field(str)},
+        "tail_log": {
+            "path": Field(str),
+            "pattern": optional(str),
+            "level": optional(str),
+            "backlog": optional(int),
+            "rate": optional(int),
+            "lease": optional(*Number),
+        },
+        "stop_tail": {"path": Field(str)},
+        "screen_stream": {"max_width": optional(int), "codecs": optional(list), "lease": optional(*Number)},
+        "screen_ack": {"frame": Field(int)},
+        "screen_stop": {},
+    },
+    "egm": {
+        "register": {"result": Field(dict), "protocol": optional(int)},
+        "ping": {},
+        "update_offer": {"have": optional(list)},
+        "tail_log": {"offset": optional(int)},
+        "log_lines": {"path": Field(str), "lines": Field(list), "offset": Field(int), "skipped": optional(int)},
+        "screen_stream": {"codec": optional(str)},
+        "screen_frame": {
+            "frame": Field(int),
+            "width": Field(int),
+            "height": Field(int),
+            "codec": Field(str),
+            "tiles": Field(list),
+            "full": optional(bool),
+        },
+        "telemetry": {
+            "cpu": optional(*Number),
+            "memory": optional(*Number),
+            "disk": optional(*Number),
+            "uptime": optional(*Number),
+            "processes": optional(dict),
+        },
+    },
+}
+
+
+def negotiate(theirs) -> int:
+    return min(PROTOCOL_VERSION, theirs if isinstance(theirs, int) else 0)
+
+
+def validate(data) -> dict:
+    if not isinstance(data, dict):
+        raise ProtocolError(f"Expected an object, got {type(data).__name__}")
+
+    sender, command = data.get("sender"), data.get("command")
+    if sender not in MESSAGES:
+        raise ProtocolError(f"Unknown sender {sender!r}")
+    if not isinstance(command, str):
+        raise ProtocolError("Missing command")
+
+    for fields in (ENVELOPE[sender], MESSAGES[sender].get(command, {})):
+        for name, field in fields.items():
+            if name in data:
+                field.check(command, name, data[name])
+            elif field.required:
+                raise ProtocolError(f"{command}: missing field '{name}'")
+    return data
+
+
+def decode(message) -> dict:
+    try:
+        data = loads(message)
+    except Exception as e:
+        raise ProtocolError(f"Malformed message: {e}") from None
+    return validate(data)
+
+
+def encode(sender: str, command: str, **fields) -> str:
+    return dumps(dict(sender=sender, command=command, **fields))
+
+
+class Route(NamedTuple):
+    target: str
+    sender: str
+    payload: str
+    cid: str | None = None
+    ttl: float | None = None
+
+
+# Routed frames let the manager forward a payload by rewriting a one-line
+# header, without ever decoding the JSON behind it. Replies echo the request's
+# cid so the manager can match them to what is in flight.
+def route(target: str, payload: str, sender: str = "-", cid: str = None, ttl: float = None) -> str:
+    if cid is None:
+        return f"@{target} {sender}\n{payload}"
+    if ttl is None:
+        return f"@{target} {sender} {cid}\n{payload}"
+    return f"@{target} {sender} {cid} {ttl:g}\n{payload}"
+
+
+def split_route(frame) -> Route | None:
+    if not isinstance(frame, str) or not frame.startswith("@"):
+        return None
+    header, _, payload = frame.partition("\n")
+    fields = header[1:].split(" ")
+    if len(fields) < 2:
+        fields.append("-")
+    cid = fields[2] if len(fields) > 2 else None
+    try:
+        ttl = float(fields[3]) if len(fields) > 3 else None
+    except ValueError:
+        ttl = math.nan
+    if ttl is not None and not (math.isfinite(ttl) and ttl > 0):
+        raise ProtocolError(f"Malformed deadline in {header!r}")
+    return Route(fields[0], fields[1], payload, cid, ttl)
+
+
+def peek_command(payload: str) -> str:
+    # Finds the command of an encoded message without decoding it, for labels
+    # and logs only; encode() always writes it right after the sender
+    start = payload.find('"command":')
+    if start < 0:
+        return "-"
+    start = payload.find('"', start + 10) + 1
+    end = payload.find('"', start)
+    return payload[start:end] if 0 < start <= end else "-"
+
+
+def benchmark(number=20000):
+    from timeit import timeit
+
+    record = {
+        "ip": "10.0.0.12",
+        "id": 12,
+        "site": "warehouse",
+        "type": "vertical",
+        "bv_type": "JcmUba",
+        "status": "Online",
+        "lazy_egm_version": "1.0.2",
+    }
+    shapes = {
+        "mouse_move": dict(sender="app", command="mouse_move", target="10.0.0.12", dx=3.5, dy=-1.25),
+        "egm_reply": dict(sender="egm", command="mouse_move", result="Success", app_ip="10.0.0.200"),
+        "register": dict(sender="egm", command="register", protocol=1,
+                         result={"site": "warehouse", "bv_type": "JcmUba", "type": "vertical", "lazy_egm_version": "1.0.2"}),
+        "device_info(25)": dict(sender="manager", command="device_info", epoch="3f2a9c1d", version=25,
+                                full=True, result=[{**record, "id": i} for i in range(25)]),
+    }
+
+    print(f"{'message':<18}{'codec':<10}{'encode us':>12}{'decode us':>12}{'bytes':>8}")
+    for shape, message in shapes.items():
+        for name, (encoder, decoder) in BACKENDS.items():
+            raw = encoder(message)
+            encode_us = timeit(lambda: encoder(message), number=number) / number * 1e6
+            decode_us = timeit(lambda: validate(decoder(raw)), number=number) / number * 1e6
+            print(f"{shape:<18}{name:<10}{encode_us:>12.2f}{decode_us:>12.2f}{len(raw):>8}")
+
+    reply = shapes["egm_reply"]
+    plain = dumps(reply)
+    routed = route("10.0.0.200", dumps({key: value for key, value in reply.items() if key != "app_ip"}))
+
+    def reencode():
+        data = loads(plain)
+        data.update(sender_ip="10.0.0.12")
+        return dumps(data)
+
+    def reroute():
+        frame = split_route(routed)
+        return route(frame.target, frame.payload, "10.0.0.12", frame.cid)
+
+    print()
+    for name, forward in (("re-encode", reencode), ("routed", reroute)):
+        forward_us = timeit(forward, number=number) / number * 1e6
+        print(f"{'forward':<18}{name:<10}{forward_us:>12.2f}")
+
+
+if __name__ == "__main__":
+    benchmark()
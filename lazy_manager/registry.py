@@ -0,0 +1,66 @@
+import asyncio
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from lazy_logging import get_logger
+
+logger = get_logger("Registry")
+
+
+class Registry:
+
+    # Last known state of the local devices, so a restarted manager can serve
+    # them before the agents are back. Changes are collected and written in
+    # one transaction per FLUSH_INTERVAL on a worker thread.
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path: str):
+        self.path = path
+        self.dirty: dict[str, object] = {}
+        self.changed = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="registry")
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS devices (ip TEXT PRIMARY KEY, record TEXT NOT NULL)")
+        self.db.commit()
+
+    def load(self) -> list[dict]:
+        records = []
+        for ip, record in self.db.execute("SELECT ip, record FROM devices"):
+            try:
+                records.append(json.loads(record))
+            except ValueError as e:
+                logger.warning(f"Skipping unreadable record for {ip}: {e}")
+        logger.info(f"Loaded {len(records)} devices from {self.path}")
+        return records
+
+    def save(self, egm):
+        # Serialized at flush time, so a burst of changes is written once with its latest state
+        self.dirty[egm.ip] = egm
+        self.changed.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.changed.wait()
+            await asyncio.sleep(self.FLUSH_INTERVAL)
+            self.changed.clear()
+            dirty, self.dirty = self.dirty, {}
+
+            rows = [
+                (ip, json.dumps({**egm.serialize(), "last_seen": egm.last_seen, "version": egm.version}))
+                for ip, egm in dirty.items()
+            ]
+            try:
+                await loop.run_in_executor(self.executor, self.write, rows)
+            except sqlite3.Error as e:
+                logger.error(f"Could not save {len(rows)} devices: {e}")
+                for ip, egm in dirty.items():
+                    self.dirty.setdefault(ip, egm)
+                self.changed.set()
+
+    def write(self, rows: list[tuple[str, str]]):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO devices (ip, record) VALUES (?, ?)", rows)
@@ -0,0 +1,20 @@
+import pytest
+from channels import BULK, CONTROL, INPUT, Demux, frame, grant
+from protocol import ProtocolError
+
+
+@pytest.mark.parametrize("header", ["#3\n{}", "#-1\n{}", "#99+\n{}", "#x\n{}", "#3=100", "#-1=100"])
+def test_unknown_channels_are_rejected(header):
+    demux = Demux()
+    with pytest.raises(ProtocolError):
+        demux.feed(header)
+    assert not demux.consumed and not demux.buffers
+
+
+@pytest.mark.parametrize("channel", [CONTROL, INPUT, BULK])
+def test_known_channels_are_reassembled(channel):
+    demux = Demux()
+    if channel != CONTROL:
+        assert demux.feed(frame(channel, "ab", more=True)) is None
+        assert demux.feed(grant(channel, 10)) is None
+    assert demux.feed(frame(channel, "cd")) == (channel, "cd" if channel == CONTROL else "abcd")
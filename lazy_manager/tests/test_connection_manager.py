@@ -0,0 +1,31 @@
+import asyncio
+import websockets
+import connection_manager
+from connection_manager import ConnectionManager
+
+
+class Connection:
+
+    async def send(self, message: str):
+        raise websockets.ConnectionClosed(None, None)
+
+
+def test_agent_that_closes_during_connect_is_dropped(monkeypatch):
+    async def connect(*args, **kwargs):
+        return Connection()
+
+    async def on_agent_connect(agent):
+        await agent.connection.send("register")
+
+    async def main():
+        manager = ConnectionManager()
+        manager.connect_slots = asyncio.Semaphore(1)
+        manager.on_agent_connect = on_agent_connect
+        assert await manager._connect_to_agent("10.0.0.2") is None
+        await asyncio.sleep(0)
+        return manager, [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    monkeypatch.setattr(connection_manager.websockets, "connect", connect)
+    manager, tasks = asyncio.run(main())
+    assert manager.agents == {}
+    assert tasks == []  # The outbox writer is gone
@@ -0,0 +1,43 @@
+import math
+import asyncio
+import pytest
+import protocol
+from inflight import InFlight
+
+
+@pytest.mark.parametrize("ttl", ["nan", "inf", "-inf", "0", "-1", "soon"])
+def test_bad_deadlines_are_rejected(ttl):
+    with pytest.raises(protocol.ProtocolError):
+        protocol.split_route(f"@10.0.0.2 app 1 {ttl}\n{{}}")
+
+
+def test_good_deadline_is_kept():
+    assert protocol.split_route("@10.0.0.2 app 1 0.5\n{}").ttl == 0.5
+
+
+@pytest.mark.parametrize("ttl", [math.nan, math.inf, -1, 0, None])
+def test_bad_ttl_falls_back_to_the_default(ttl):
+    async def main():
+        inflight = InFlight(None)
+        request = inflight.add("10.0.0.2", "app", "1", ttl=ttl)
+        assert 0 < request.deadline - request.sent <= InFlight.MAX_TTL
+        inflight.task.cancel()
+
+    asyncio.run(main())
+
+
+def test_requests_expire_behind_a_nan_deadline():
+    async def main():
+        timeouts = []
+
+        async def on_timeout(request):
+            timeouts.append(request.cid)
+
+        inflight = InFlight(on_timeout)
+        inflight.add("10.0.0.2", "app", "nan", ttl=math.nan)
+        inflight.add("10.0.0.2", "app", "short", ttl=0.05)
+        await asyncio.sleep(0.3)
+        inflight.task.cancel()
+        return timeouts
+
+    assert asyncio.run(main()) == ["short"]
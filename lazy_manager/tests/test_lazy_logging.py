@@ -0,0 +1,20 @@
+import logging
+import lazy_logging
+
+
+class Counted:
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return "counted"
+
+
+def test_records_are_formatted_by_the_listener():
+    value = Counted()
+    record = logging.makeLogRecord({"msg": "value %s", "args": (value,)})
+    queued = lazy_logging.HANDLER.prepare(record)
+    assert value.formatted == 0
+    assert queued.getMessage() == "value counted"
@@ -0,0 +1,73 @@
+import re
+import asyncio
+import metrics
+from urllib.request import urlopen
+
+SAMPLE = re.compile(r'([a-z_]+)(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? (\S+)')
+
+
+def scrape() -> str:
+    async def main():
+        server = await metrics.start("127.0.0.1", 0)
+        lag = asyncio.create_task(metrics.watch_loop_lag(0.01))
+        await asyncio.sleep(0.05)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await asyncio.to_thread(lambda: urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read())
+        finally:
+            lag.cancel()
+            server.close()
+
+    metrics.AGENT_IN.inc(3)
+    with metrics.FORWARD_SECONDS.labels("test").time():
+        pass
+    return asyncio.run(main()).decode()
+
+
+def families(text: str) -> dict:
+    # {name: (type, {sample name with labels: value})}
+    found = {}
+    for line in text.splitlines():
+        if line.startswith("# HELP "):
+            continue
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split(" ")
+            found[name] = (kind, {})
+            continue
+        match = SAMPLE.fullmatch(line)
+        assert match, f"Malformed sample {line!r}"
+        family = next(name for name in found if match[1] == name or match[1].startswith(name + "_"))
+        found[family][1][match[1] + (match[2] or "")] = float(match[4])
+    return found
+
+
+def test_metrics_are_served_over_http():
+    found = families(scrape())
+
+    kind, samples = found["lazy_messages_total"]
+    assert kind == "counter"
+    assert samples['lazy_messages_total{peer="agent",direction="in"}'] >= 3
+
+    kind, samples = found["lazy_forward_seconds"]
+    assert kind == "histogram"
+    buckets = [value for name, value in samples.items() if name.startswith('lazy_forward_seconds_bucket{path="test"')]
+    assert buckets == sorted(buckets) and len(buckets) == len(metrics.Histogram.BUCKETS) + 1
+    assert buckets[-1] == samples['lazy_forward_seconds_count{path="test"}'] >= 1
+
+    kind, samples = found["lazy_event_loop_lag_seconds"]
+    assert kind == "histogram"
+    assert samples["lazy_event_loop_lag_seconds_count"] >= 1
+    assert samples['lazy_event_loop_lag_seconds_bucket{le="+Inf"}'] == samples["lazy_event_loop_lag_seconds_count"]
+
+
+def test_other_paths_are_not_found():
+    async def main():
+        server = await metrics.start("127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+        writer.write(b"GET / HTTP/1.1\r\n\r\n")
+        status = await reader.readline()
+        writer.close()
+        server.close()
+        return status
+
+    assert asyncio.run(main()).startswith(b"HTTP/1.1 404")
@@ -0,0 +1,19 @@
+import protocol
+from outbox import merge, merge_mouse_move
+
+
+def test_moves_missing_an_axis_are_merged():
+    assert merge_mouse_move({"dx": 3, "dy": 1}, {"dy": 2}) == {"dx": 3, "dy": 3}
+    assert merge_mouse_move({"dy": 1}, {"dx": 4}) == {"dx": 4, "dy": 1}
+
+
+def test_replies_keep_the_latest():
+    assert merge_mouse_move({"result": "Success"}, {"result": "Failure"}) == {"result": "Failure"}
+
+
+def test_routed_moves_keep_their_route():
+    older = protocol.route("10.0.0.2", protocol.encode("app", "mouse_move", dx=1), "10.0.0.9")
+    newer = protocol.route("10.0.0.2", protocol.encode("app", "mouse_move", dy=2), "10.0.0.9")
+    routed = protocol.split_route(merge(older, newer))
+    assert (routed.target, routed.sender) == ("10.0.0.2", "10.0.0.9")
+    assert protocol.loads(routed.payload) == {"sender": "app", "command": "mouse_move", "dx": 1, "dy": 2}
@@ -0,0 +1,48 @@
+import asyncio
+import protocol
+from connection_manager import Peer
+
+
+class StalledConnection:
+
+    # Takes one message, then holds every send until released
+    def __init__(self):
+        self.sent = []
+        self.released = asyncio.Event()
+
+    async def send(self, message: str):
+        if self.sent:
+            await self.released.wait()
+        self.sent.append(message)
+
+
+def update(version: int) -> str:
+    return protocol.encode("manager", "device_update", epoch="e", version=version,
+                           result=[{"ip": f"10.0.0.{version}", "status": "Online"}])
+
+
+def test_stalled_peer_drops_and_resyncs_since_the_last_update_sent():
+    async def main():
+        connection = StalledConnection()
+        peer = Peer("b", "ws://b")
+        peer.attach(connection)
+        peer.outbox.limit = 4
+        resyncs = []
+        peer.resync = lambda since: resyncs.append(since) or protocol.encode("manager", "device_info", since=since)
+
+        await peer.send(update(1))
+        await asyncio.sleep(0)  # Goes out, the link stalls behind it
+        for version in range(2, 10):
+            # Routed replies in between keep the updates from being merged
+            await asyncio.wait_for(peer.send(update(version)), 0.1)
+            await asyncio.wait_for(peer.send(protocol.route("10.0.0.9", update(version), "10.0.0.1")), 0.1)
+        assert peer.stale and len(peer.outbox) == 4
+
+        connection.released.set()
+        await asyncio.sleep(0.05)
+        peer.detach()
+        return connection.sent, resyncs
+
+    sent, resyncs = asyncio.run(main())
+    assert resyncs == [1]
+    assert protocol.loads(sent[-1]) == {"sender": "manager", "command": "device_info", "since": 1}
@@ -0,0 +1,16 @@
+import pytest
+from pathlib import Path
+
+# The agent and the app are built from their own directories, so the modules
+# all three speak with are copied into each. The manager's copy is the one
+# that gets edited, this catches a copy that was not updated.
+ROOT = Path(__file__).resolve().parent.parent.parent
+SHARED = ("protocol.py", "channels.py", "lazy_logging.py")
+COPIES = ("lazy_egm", "lazy_app")
+
+
+@pytest.mark.parametrize("name", SHARED)
+@pytest.mark.parametrize("component", COPIES)
+def test_copy_matches_the_manager(component, name):
+    assert (ROOT / component / name).read_bytes() == (ROOT / "lazy_manager" / name).read_bytes(), \
+        f"{component}/{name} differs from lazy_manager/{name}, copy it over"